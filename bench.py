@@ -0,0 +1,779 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def peak_rss_mb():
+    if resource is None:
+        return float("nan")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+def legacy_prepare_image(image_path, target_size):
+    image = Image.open(image_path).convert("RGBA")
+
+    canvas = Image.new("RGBA", image.size, (255, 255, 255))
+    canvas.alpha_composite(image)
+    image = canvas.convert("RGB")
+
+    image_shape = image.size
+    max_dim = max(image_shape)
+    pad_left = (max_dim - image_shape[0]) // 2
+    pad_top = (max_dim - image_shape[1]) // 2
+
+    padded_image = Image.new("RGB", (max_dim, max_dim), (255, 255, 255))
+    padded_image.paste(image, (pad_left, pad_top))
+
+    if max_dim != target_size:
+        padded_image = padded_image.resize((target_size, target_size), Image.BICUBIC)
+
+    image_array = np.asarray(padded_image, dtype=np.float32)
+    image_array = image_array[:, :, ::-1]
+    return np.expand_dims(image_array, axis=0)
+
+def _prepare_image_child(variant, image_path, target_size, queue):
+    from wd_tagger.tagger import Predictor
+
+    predictor = Predictor()
+    predictor.model_target_size = target_size
+    base_rss = peak_rss_mb()
+    start = time.perf_counter()
+    if variant == "legacy":
+        result = legacy_prepare_image(image_path, target_size)
+    else:
+        result = predictor.prepare_image(image_path)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, peak_rss_mb() - base_rss, np.ascontiguousarray(result)))
+
+def run_isolated(target, *args):
+    # Every measurement gets a fresh process so peak RSS isn't polluted by earlier runs
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=(*args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def make_test_images(directory, width, height):
+    rng = np.random.default_rng(0)
+    # Smooth gradients plus noise so the encoders and resamplers do realistic work
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1).astype(np.uint8)
+    rgb = np.clip(rgb + rng.integers(0, 16, rgb.shape, dtype=np.uint8), 0, 255).astype(np.uint8)
+
+    paths = []
+    jpeg_path = os.path.join(directory, f"large_{width}x{height}.jpg")
+    Image.fromarray(rgb).save(jpeg_path, quality=92)
+    paths.append(jpeg_path)
+
+    alpha = np.full((height, width, 1), 255, dtype=np.uint8)
+    alpha[: height // 3] = 0
+    png_path = os.path.join(directory, f"large_{width}x{height}_alpha.png")
+    Image.fromarray(np.concatenate([rgb, alpha], axis=-1)).save(png_path, compress_level=1)
+    paths.append(png_path)
+    return paths
+
+def bench_prepare_image(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.images or make_test_images(tmp, args.width, args.height)
+        for path in paths:
+            legacy_time, legacy_mem, legacy_out = run_isolated(_prepare_image_child, "legacy", path, args.target_size)
+            fast_time, fast_mem, fast_out = run_isolated(_prepare_image_child, "fast", path, args.target_size)
+            diff = np.abs(legacy_out - fast_out)
+            print(f"{os.path.basename(path)}")
+            print(f"  legacy: {legacy_time * 1000:8.1f} ms  peak +{legacy_mem:7.1f} MB")
+            print(f"  fast:   {fast_time * 1000:8.1f} ms  peak +{fast_mem:7.1f} MB")
+            print(f"  mean abs diff {diff.mean():.3f}, p99 {np.percentile(diff, 99):.1f} (0-255 scale)")
+
+def legacy_load_labels(csv_path):
+    import pandas as pd
+    from wd_tagger.tag_table import kaomojis
+
+    dataframe = pd.read_csv(csv_path)
+    name_series = dataframe["name"].map(lambda x: x.replace("_", " ") if x not in kaomojis else x)
+    tag_names = name_series.tolist()
+    rating_indexes = list(np.where(dataframe["category"] == 9)[0])
+    general_indexes = list(np.where(dataframe["category"] == 0)[0])
+    character_indexes = list(np.where(dataframe["category"] == 4)[0])
+    return tag_names, rating_indexes, general_indexes, character_indexes
+
+def _tag_table_child(variant, csv_path, table_dir, queue):
+    base_rss = peak_rss_mb()
+    start = time.perf_counter()
+    if variant == "pandas":
+        legacy_load_labels(csv_path)
+    else:
+        from wd_tagger.tag_table import TagTable
+        table = TagTable.load(table_dir)
+        table.indexes(9), table.indexes(0), table.indexes(4)
+    queue.put((time.perf_counter() - start, peak_rss_mb() - base_rss, None))
+
+def make_tag_csv(path, count):
+    rng = np.random.default_rng(0)
+    categories = rng.choice([0, 4, 9], size=count, p=[0.7, 0.2996, 0.0004])
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("tag_id,name,category,count\n")
+        for i, category in enumerate(categories):
+            f.write(f"{i},some_tag_name_{i},{category},{count - i}\n")
+
+def bench_tag_table(args):
+    from wd_tagger.tag_table import compile_tag_table
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = args.csv or os.path.join(tmp, "selected_tags.csv")
+        if not args.csv:
+            make_tag_csv(csv_path, args.count)
+        table_dir = os.path.join(tmp, "tag_table")
+        start = time.perf_counter()
+        compile_tag_table(csv_path, table_dir)
+        print(f"tag table: one-off compile {(time.perf_counter() - start) * 1000:.1f} ms")
+        for variant in ("pandas", "tag_table"):
+            elapsed, memory, _ = run_isolated(_tag_table_child, variant, csv_path, table_dir)
+            print(f"  {variant:10s} load (incl. imports) {elapsed * 1000:8.1f} ms  peak +{memory:6.1f} MB")
+
+def start_stub_server(handler_class):
+    import http.server
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.connections = 0
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def openrouter_stub_handler():
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+        disable_nagle_algorithm = True  # headers and body are separate writes
+
+        def setup(self):
+            super().setup()
+            self.server.connections += 1
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = json.dumps({"choices": [{"message": {"content": "a stub caption"}}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def openrouter_sse_stub_handler(tokens, token_delay):
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not request.get("stream"):
+                time.sleep(token_delay * len(tokens))
+                body = json.dumps({"choices": [{"message": {"content": "".join(tokens)}}]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.write_chunk(b": OPENROUTER PROCESSING\n\n")
+            for token in tokens:
+                time.sleep(token_delay)
+                event = {"choices": [{"delta": {"content": token}}]}
+                self.write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+            self.write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def bench_openrouter_stream(args):
+    from providers import OpenRouterClient
+
+    tokens = [f"word{i} " for i in range(args.tokens)]
+    server = start_stub_server(openrouter_sse_stub_handler(tokens, args.token_delay))
+    client = OpenRouterClient("stub-key", url=f"http://127.0.0.1:{server.server_address[1]}/")
+
+    start = time.perf_counter()
+    full_text = client.describe("hi", "stub", 256, 0.7, 1.0, use_cache=False)
+    blocking = time.perf_counter() - start
+
+    start = time.perf_counter()
+    first_token = None
+    parts = []
+    for token in client.stream("hi", "stub", 256, 0.7, 1.0, use_cache=False):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+        parts.append(token)
+    streamed = time.perf_counter() - start
+
+    assert "".join(parts) == full_text
+    print(f"openrouter SSE stub ({args.tokens} tokens, {args.token_delay * 1000:.0f} ms apart)")
+    print(f"  blocking:  first text after {blocking * 1000:7.1f} ms")
+    print(f"  streaming: first token after {first_token * 1000:7.1f} ms, complete after {streamed * 1000:7.1f} ms")
+    client.close()
+    server.shutdown()
+
+def bench_http_pool(args):
+    import requests
+    from providers import OpenRouterClient
+
+    server = start_stub_server(openrouter_stub_handler())
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/v1/chat/completions"
+    data = {"model": "stub", "messages": [{"role": "user", "content": "hi"}]}
+
+    def timed(call):
+        server.connections = 0
+        latencies = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start)
+        return latencies, server.connections
+
+    def unpooled():
+        response = requests.post(url, json=data)
+        response.raise_for_status()
+        response.json()
+
+    client = OpenRouterClient("stub-key", url=url)
+    results = {
+        "requests.post": timed(unpooled),
+        "pooled session": timed(lambda: client.describe("hi", "stub", 16, 0.7, 1.0)),
+    }
+    print(f"openrouter stub ({args.requests} sequential requests, plain HTTP on localhost, no TLS)")
+    for name, (latencies, connections) in results.items():
+        latencies = sorted(latencies)
+        print(f"  {name:15s} p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms  "
+              f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.2f} ms  connections opened: {connections}")
+    client.close()
+    server.shutdown()
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from PyQt5.QtWidgets import QApplication
+import labeler
+imported = time.perf_counter()
+app = QApplication(sys.argv)
+window = labeler.ImageTextPairApp()
+window.show()
+app.processEvents()
+shown = time.perf_counter()
+window.open_directory(sys.argv[1])
+app.processEvents()
+first_image = time.perf_counter()
+heavy = ["requests", "fal_client", "onnxruntime", "pandas", "huggingface_hub", "numpy", "PIL"]
+print(json.dumps({
+    "import": imported - start,
+    "window": shown - imported,
+    "first_image": first_image - shown,
+    "total": first_image - start,
+    "heavy_modules": [name for name in heavy if name in sys.modules],
+}))
+"""
+
+def bench_startup(args):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get("QT_QPA_PLATFORM", "offscreen"))
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.directory
+        if directory is None:
+            directory = tmp
+            for i in range(args.count):
+                Image.new("RGB", (64, 64), (i % 256, 128, 64)).save(os.path.join(tmp, f"{i:06d}.png"))
+
+        runs = []
+        for _ in range(args.runs):
+            output = subprocess.run(
+                [sys.executable, "-c", STARTUP_SCRIPT, directory],
+                cwd=repo_dir, env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"startup ({args.runs} runs, {len(os.listdir(directory)) if args.directory else args.count} files, median)")
+    for key in ("import", "window", "first_image", "total"):
+        print(f"  {key:12s} {statistics.median(run[key] for run in runs) * 1000:8.1f} ms")
+    print(f"  heavy modules loaded at startup: {', '.join(runs[0]['heavy_modules']) or 'none'}")
+
+def make_caption_sidecars(directory, count, labeled=0.9):
+    rng = np.random.default_rng(0)
+    vocabulary = [f"tag {i}" for i in range(5000)]
+    image_files = []
+    for i in range(count):
+        image_file = f"{i:06d}.png"
+        image_files.append(image_file)
+        if rng.random() < labeled:
+            tags = ["1girl"] * (rng.random() < 0.5) + ["solo"] * (rng.random() < 0.3)
+            tags += [vocabulary[j] for j in rng.choice(300, 12, replace=False)]
+            tags += [vocabulary[j] for j in rng.choice(len(vocabulary), 8, replace=False)]
+            with open(os.path.join(directory, f"{i:06d}.txt"), "w", encoding="utf-8") as f:
+                f.write(", ".join(tags))
+    return image_files
+
+def bench_tag_index(args):
+    from dataset_tools.tag_index import TagIndex
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image_files = make_caption_sidecars(tmp, args.count)
+        store_path = os.path.join(tmp, "cache", "captions.sqlite")
+        for label in ("cold", "warm"):
+            start = time.perf_counter()
+            index = TagIndex.open(tmp, image_files, store_path=store_path)
+            print(f"tag index: {label} open of {args.count} sidecars {(time.perf_counter() - start) * 1000:8.1f} ms")
+            if label == "cold":
+                index.close()
+
+        for query in ("1girl, -solo", "1girl, solo, tag 1", "-1girl", "tag 4999"):
+            times = []
+            for _ in range(20):
+                start = time.perf_counter()
+                matches = index.query(query)
+                times.append(time.perf_counter() - start)
+            print(f"  query {query!r:24s} {len(matches):7d} matches  p50 {statistics.median(times) * 1000:6.2f} ms")
+
+        with open(os.path.join(tmp, "000001.txt"), "w", encoding="utf-8") as f:
+            f.write("1girl, solo, new tag")
+        start = time.perf_counter()
+        index.refresh(1, image_files[1])
+        print(f"  refresh after save {(time.perf_counter() - start) * 1000:6.2f} ms")
+        start = time.perf_counter()
+        index.remove(0, image_files[0])
+        print(f"  remove after delete {(time.perf_counter() - start) * 1000:6.2f} ms")
+        index.close()
+
+def bench_dedupe(args):
+    import numpy as np
+    from dataset_tools.dedupe import near_pairs, popcount
+
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(0, 2**64, args.count, dtype=np.uint64)
+    # Plant a near copy for every 20th hash, a few bits away
+    planted = np.arange(0, args.count, 20)
+    flips = np.zeros(len(planted), dtype=np.uint64)
+    for _ in range(4):
+        flips |= np.uint64(1) << rng.integers(0, 64, len(planted)).astype(np.uint64)
+    hashes = np.concatenate([hashes, hashes[planted] ^ flips])
+    for distance in args.distances:
+        start = time.perf_counter()
+        pairs = near_pairs(hashes, distance)
+        elapsed = time.perf_counter() - start
+        assert (popcount(hashes[pairs[:, 0]] ^ hashes[pairs[:, 1]]) <= distance).all()
+        print(f"dedupe: {len(hashes)} hashes, distance {distance:2d}: {len(pairs):6d} pairs in {elapsed * 1000:8.1f} ms")
+
+def bench_embeddings(args):
+    import numpy as np
+    from dataset_tools.embeddings import EmbeddingIndex, normalize
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(args.count // 300, args.dim))
+    vectors = normalize(centers[rng.integers(0, len(centers), args.count)] + rng.normal(size=(args.count, args.dim)) * 0.8)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "vectors.f16")
+        vectors.astype(np.float16).tofile(path)
+        del vectors
+        mapped = np.memmap(path, dtype=np.float16, mode="r", shape=(args.count, args.dim))
+        rows = rng.permutation(args.count)  # storage order differs from image order, as after rescans
+        start = time.perf_counter()
+        index = EmbeddingIndex(mapped, rows)
+        print(f"embeddings: index over {args.count}x{args.dim} float16 built in {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+        times, recall = [], []
+        for position in rng.integers(0, args.count, 20):
+            start = time.perf_counter()
+            found = {neighbour for neighbour, _ in index.similar(position, 10)}
+            times.append(time.perf_counter() - start)
+            exact = np.concatenate([index.gather(np.arange(i, min(i + 8192, args.count))) @ index.gather([position])[0]
+                                    for i in range(0, args.count, 8192)])
+            exact[position] = -np.inf
+            recall.append(len(found & set(np.argsort(-exact)[:10].tolist())) / 10)
+        print(f"  similar k=10  p50 {statistics.median(times) * 1000:6.2f} ms  recall@10 {np.mean(recall):.3f}")
+        start = time.perf_counter()
+        groups = index.clusters(args.clusters)
+        print(f"  {len(groups)} clusters in {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+def bench_buckets(args):
+    import struct
+    import zlib
+    from dataset_tools.resolution import DEFAULT_MIN_SIDE, BucketReport, SizeStore, scan_sizes
+
+    # Small real PNG and JPEG files whose headers are patched to random training-photo sizes: the scan
+    # never looks past the header, and writing 100k genuinely large images would take far longer than the scan
+    rng = np.random.default_rng(0)
+    templates = {}
+    for extension, image_format, options in (("png", "PNG", {}), ("jpg", "JPEG", {"exif": b"Exif\0\0" + bytes(4096)})):
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 64), (120, 80, 40)).save(buffer, image_format, **options)
+        templates[extension] = buffer.getvalue()
+
+    def patched(extension, width, height):
+        data = templates[extension]
+        if extension == "png":
+            ihdr = b"IHDR" + struct.pack(">II", width, height) + data[24:29]
+            return data[:12] + ihdr + struct.pack(">I", zlib.crc32(ihdr)) + data[33:]
+        offset = data.index(b"\xff\xc0") + 5
+        return data[:offset] + struct.pack(">HH", height, width) + data[offset + 4:]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image_files = []
+        long_sides = rng.integers(300, 6000, args.count)
+        aspects = np.exp(rng.normal(0, 0.35, args.count))
+        for i, (long_side, aspect) in enumerate(zip(long_sides.tolist(), aspects.tolist())):
+            extension = "png" if i % 2 else "jpg"
+            if aspect >= 1:
+                width, height = long_side, max(1, round(long_side / aspect))
+            else:
+                width, height = max(1, round(long_side * aspect)), long_side
+            image_file = f"{i:06d}.{extension}"
+            with open(os.path.join(tmp, image_file), "wb") as f:
+                f.write(patched(extension, width, height))
+            image_files.append(image_file)
+
+        store = SizeStore(os.path.join(tmp, "cache", "sizes.sqlite"))
+        for label in ("cold", "warm"):
+            start = time.perf_counter()
+            image_sizes = scan_sizes(tmp, image_files, store, args.workers)
+            print(f"buckets: {label} header scan of {args.count} images {(time.perf_counter() - start) * 1000:8.1f} ms")
+        store.close()
+        assert image_sizes.valid.all()
+        sample = image_files[:args.pil_sample]
+        start = time.perf_counter()
+        for image_file in sample:
+            with Image.open(os.path.join(tmp, image_file)) as image:
+                image.size
+        per_image = (time.perf_counter() - start) / len(sample)
+        print(f"  PIL Image.open per image {per_image * 1e6:6.1f} us ({per_image * args.count * 1000:8.1f} ms for all, one thread)")
+        start = time.perf_counter()
+        report = BucketReport(image_sizes, min_side=DEFAULT_MIN_SIDE)
+        print(f"  report {(time.perf_counter() - start) * 1000:6.1f} ms: {int((report.counts > 0).sum())} buckets used, "
+              f"{len(report.small)} small images")
+
+def make_standin_captioner(model_dir, dim=64, heads=4, layers=2, image_size=224, patch=16, seed=0):
+    # A randomly initialised model with the same graph inputs and outputs as the Florence-2 export, small
+    # enough to build in a second. Its captions are noise, it exercises batching and the KV cache. Self
+    # attention is causal like BART's, so decoding with the cache matches recomputing the whole sequence
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors
+    from wd_tagger.captioner import CAPTIONER_FILES, TASK_PROMPTS
+
+    rng = np.random.default_rng(seed)
+    words = sorted({word for prompt in TASK_PROMPTS.values() for word in prompt.replace("?", " ").replace(".", " ").split()}
+                   | {f"word{i}" for i in range(200)})
+    vocab = {token: i for i, token in enumerate(["<s>", "<pad>", "</s>", "<unk>", *words])}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.add_special_tokens(["<s>", "<pad>", "</s>", "<unk>"])
+    tokenizer.post_processor = processors.TemplateProcessing(single="<s> $A </s>", special_tokens=[("<s>", 0), ("</s>", 2)])
+    tokenizer_path, vision_path, embed_path, encoder_path, decoder_path = [os.path.join(model_dir, f) for f in CAPTIONER_FILES]
+    os.makedirs(os.path.dirname(vision_path), exist_ok=True)
+    tokenizer.save(tokenizer_path)
+
+    head_size = dim // heads
+    initializers = []
+
+    def weight(name, *shape, scale=None):
+        values = rng.normal(0, scale or shape[0] ** -0.5, shape).astype(np.float32)
+        initializers.append(numpy_helper.from_array(values, name))
+        return name
+
+    def constant(name, values, dtype=np.int64):
+        initializers.append(numpy_helper.from_array(np.array(values, dtype=dtype), name))
+        return name
+
+    def tensor(name, elem_type, shape):
+        return helper.make_tensor_value_info(name, elem_type, shape)
+
+    def save(path, nodes, inputs, outputs):
+        graph = helper.make_graph(nodes, os.path.basename(path), inputs, outputs, list(initializers))
+        onnx.save(helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)], ir_version=8), path)
+        initializers.clear()
+
+    save(vision_path, [
+        helper.make_node("AveragePool", ["pixel_values"], ["pooled"], kernel_shape=[patch, patch], strides=[patch, patch]),
+        helper.make_node("Reshape", ["pooled", constant("flat", [0, 3, -1])], ["patches"]),
+        helper.make_node("Transpose", ["patches"], ["tokens"], perm=[0, 2, 1]),
+        helper.make_node("MatMul", ["tokens", weight("vision", 3, dim)], ["image_features"]),
+    ], [tensor("pixel_values", TensorProto.FLOAT, ["batch", 3, image_size, image_size])],
+        [tensor("image_features", TensorProto.FLOAT, ["batch", "patches", dim])])
+
+    save(embed_path, [helper.make_node("Gather", [weight("embeddings", len(vocab), dim, scale=1.0), "input_ids"], ["inputs_embeds"])],
+         [tensor("input_ids", TensorProto.INT64, ["batch", "length"])],
+         [tensor("inputs_embeds", TensorProto.FLOAT, ["batch", "length", dim])])
+
+    save(encoder_path, [
+        helper.make_node("Cast", ["attention_mask"], ["mask"], to=TensorProto.FLOAT),
+        helper.make_node("Unsqueeze", ["mask", constant("last", [-1])], ["mask_3d"]),
+        helper.make_node("Mul", ["inputs_embeds", "mask_3d"], ["masked"]),
+        helper.make_node("MatMul", ["masked", weight("encoder", dim, dim)], ["projected"]),
+        helper.make_node("Tanh", ["projected"], ["last_hidden_state"]),
+    ], [tensor("inputs_embeds", TensorProto.FLOAT, ["batch", "length", dim]),
+        tensor("attention_mask", TensorProto.INT64, ["batch", "length"])],
+        [tensor("last_hidden_state", TensorProto.FLOAT, ["batch", "length", dim])])
+
+    nodes = []
+    split_shape, merge_shape = constant("split_heads", [0, 0, heads, head_size]), constant("merge_heads", [0, 0, dim])
+
+    def project(source, name):
+        nodes.append(helper.make_node("MatMul", [source, weight(f"{name}_weight", dim, dim)], [f"{name}_flat"]))
+        nodes.append(helper.make_node("Reshape", [f"{name}_flat", split_shape], [f"{name}_split"]))
+        nodes.append(helper.make_node("Transpose", [f"{name}_split"], [name], perm=[0, 2, 1, 3]))
+        return name
+
+    def causal_mask(scores, name):
+        # Query i of the newest length tokens sees keys up to past length + i
+        nodes.append(helper.make_node("Shape", [scores], [f"{name}_shape"]))
+        nodes.append(helper.make_node("Gather", [f"{name}_shape", constant(f"{name}_length_axis", 2)], [f"{name}_length"]))
+        nodes.append(helper.make_node("Gather", [f"{name}_shape", constant(f"{name}_keys_axis", 3)], [f"{name}_keys"]))
+        nodes.append(helper.make_node("Sub", [f"{name}_keys", f"{name}_length"], [f"{name}_past"]))
+        nodes.append(helper.make_node("Range", [f"{name}_past", f"{name}_keys", constant(f"{name}_one", 1)], [f"{name}_rows"]))
+        nodes.append(helper.make_node("Range", [constant(f"{name}_zero", 0), f"{name}_keys", f"{name}_one"], [f"{name}_cols"]))
+        nodes.append(helper.make_node("Unsqueeze", [f"{name}_rows", constant(f"{name}_axis", [-1])], [f"{name}_rows_2d"]))
+        nodes.append(helper.make_node("Greater", [f"{name}_cols", f"{name}_rows_2d"], [f"{name}_future"]))
+        nodes.append(helper.make_node("Where", [f"{name}_future", constant(f"{name}_blocked", -1e9, np.float32),
+                                                constant(f"{name}_open", 0.0, np.float32)], [f"{name}_bias"]))
+        nodes.append(helper.make_node("Add", [scores, f"{name}_bias"], [f"{name}_masked"]))
+        return f"{name}_masked"
+
+    def attend(query, key, value, name, causal=False):
+        nodes.append(helper.make_node("Transpose", [key], [f"{name}_kt"], perm=[0, 1, 3, 2]))
+        nodes.append(helper.make_node("MatMul", [query, f"{name}_kt"], [f"{name}_scores"]))
+        scores = causal_mask(f"{name}_scores", name) if causal else f"{name}_scores"
+        nodes.append(helper.make_node("Softmax", [scores], [f"{name}_weights"], axis=-1))
+        nodes.append(helper.make_node("MatMul", [f"{name}_weights", value], [f"{name}_heads"]))
+        nodes.append(helper.make_node("Transpose", [f"{name}_heads"], [f"{name}_merged"], perm=[0, 2, 1, 3]))
+        nodes.append(helper.make_node("Reshape", [f"{name}_merged", merge_shape], [name]))
+        return name
+
+    inputs = [tensor("encoder_attention_mask", TensorProto.INT64, ["batch", "encoder_length"]),
+              tensor("encoder_hidden_states", TensorProto.FLOAT, ["batch", "encoder_length", dim]),
+              tensor("inputs_embeds", TensorProto.FLOAT, ["batch", "length", dim])]
+    outputs = [tensor("logits", TensorProto.FLOAT, ["batch", "length", len(vocab)])]
+    hidden = "inputs_embeds"
+    for layer in range(layers):
+        for kind in ("decoder", "encoder"):
+            for part in ("key", "value"):
+                inputs.append(tensor(f"past_key_values.{layer}.{kind}.{part}", TensorProto.FLOAT,
+                                     ["batch", heads, f"past_{kind}_length", head_size]))
+                outputs.append(tensor(f"present.{layer}.{kind}.{part}", TensorProto.FLOAT,
+                                      ["batch", heads, f"{kind}_length", head_size]))
+        query = project(hidden, f"query{layer}")
+        for part in ("key", "value"):
+            nodes.append(helper.make_node("Concat", [f"past_key_values.{layer}.decoder.{part}", project(hidden, f"{part}{layer}")],
+                                          [f"present.{layer}.decoder.{part}"], axis=2))
+            # The merged export recomputes these only without a cache, the stand-in always does
+            nodes.append(helper.make_node("Identity", [project("encoder_hidden_states", f"cross_{part}{layer}")],
+                                          [f"present.{layer}.encoder.{part}"]))
+        self_attention = attend(query, f"present.{layer}.decoder.key", f"present.{layer}.decoder.value", f"self{layer}",
+                                causal=True)
+        cross_attention = attend(query, f"present.{layer}.encoder.key", f"present.{layer}.encoder.value", f"cross{layer}")
+        nodes.append(helper.make_node("Sum", [hidden, self_attention, cross_attention], [f"hidden{layer}"]))
+        hidden = f"hidden{layer}"
+    nodes.append(helper.make_node("MatMul", [hidden, weight("lm_head", dim, len(vocab))], ["logits"]))
+    inputs.append(tensor("use_cache_branch", TensorProto.BOOL, [1]))
+    save(decoder_path, nodes, inputs, outputs)
+
+def bench_captioner(args):
+    from wd_tagger.captioner import CAPTIONER_FILES, CaptionGenerator, ImageCaptioner
+    from wd_tagger.model_store import ModelStore
+    from wd_tagger.tuning import TuningConfig
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.model:
+            store = ModelStore()
+            model_repo, revision = ImageCaptioner().model_spec(args.model)
+            store.resolve(model_repo, revision, files=CAPTIONER_FILES)
+        else:
+            store = ModelStore(os.path.join(tmp, "store"))
+            model_repo, revision = "standin/captioner", "main"
+            make_standin_captioner(store.model_dir(model_repo, revision))
+        rng = np.random.default_rng(0)
+        image_paths = []
+        for i in range(args.images):
+            image_paths.append(os.path.join(tmp, f"{i}.jpg"))
+            Image.fromarray(rng.integers(0, 256, (768, 1024, 3), dtype=np.uint8)).save(image_paths[-1], quality=90)
+        for batch_size in args.batch_sizes:
+            generator = CaptionGenerator(store, TuningConfig(batch_size, decode_workers=2))
+            generator.load_model(model_repo, revision)
+            start = time.perf_counter()
+            results = list(generator.run_many(image_paths, model_repo, revision, args.task, args.max_tokens))
+            seconds = time.perf_counter() - start
+            images, tokens, _ = generator.stats.snapshot()
+            failed = sum(error is not None for _, error in results)
+            print(f"captioner batch {batch_size:2d}: {images / seconds:6.2f} images/s  {tokens / seconds:8.1f} tokens/s  "
+                  f"({tokens / max(images, 1):.0f} tokens per caption on {generator.device}"
+                  + (f", {failed} failed" if failed else "") + ")")
+
+def bench_tiling(args):
+    from wd_tagger.tagger import ImageTagger
+    from wd_tagger.tiling import TilingOptions
+
+    tagger = ImageTagger()
+    tagger.preload(args.model)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.images or [make_test_images(tmp, width, height)[0] for width, height in args.sizes]
+        for path in paths:
+            timings = {}
+            for label, tiling in (("single", None), ("tiled", TilingOptions(args.grid, args.overlap, args.merge))):
+                before = tagger.predictor.tiling_stats.snapshot()
+                times = []
+                for _ in range(args.runs):
+                    start = time.perf_counter()
+                    tagger.tag_image(path, args.model, tiling=tiling)
+                    times.append(time.perf_counter() - start)
+                timings[label] = statistics.median(times)
+            images, views = (now - then for now, then in zip(tagger.predictor.tiling_stats.snapshot(), before))
+            with Image.open(path) as image:
+                size = "x".join(map(str, image.size))
+            print(f"tiling {os.path.basename(path)} ({size}): single {timings['single'] * 1000:7.1f} ms  "
+                  f"tiled {timings['tiled'] * 1000:7.1f} ms ({views // images} views)  "
+                  f"{timings['tiled'] / timings['single']:.1f}x the time of a single pass")
+
+def bench_scheduler(args):
+    from scheduler import INTERACTIVE, BATCH, PriorityScheduler
+
+    # Several batch jobs (captioning, statistics and embedding scans) keep one tagger slot busy while
+    # interactive requests arrive. Without priorities they queue behind every job's next item
+    item = args.item_ms / 1000
+    for label, interactive_priority in (("fifo", BATCH), ("priority", INTERACTIVE)):
+        scheduler = PriorityScheduler("bench")
+        stop = threading.Event()
+
+        def batch_job():
+            while not stop.is_set():
+                scheduler.run(lambda: time.sleep(item), BATCH)
+
+        jobs = [threading.Thread(target=batch_job) for _ in range(args.batch_jobs)]
+        for job in jobs:
+            job.start()
+        latencies = []
+        for _ in range(args.requests):
+            time.sleep(item * 2.5)
+            start = time.perf_counter()
+            scheduler.run(lambda: time.sleep(item), interactive_priority)
+            latencies.append(time.perf_counter() - start)
+        stop.set()
+        for job in jobs:
+            job.join()
+        scheduler.close()
+        waits = scheduler.wait_stats()
+        latencies.sort()
+        print(f"scheduler {label:8s}: interactive p50 {statistics.median(latencies) * 1000:6.1f} ms  "
+              f"p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000:6.1f} ms  "
+              f"batch items {waits['batch']['count']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the labeler and wd tagger")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prepare = subparsers.add_parser("prepare-image", help="Compare prepare_image against the legacy full-size path")
+    prepare.add_argument("images", nargs="*", help="Images to test (defaults to generated large JPEG/PNG)")
+    prepare.add_argument("--width", type=int, default=6000)
+    prepare.add_argument("--height", type=int, default=4000)
+    prepare.add_argument("--target-size", type=int, default=448)
+    prepare.set_defaults(func=bench_prepare_image)
+
+    tag_table = subparsers.add_parser("tag-table", help="Compare pandas label parsing against the compiled tag table")
+    tag_table.add_argument("csv", nargs="?", help="selected_tags.csv to test (defaults to a generated one)")
+    tag_table.add_argument("--count", type=int, default=10861)
+    tag_table.set_defaults(func=bench_tag_table)
+
+    http_pool = subparsers.add_parser("http-pool", help="Per-request latency against a local OpenRouter stub")
+    http_pool.add_argument("--requests", type=int, default=200)
+    http_pool.set_defaults(func=bench_http_pool)
+
+    stream = subparsers.add_parser("openrouter-stream", help="Time to first token against a local SSE stub")
+    stream.add_argument("--tokens", type=int, default=100)
+    stream.add_argument("--token-delay", type=float, default=0.02)
+    stream.set_defaults(func=bench_openrouter_stream)
+
+    startup = subparsers.add_parser("startup", help="Time from launch to the first image being shown")
+    startup.add_argument("directory", nargs="?", help="Dataset to open (defaults to generated small PNGs)")
+    startup.add_argument("--count", type=int, default=2000)
+    startup.add_argument("--runs", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    tag_index = subparsers.add_parser("tag-index", help="Build and query the caption tag index")
+    tag_index.add_argument("--count", type=int, default=100000)
+    tag_index.set_defaults(func=bench_tag_index)
+
+    dedupe = subparsers.add_parser("dedupe", help="Near-duplicate search over random 64-bit hashes")
+    dedupe.add_argument("--count", type=int, default=100000)
+    dedupe.add_argument("--distances", type=int, nargs="+", default=[4, 8, 10])
+    dedupe.set_defaults(func=bench_dedupe)
+
+    embeddings = subparsers.add_parser("embeddings", help="Similar-image search and clustering over synthetic embeddings")
+    embeddings.add_argument("--count", type=int, default=100000)
+    embeddings.add_argument("--dim", type=int, default=1024)
+    embeddings.add_argument("--clusters", type=int, default=50)
+    embeddings.set_defaults(func=bench_embeddings)
+
+    buckets = subparsers.add_parser("buckets", help="Header-only resolution scan and bucket report")
+    buckets.add_argument("--count", type=int, default=100000)
+    buckets.add_argument("--workers", type=int, default=8)
+    buckets.add_argument("--pil-sample", type=int, default=2000)
+    buckets.set_defaults(func=bench_buckets)
+
+    scheduler = subparsers.add_parser("scheduler", help="Interactive latency with batch jobs sharing the tagger slot")
+    scheduler.add_argument("--batch-jobs", type=int, default=3)
+    scheduler.add_argument("--item-ms", type=float, default=40)
+    scheduler.add_argument("--requests", type=int, default=40)
+    scheduler.set_defaults(func=bench_scheduler)
+
+    captioner = subparsers.add_parser("captioner", help="Local caption throughput per batch size (stand-in model by default)")
+    captioner.add_argument("--model", help="A captioner from the model store, e.g. Florence_2_Base")
+    captioner.add_argument("--images", type=int, default=32)
+    captioner.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    captioner.add_argument("--task", default="<MORE_DETAILED_CAPTION>")
+    captioner.add_argument("--max-tokens", type=int, default=64)
+    captioner.set_defaults(func=bench_captioner)
+
+    tiling = subparsers.add_parser("tiling", help="Cost of tiled tagging against a single pass (needs a model in the store)")
+    tiling.add_argument("images", nargs="*", help="Images to test (defaults to a generated panorama and comic page)")
+    tiling.add_argument("--sizes", type=lambda text: tuple(map(int, text.split("x"))), nargs="+",
+                        default=[(8000, 2000), (2400, 3600)], help="Generated image sizes, e.g. 8000x2000")
+    tiling.add_argument("--model", default="vitv3")
+    tiling.add_argument("--grid", type=int, default=2)
+    tiling.add_argument("--overlap", type=float, default=0.25)
+    tiling.add_argument("--merge", choices=["max", "mean"], default="max")
+    tiling.add_argument("--runs", type=int, default=5)
+    tiling.set_defaults(func=bench_tiling)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import json
+import os
+import time
+from collections import Counter
+
+import numpy as np
+
+from .cache import dataset_cache_dir
+from .tag_index import EMPTY, contains, map_chunks, read_sidecar, sidecar_name
+
+JOURNAL_FILENAME = "undo_journal.json"
+STAGED_SUFFIX = ".bulk.tmp"
+PREVIEW_LIMIT = 20
+
+def split_tags(text):
+    # Unlike parse_tags this keeps order and duplicates, it's what gets written back
+    return [tag for tag in map(str.strip, text.split(",")) if tag]
+
+def join_tags(tags):
+    return ", ".join(tags)
+
+def captioned_positions(index):
+    return np.flatnonzero([bool(tags) for tags in index.doc_tags]).astype(np.int32)
+
+class RenameTag:
+    def __init__(self, old, new):
+        self.old = old.strip()
+        self.new = new.strip()
+
+    def describe(self):
+        return f'Rename "{self.old}" to "{self.new}"'
+
+    def candidates(self, index):
+        return index.positions(self.old) if self.new else EMPTY
+
+    def apply(self, image_path, tags):
+        renamed, seen = [], False
+        for tag in tags:
+            tag = self.new if tag == self.old else tag
+            if tag == self.new:
+                if seen:
+                    continue  # renaming onto a tag that is already there merges the two
+                seen = True
+            renamed.append(tag)
+        return renamed
+
+class RemoveTag:
+    def __init__(self, tag):
+        self.tag = tag.strip()
+
+    def describe(self):
+        return f'Remove "{self.tag}"'
+
+    def candidates(self, index):
+        return index.positions(self.tag)
+
+    def apply(self, image_path, tags):
+        return [tag for tag in tags if tag != self.tag]
+
+class AddTriggerWord:
+    def __init__(self, word):
+        self.word = word.strip()
+
+    def describe(self):
+        return f'Add trigger word "{self.word}"'
+
+    def candidates(self, index):
+        return captioned_positions(index) if self.word else EMPTY
+
+    def apply(self, image_path, tags):
+        return [self.word] + [tag for tag in tags if tag != self.word]
+
+class DedupeTags:
+    def describe(self):
+        return "Remove duplicate tags within each caption"
+
+    def candidates(self, index):
+        return captioned_positions(index)
+
+    def apply(self, image_path, tags):
+        return list(dict.fromkeys(tags))
+
+class SortByConfidence:
+    def __init__(self, tagger, model):
+        self.tagger = tagger
+        self.model = model
+
+    def describe(self):
+        return f"Sort tags by {self.model} confidence"
+
+    def candidates(self, index):
+        return captioned_positions(index)
+
+    def apply(self, image_path, tags):
+        # Tags the model doesn't know (trigger words, names) stay in front in their current order
+        confidences = self.tagger.tag_confidences(image_path, tags, self.model)
+        unknown = [tag for tag, confidence in zip(tags, confidences) if confidence is None]
+        known = sorted(((confidence, i) for i, confidence in enumerate(confidences) if confidence is not None),
+                       key=lambda item: -item[0])
+        return unknown + [tags[i] for _, i in known]
+
+class BulkEditPlan:
+    def __init__(self, description, scanned, changes):
+        self.description = description
+        self.scanned = scanned
+        self.changes = changes  # (position, image_file, before, after)
+
+    def summary(self):
+        removed = added = reordered = 0
+        for _, _, before, after in self.changes:
+            before_tags, after_tags = Counter(split_tags(before)), Counter(split_tags(after))
+            removed += sum((before_tags - after_tags).values())
+            added += sum((after_tags - before_tags).values())
+            reordered += before_tags == after_tags
+        return (f"{self.description}: {len(self.changes)} of {self.scanned} captions change "
+                f"({removed} tags removed, {added} added, {reordered} only reordered)")
+
+    def preview(self, limit=PREVIEW_LIMIT):
+        lines = [self.summary(), ""]
+        for _, image_file, before, after in self.changes[:limit]:
+            lines += [image_file, f"  - {before}", f"  + {after}"]
+        if len(self.changes) > limit:
+            lines.append(f"... and {len(self.changes) - limit} more")
+        return "\n".join(lines)
+
+def plan_bulk_edit(directory, image_files, index, operation, positions=None, workers=8):
+    # Dry run: reads the candidate sidecars fresh and computes every new caption, nothing is written
+    candidates = operation.candidates(index)
+    if positions is not None:
+        candidates = candidates[contains(positions, candidates)]
+
+    def plan(chunk):
+        changes = []
+        for position in chunk:
+            image_file = image_files[position]
+            sidecar = read_sidecar(os.path.join(directory, sidecar_name(image_file)))
+            if not sidecar or not sidecar[2]:
+                continue
+            after = join_tags(operation.apply(os.path.join(directory, image_file), split_tags(sidecar[2])))
+            if after != sidecar[2]:
+                changes.append((int(position), image_file, sidecar[2], after))
+        return changes
+
+    return BulkEditPlan(operation.describe(), len(candidates), map_chunks(plan, candidates.tolist(), workers, 256))
+
+def journal_path(directory):
+    return dataset_cache_dir(directory) / JOURNAL_FILENAME
+
+def write_json_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_journal(directory):
+    try:
+        with open(journal_path(directory), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def discard_staged(directory, names):
+    for name in names:
+        try:
+            os.remove(os.path.join(directory, name) + STAGED_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+def write_captions(directory, captions, workers=8):
+    # captions are (name, text, expected). Every caption is fully written under a temporary name before
+    # any sidecar is replaced, so a failed write leaves the dataset untouched. A sidecar that no longer
+    # holds expected (None writes unconditionally) was edited since it was read and is left alone.
+    # Returns the names that were written
+    def stage(chunk):
+        staged = []
+        for name, text, expected in chunk:
+            path = os.path.join(directory, name)
+            if expected is not None:
+                sidecar = read_sidecar(path)
+                if (sidecar[2] if sidecar else "") != expected:
+                    continue
+            if text:
+                with open(path + STAGED_SUFFIX, "w", encoding="utf-8") as f:
+                    f.write(text)
+            staged.append((name, bool(text)))
+        return staged
+
+    written = []
+    try:
+        for name, has_text in map_chunks(stage, captions, workers, 256):
+            path = os.path.join(directory, name)
+            if has_text:
+                os.replace(path + STAGED_SUFFIX, path)
+            elif os.path.exists(path):
+                os.remove(path)  # an empty caption means no sidecar, as in save_description
+            written.append(name)
+    except BaseException:
+        discard_staged(directory, [name for name, text, _ in captions if text])
+        raise
+    return written
+
+def revert_entries(directory, entries, workers=8):
+    # Only sidecars still holding what the edit wrote are reverted, later hand edits are kept
+    written = set(write_captions(directory, [(entry["name"], entry["before"], entry["after"]) for entry in entries],
+                                 workers))
+    return [entry for entry in entries if entry["name"] in written]
+
+def commit_bulk_edit(directory, plan, workers=8):
+    # The plan may be stale by now, captions edited since the preview are skipped rather than overwritten
+    journal = {
+        "description": plan.description,
+        "created": time.time(),
+        "state": "pending",
+        "changes": [{"image": image_file, "name": sidecar_name(image_file), "before": before, "after": after}
+                    for _, image_file, before, after in plan.changes],
+    }
+    path = journal_path(directory)
+    write_json_atomic(path, journal)
+    try:
+        written = set(write_captions(
+            directory, [(entry["name"], entry["after"], entry["before"]) for entry in journal["changes"]], workers))
+    except BaseException:
+        revert_entries(directory, journal["changes"], workers)
+        journal["state"] = "rolled back"
+        write_json_atomic(path, journal)
+        raise
+    journal["skipped"] = [entry for entry in journal["changes"] if entry["name"] not in written]
+    journal["changes"] = [entry for entry in journal["changes"] if entry["name"] in written]
+    journal["state"] = "committed"
+    write_json_atomic(path, journal)
+    return journal
+
+def undo_last_bulk_edit(directory, workers=8):
+    journal = load_journal(directory)
+    if not journal or journal["state"] != "committed":
+        return None, []
+    reverted = revert_entries(directory, journal["changes"], workers)
+    journal["state"] = "undone"
+    write_json_atomic(journal_path(directory), journal)
+    return journal, reverted
+
+def recover_interrupted_edit(directory, workers=8):
+    # A journal left pending means the process died mid-commit, put back what was already swapped in
+    journal = load_journal(directory)
+    if not journal or journal["state"] != "pending":
+        return None
+    revert_entries(directory, journal["changes"], workers)
+    discard_staged(directory, [entry["name"] for entry in journal["changes"]])
+    journal["state"] = "rolled back"
+    write_json_atomic(journal_path(directory), journal)
+    return journal
@@ -0,0 +1,8 @@
+import os
+
+from provider_cache import CACHE_DIR, content_hash
+
+def dataset_cache_dir(directory):
+    # Kept outside the dataset so training scripts walking the folder never see it
+    key = content_hash(os.path.abspath(directory).encode("utf-8"))[:16]
+    return CACHE_DIR / "datasets" / key
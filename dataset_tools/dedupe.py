@@ -0,0 +1,173 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from provider_cache import SqliteCache
+from .cache import dataset_cache_dir
+from .tag_index import map_chunks
+
+HASH_METHODS = ("phash", "dhash")
+DEFAULT_MAX_DISTANCE = 8
+DCT_SIZE = 32
+HASH_SIZE = 8
+QUARTER_BITS = 16
+HASH_CHUNK_SIZE = 64
+
+if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+    popcount = np.bitwise_count
+else:
+    BYTE_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount(values):
+        return BYTE_COUNTS[values.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+def dct_matrix(size):
+    k = np.arange(size)[:, None]
+    i = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+DCT = dct_matrix(DCT_SIZE)
+
+def pack_bits(bits):
+    return int(np.packbits(bits.ravel()).view(">u8")[0])
+
+def to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def hash_image(path):
+    image = Image.open(path)
+    width, height = image.size
+    if image.format == "JPEG":
+        image.draft("L", (DCT_SIZE * 4, DCT_SIZE * 4))  # hashes only need a thumbnail's worth of pixels
+    gray = image.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.BILINEAR, reducing_gap=2.0)
+
+    pixels = np.asarray(gray, dtype=np.float32)
+    low = (DCT @ pixels @ DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    phash = pack_bits(low > np.median(low[1:]))  # DC term left out of the median, as in the usual pHash
+
+    small = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    dhash = pack_bits(small[:, 1:] > small[:, :-1])
+    return width, height, dhash, phash
+
+class HashStore(SqliteCache):
+    def __init__(self, path):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS hashes (name TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "width INTEGER NOT NULL, height INTEGER NOT NULL, dhash INTEGER NOT NULL, phash INTEGER NOT NULL)",
+        )
+
+    @classmethod
+    def for_directory(cls, directory):
+        return cls(dataset_cache_dir(directory) / "hashes.sqlite")
+
+    def load(self):
+        return {row[0]: row[1:] for row in self.execute("SELECT * FROM hashes")}
+
+    def put_many(self, rows):
+        self.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+class ImageHashes:
+    def __init__(self, image_files, rows):
+        self.image_files = image_files
+        self.valid = np.array([row is not None for row in rows], dtype=bool)
+        columns = np.array([row or (0, 0, 0, 0, 0) for row in rows], dtype=np.int64).reshape(-1, 5)
+        self.width, self.height, self.size = columns[:, 0], columns[:, 1], columns[:, 2]
+        self.dhash = columns[:, 3].copy().view(np.uint64)
+        self.phash = columns[:, 4].copy().view(np.uint64)
+
+def compute_hashes(directory, image_files, store, workers=8, progress=None):
+    # Cached by name, mtime and size; unreadable images are left out rather than failing the scan
+    cached = store.load()
+
+    def hash_chunk(chunk):
+        results, rows = [], []
+        for image_file in chunk:
+            path = os.path.join(directory, image_file)
+            try:
+                stat = os.stat(path)
+                entry = cached.get(image_file)
+                if entry and (entry[0], entry[1]) == (stat.st_mtime_ns, stat.st_size):
+                    width, height, dhash, phash = entry[2:]
+                else:
+                    width, height, dhash, phash = hash_image(path)
+                    dhash, phash = to_signed(dhash), to_signed(phash)
+                    rows.append((image_file, stat.st_mtime_ns, stat.st_size, width, height, dhash, phash))
+            except Exception as e:
+                print(f"Could not hash {image_file}: {e}")
+                results.append(None)
+                continue
+            results.append((width, height, stat.st_size, dhash, phash))
+        if rows:
+            store.put_many(rows)
+        return results
+
+    return ImageHashes(image_files, map_chunks(hash_chunk, image_files, workers, HASH_CHUNK_SIZE, progress))
+
+def flip_masks(bits, radius):
+    masks = [0]
+    for _ in range(radius):
+        masks = sorted({mask | (1 << bit) for mask in masks for bit in range(bits)} | set(masks))
+    return np.array(masks, dtype=np.int64)
+
+def near_pairs(hashes, max_distance):
+    # Multi-index hashing: two hashes within max_distance agree to within max_distance // 4 bits
+    # on at least one 16-bit quarter, so only those probes need to be verified
+    ids = np.arange(len(hashes))
+    masks = flip_masks(QUARTER_BITS, max_distance // 4)
+    found = []
+    for quarter in range(64 // QUARTER_BITS):
+        keys = ((hashes >> np.uint64(quarter * QUARTER_BITS)) & np.uint64(0xFFFF)).astype(np.int64)
+        order = np.argsort(keys, kind="stable")
+        # 16-bit keys index a bucket table directly, no searching needed
+        bucket_sizes = np.bincount(keys, minlength=1 << QUARTER_BITS)
+        bucket_starts = np.cumsum(bucket_sizes) - bucket_sizes
+        for mask in masks:
+            probes = keys ^ mask
+            start = bucket_starts[probes]
+            counts = bucket_sizes[probes]
+            total = int(counts.sum())
+            if not total:
+                continue
+            queries = np.repeat(ids, counts)
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            candidates = order[np.repeat(start, counts) + offsets]
+            keep = queries < candidates  # every unordered pair once
+            queries, candidates = queries[keep], candidates[keep]
+            close = popcount(hashes[queries] ^ hashes[candidates]) <= max_distance
+            found.append(np.stack([queries[close], candidates[close]], axis=1))
+    if not found:
+        return np.zeros((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(found), axis=0)
+
+def find_duplicate_groups(image_hashes, method="phash", max_distance=DEFAULT_MAX_DISTANCE):
+    # Groups of image positions, largest group first, each sorted best copy first
+    positions = np.flatnonzero(image_hashes.valid)
+    hashes = getattr(image_hashes, method)[positions]
+    # Identical hashes collapse first, so a pile of blank images can't blow up the candidate lists
+    unique, inverse = np.unique(hashes, return_inverse=True)
+
+    parent = list(range(len(unique)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in near_pairs(unique, max_distance).tolist():
+        parent[find(a)] = find(b)
+
+    groups = {}
+    for position, hash_id in zip(positions.tolist(), inverse.ravel().tolist()):
+        groups.setdefault(find(hash_id), []).append(position)
+
+    def quality(position):
+        return (int(image_hashes.width[position] * image_hashes.height[position]), int(image_hashes.size[position]))
+
+    groups = [sorted(group, key=quality, reverse=True) for group in groups.values() if len(group) > 1]
+    return sorted(groups, key=len, reverse=True)
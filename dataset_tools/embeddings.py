@@ -0,0 +1,170 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+from provider_cache import SqliteCache
+from .cache import dataset_cache_dir
+from .tag_index import map_chunks
+
+PROJECTION_DIMS = 128
+PROJECTION_SAMPLE = 4096
+ROW_CHUNK_SIZE = 8192
+MIN_CANDIDATES = 500
+CANDIDATE_FACTOR = 20
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class EmbeddingStore(SqliteCache):
+    # Unit-length vectors in a flat float16 file (one row per image, memory-mapped for search),
+    # row numbers and invalidation data in SQLite
+    def __init__(self, path):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS embeddings (name TEXT PRIMARY KEY, row INTEGER NOT NULL UNIQUE, "
+            "mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL)",
+        )
+        self.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.vectors_path = Path(path).with_suffix(".f16")
+
+    @classmethod
+    def for_model(cls, directory, model):
+        return cls(dataset_cache_dir(directory) / f"embeddings-{model}.sqlite")
+
+    def dim(self):
+        rows = self.execute("SELECT value FROM meta WHERE key = 'dim'")
+        return rows[0][0] if rows else None
+
+    def put(self, image_path, embedding):
+        vector = normalize(np.asarray(embedding, dtype=np.float32).ravel()).astype(np.float16)
+        stat = os.stat(image_path)
+        name = os.path.basename(image_path)
+        # BEGIN IMMEDIATE takes SQLite's write lock up front, so another process tagging the same
+        # dataset can't be handed the same new row between the lookup and the insert
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute("SELECT value FROM meta WHERE key = 'dim'").fetchall()
+                if not rows:
+                    self.connection.execute("INSERT INTO meta (key, value) VALUES ('dim', ?)", (len(vector),))
+                elif rows[0][0] != len(vector):
+                    raise ValueError(f"Embedding has {len(vector)} dimensions, the store holds {rows[0][0]}")
+                rows = self.connection.execute("SELECT row FROM embeddings WHERE name = ?", (name,)).fetchall()
+                row = rows[0][0] if rows else self.connection.execute(
+                    "SELECT COALESCE(MAX(row) + 1, 0) FROM embeddings").fetchall()[0][0]
+                # The vector lands before its row is recorded, an interrupted write is just an unused row
+                with open(self.vectors_path, "r+b" if self.vectors_path.exists() else "wb") as f:
+                    f.seek(row * vector.nbytes)
+                    f.write(vector.tobytes())
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO embeddings (name, row, mtime_ns, size) VALUES (?, ?, ?, ?)",
+                    (name, row, stat.st_mtime_ns, stat.st_size))
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def load(self, directory, image_files, workers=8):
+        rows = {name: (row, mtime_ns, size) for name, row, mtime_ns, size in self.execute("SELECT * FROM embeddings")}
+
+        def lookup(chunk):
+            results = []
+            for image_file in chunk:
+                entry = rows.get(image_file)
+                if entry:
+                    try:
+                        stat = os.stat(os.path.join(directory, image_file))
+                    except FileNotFoundError:
+                        entry = None
+                    else:
+                        entry = entry if (entry[1], entry[2]) == (stat.st_mtime_ns, stat.st_size) else None
+                results.append(entry[0] if entry else -1)
+            return results
+
+        image_rows = np.array(map_chunks(lookup, image_files, workers), dtype=np.int64)
+        dim = self.dim()
+        stored = self.vectors_path.stat().st_size // (2 * dim) if dim and self.vectors_path.exists() else 0
+        if not stored:
+            return EmbeddingIndex(np.zeros((0, dim or 1), dtype=np.float16), np.full(len(image_files), -1, dtype=np.int64))
+        vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(stored, dim))
+        image_rows[image_rows >= stored] = -1
+        return EmbeddingIndex(vectors, image_rows)
+
+class EmbeddingIndex:
+    # k-NN over the images of one dataset. Candidates come from a small in-memory projection
+    # (truncated SVD of a sample), then get re-ranked exactly against the float16 vectors
+    def __init__(self, vectors, rows, dims=PROJECTION_DIMS, seed=0):
+        self.vectors = vectors
+        self.rows = rows
+        self.covered = rows >= 0
+        self.positions = np.flatnonzero(self.covered)
+        self.slots = np.full(len(rows), -1, dtype=np.int64)
+        self.slots[self.positions] = np.arange(len(self.positions))
+        self.rng = np.random.default_rng(seed)
+        self.basis = self.fit_projection(dims)
+        self.projected = self.project(self.positions)
+
+    def gather(self, positions):
+        return np.asarray(self.vectors[self.rows[positions]], dtype=np.float32)
+
+    def fit_projection(self, dims):
+        if self.vectors.shape[1] <= dims or len(self.positions) < 2:
+            return None
+        sample = self.positions
+        if len(sample) > PROJECTION_SAMPLE:
+            sample = np.sort(self.rng.choice(sample, PROJECTION_SAMPLE, replace=False))
+        # Uncentred, so dot products in the projected space approximate the cosine similarities
+        _, _, vt = np.linalg.svd(self.gather(sample), full_matrices=False)
+        return np.ascontiguousarray(vt[:dims].T)
+
+    def project(self, positions):
+        chunks = [self.gather(positions[i:i + ROW_CHUNK_SIZE]) for i in range(0, len(positions), ROW_CHUNK_SIZE)]
+        if self.basis is not None:
+            chunks = [chunk @ self.basis for chunk in chunks]
+        return np.concatenate(chunks) if chunks else np.zeros((0, self.vectors.shape[1]), dtype=np.float32)
+
+    def similar(self, position, k=20):
+        # (position, cosine similarity) of the k nearest images, the image itself left out
+        i = self.slots[position]
+        if i < 0 or k <= 0:
+            return []
+        scores = self.projected @ self.projected[i]
+        scores[i] = -np.inf
+        count = min(max(k * CANDIDATE_FACTOR, MIN_CANDIDATES), len(scores) - 1)
+        if count <= 0:
+            return []
+        candidates = np.argpartition(-scores, count - 1)[:count]
+        candidates = self.positions[candidates]
+        candidates = candidates[np.argsort(self.rows[candidates])]  # ascending rows read the memory map in order
+        exact = self.gather(candidates) @ self.gather([position])[0]
+        order = np.argsort(-exact, kind="stable")[:k]
+        return [(int(candidates[j]), float(exact[j])) for j in order]
+
+    def clusters(self, count, iterations=20):
+        # Spherical k-means in the projected space, groups of positions with the most typical image first
+        points = normalize(self.projected)
+        count = min(count, len(points))
+        if not count:
+            return []
+        centroids = points[self.rng.choice(len(points), count, replace=False)]
+        for _ in range(iterations):
+            labels = np.concatenate([(points[i:i + ROW_CHUNK_SIZE] @ centroids.T).argmax(axis=1)
+                                     for i in range(0, len(points), ROW_CHUNK_SIZE)])
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, points)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]  # an emptied cluster keeps its old centre
+            updated = normalize(sums)
+            if np.allclose(updated, centroids, atol=1e-5):
+                break
+            centroids = updated
+        closeness = np.einsum("ij,ij->i", points, centroids[labels])
+        groups = []
+        for label in range(count):
+            members = np.flatnonzero(labels == label)
+            if len(members):
+                members = members[np.argsort(-closeness[members], kind="stable")]
+                groups.append(self.positions[members].tolist())
+        return sorted(groups, key=len, reverse=True)
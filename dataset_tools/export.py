@@ -0,0 +1,274 @@
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import tarfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+from PIL import Image
+
+from .cache import dataset_cache_dir
+from .tag_index import CaptionStore, map_chunks, scan_captions
+
+MANIFEST_FILENAME = "export.json"
+PARTS_DIRNAME = "parts"
+PARQUET_FILENAME = "captions.parquet"
+DEFAULT_SHARD_SIZE = 1000
+HASH_BLOCK = 1 << 20
+FORMATS = {"jpeg": ("JPEG", "jpg"), "png": ("PNG", "png"), "webp": ("WEBP", "webp")}
+SOURCE_FORMATS = {".jpg": "jpeg", ".jpeg": "jpeg", ".png": "png", ".bmp": "png"}  # resized bmp becomes png
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class HashingWriter:
+    # Checksums a shard as it is streamed out, so it never has to be read back
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+def sample_key(image_file, taken):
+    # WebDataset splits keys at the first dot, so "a.b.png" becomes "a_b"; clashes (a.png, a.jpg) get the extension
+    stem, ext = os.path.splitext(os.path.basename(image_file))
+    key = stem.replace(".", "_")
+    if key in taken:
+        key = f"{key}_{ext.lstrip('.').lower()}"
+    taken.add(key)
+    return key
+
+def encode_image(image_path, options):
+    # Original bytes unless the export resizes or converts, returns (bytes, extension, width, height)
+    ext = os.path.splitext(image_path)[1].lower()
+    image_format = options["format"] or SOURCE_FORMATS.get(ext, "png")
+    with Image.open(image_path) as image:
+        width, height = image.size
+        # What the file actually holds, a .bmp (or a misnamed file) still needs converting to png
+        if not options["resolution"] and (not options["format"] or (image.format or "").lower() == options["format"]):
+            with open(image_path, "rb") as f:
+                return f.read(), ext.lstrip("."), width, height
+        scale = min(1.0, options["resolution"] / max(width, height)) if options["resolution"] else 1.0
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if image.format == "JPEG" and scale < 1:
+            image.draft("RGB", size)
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        if image.size != size:
+            image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        pil_format, extension = FORMATS[image_format]
+        if has_alpha and pil_format == "JPEG":
+            canvas = Image.new("RGB", image.size, (255, 255, 255))
+            canvas.paste(image, mask=image.getchannel("A"))
+            image = canvas
+        buffer = io.BytesIO()
+        image.save(buffer, pil_format, quality=options["quality"])
+        return buffer.getvalue(), extension, size[0], size[1]
+
+def write_parquet(path, rows):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("The Parquet caption table needs the pyarrow package (pip install pyarrow)") from None
+    columns = ("key", "image_file", "caption", "width", "height", "sha256", "shard")
+    pq.write_table(pa.table({name: [row[i] for row in rows] for i, name in enumerate(columns)}), path)
+
+def pack_shard(output_dir, name, items, options):
+    # Runs in a worker process. One image is in memory at a time, the tar is streamed out and
+    # checksummed as it goes; files only get their final names once complete. An image that can't be
+    # read is left out and counted rather than failing the shard
+    output_dir = Path(output_dir)
+    files = {}
+    rows = []
+    unreadable = 0
+    tar_path = output_dir / f"{name}.tar"
+    tar_file = open(f"{tar_path}.tmp", "wb") if options["tar"] else None
+    try:
+        writer = HashingWriter(tar_file) if tar_file else None
+        tar = tarfile.open(fileobj=writer, mode="w|") if writer else None
+        for key, image_file, image_path, caption, mtime in items:
+            try:
+                data, extension, width, height = encode_image(image_path, options)
+            except Exception:
+                unreadable += 1
+                continue
+            rows.append((key, image_file, caption, width, height, hashlib.sha256(data).hexdigest(), name))
+            if tar:
+                meta = json.dumps({"image_file": image_file, "width": width, "height": height}).encode("utf-8")
+                for member, payload in ((f"{key}.{extension}", data), (f"{key}.txt", caption.encode("utf-8")),
+                                        (f"{key}.json", meta)):
+                    info = tarfile.TarInfo(member)
+                    info.size = len(payload)
+                    info.mtime = mtime
+                    tar.addfile(info, io.BytesIO(payload))
+        if tar:
+            tar.close()
+            tar_file.close()
+            os.replace(f"{tar_path}.tmp", tar_path)
+            files[tar_path.name] = {"size": writer.size, "sha256": writer.digest.hexdigest()}
+    finally:
+        if tar_file and not tar_file.closed:
+            tar_file.close()
+    if options["parquet"] and rows:
+        part_path = output_dir / PARTS_DIRNAME / f"{name}.parquet"
+        write_parquet(f"{part_path}.tmp", rows)
+        os.replace(f"{part_path}.tmp", part_path)
+        files[f"{PARTS_DIRNAME}/{part_path.name}"] = {"size": part_path.stat().st_size, "sha256": file_sha256(part_path)}
+    return {"count": len(rows), "unreadable": unreadable, "files": files}
+
+def plan_export(directory, image_files, workers=8):
+    # (key, image_file, image_path, caption, mtime) for every image with a non-empty caption. image_files
+    # are the top-level names the labeler lists, so images moved into deleted/ are never among them
+    store = CaptionStore(dataset_cache_dir(directory) / "captions.sqlite")
+    try:
+        captions = scan_captions(directory, image_files, store, workers)
+    finally:
+        store.close()
+    image_files = [(f, caption) for f, caption in zip(image_files, captions) if caption]
+    stats = map_chunks(lambda chunk: [os.stat(os.path.join(directory, f)) for f, _ in chunk], image_files, workers)
+    taken = set()
+    items = [(sample_key(f, taken), f, os.path.join(directory, f), caption, int(stat.st_mtime))
+             for (f, caption), stat in zip(image_files, stats)]
+    return items, len(captions) - len(items)
+
+def shard_fingerprint(items, options):
+    # Anything that changes a shard's bytes: settings, membership, captions and source modification times
+    digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode("utf-8"))
+    for key, image_file, _, caption, mtime in items:
+        digest.update(json.dumps([key, image_file, caption, mtime]).encode("utf-8"))
+    return digest.hexdigest()
+
+def load_manifest(output_dir):
+    try:
+        with open(Path(output_dir) / MANIFEST_FILENAME, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"shards": {}}
+
+def save_manifest(output_dir, manifest):
+    path = Path(output_dir) / MANIFEST_FILENAME
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+def intact(output_dir, entry, verify):
+    for filename, expected in entry["files"].items():
+        path = Path(output_dir) / filename
+        if not path.exists() or path.stat().st_size != expected["size"]:
+            return False
+        if verify and file_sha256(path) != expected["sha256"]:
+            return False
+    return True
+
+def combine_parquet(output_dir, names):
+    import pyarrow.parquet as pq
+    path = Path(output_dir) / PARQUET_FILENAME
+    writer = None
+    try:
+        for name in names:
+            if not (Path(output_dir) / PARTS_DIRNAME / f"{name}.parquet").exists():
+                continue  # every image in the shard was unreadable
+            table = pq.read_table(Path(output_dir) / PARTS_DIRNAME / f"{name}.parquet")
+            writer = writer or pq.ParquetWriter(f"{path}.tmp", table.schema)
+            writer.write_table(table)  # one part in memory at a time
+    finally:
+        if writer:
+            writer.close()
+    if writer:
+        os.replace(f"{path}.tmp", path)
+
+def export_dataset(directory, image_files, output_dir, tar=True, parquet=False, resolution=None, image_format=None,
+                   quality=95, shard_size=DEFAULT_SHARD_SIZE, workers=None, verify=False, progress=None):
+    # Packs image/caption pairs into WebDataset tar shards and/or a Parquet caption table on a process pool.
+    # Resumable: export.json records every finished shard with its fingerprint and checksums, a rerun only
+    # packs shards that changed or whose files are missing (or fail the checksum, with verify).
+    # progress(done, total) may raise to stop early; finished shards are kept.
+    if not tar and not parquet:
+        raise ValueError("Nothing to export, choose tar shards and/or the Parquet table")
+    if image_format and image_format not in FORMATS:
+        raise ValueError(f"Unknown image format {image_format}")
+    if parquet:
+        try:
+            import pyarrow.parquet  # noqa: F401 -- fail here rather than in every worker
+        except ImportError:
+            raise RuntimeError("The Parquet caption table needs the pyarrow package (pip install pyarrow)") from None
+    output_dir = Path(output_dir)
+    (output_dir / PARTS_DIRNAME if parquet else output_dir).mkdir(parents=True, exist_ok=True)
+    options = {"tar": tar, "parquet": parquet, "resolution": resolution or None, "format": image_format or None,
+               "quality": quality}
+    items, skipped = plan_export(directory, image_files)
+    shards = {f"shard-{i // shard_size:06d}": items[i:i + shard_size] for i in range(0, len(items), shard_size)}
+
+    manifest = load_manifest(output_dir)
+    manifest.update({"directory": os.path.abspath(directory), "options": options, "shard_size": shard_size})
+    for name in set(manifest["shards"]) - set(shards):
+        # The dataset shrank since the last run, these shards would hold stale samples
+        for filename in manifest["shards"].pop(name)["files"]:
+            (output_dir / filename).unlink(missing_ok=True)
+
+    todo = []
+    for name, shard_items in shards.items():
+        fingerprint = shard_fingerprint(shard_items, options)
+        entry = manifest["shards"].get(name)
+        if entry and entry["fingerprint"] == fingerprint and intact(output_dir, entry, verify):
+            continue
+        manifest["shards"].pop(name, None)
+        todo.append((name, fingerprint, shard_items))
+    save_manifest(output_dir, manifest)
+
+    done = len(shards) - len(todo)
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        pending = {}
+        queued = iter(todo)
+        while True:
+            # Only a few shards' item lists are handed to the pool at once
+            while len(pending) < 2 * workers:
+                task = next(queued, None)
+                if task is None:
+                    break
+                name, fingerprint, shard_items = task
+                pending[pool.submit(pack_shard, str(output_dir), name, shard_items, options)] = (name, fingerprint)
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, fingerprint = pending.pop(future)
+                manifest["shards"][name] = {"fingerprint": fingerprint, **future.result()}
+                save_manifest(output_dir, manifest)
+                done += 1
+                if progress:
+                    progress(done, len(shards))
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    if parquet and (todo or not (output_dir / PARQUET_FILENAME).exists()):
+        combine_parquet(output_dir, list(shards))
+    unreadable = sum(manifest["shards"][name].get("unreadable", 0) for name in shards)
+    return {"shards": len(shards), "packed": len(todo), "samples": len(items) - unreadable,
+            "skipped": skipped + unreadable, "unreadable": unreadable, "seconds": time.perf_counter() - start}
+
+def verify_export(output_dir):
+    # Re-hashes every file the manifest lists, returns the names that are missing or don't match
+    manifest = load_manifest(output_dir)
+    bad = []
+    for entry in manifest["shards"].values():
+        for filename, expected in entry["files"].items():
+            path = Path(output_dir) / filename
+            if not path.exists() or file_sha256(path) != expected["sha256"]:
+                bad.append(filename)
+    return bad
@@ -0,0 +1,71 @@
+import os
+
+from PIL import Image
+
+from provider_cache import SqliteCache
+from .cache import dataset_cache_dir
+from .tag_index import map_chunks
+
+QUARANTINE_DIRNAME = "quarantine"
+CHECK_CHUNK_SIZE = 16  # every image is decoded, so chunks are small enough to keep all workers busy
+
+def check_image(path):
+    # Decodes the whole file, truncation only shows once the decoder runs out of data.
+    # Returns None for a usable image, otherwise why it can't be used
+    try:
+        with Image.open(path) as image:
+            if not image.width or not image.height:
+                return "Image has no pixels"
+            if image.format == "JPEG":
+                # a reduced DCT scale still reads every scan
+                image.draft("RGB", (max(1, image.width // 8), max(1, image.height // 8)))
+            image.load()
+    except Exception as e:
+        return str(e) or type(e).__name__
+    return None
+
+class IntegrityStore(SqliteCache):
+    def __init__(self, path):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS verdicts (name TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, error TEXT)",
+        )
+
+    @classmethod
+    def for_directory(cls, directory):
+        return cls(dataset_cache_dir(directory) / "integrity.sqlite")
+
+    def load(self):
+        return {row[0]: row[1:] for row in self.execute("SELECT * FROM verdicts")}
+
+    def put_many(self, rows):
+        self.executemany("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)", rows)
+
+def check_images(directory, image_files, store, workers=None, progress=None):
+    # Why each image can't be used, or None when it decodes cleanly. Verdicts are cached by name,
+    # mtime and size, so only new or changed files are decoded again
+    cached = store.load()
+
+    def check_chunk(chunk):
+        results, rows = [], []
+        for image_file in chunk:
+            path = os.path.join(directory, image_file)
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                results.append(e.strerror or str(e))
+                continue
+            entry = cached.get(image_file)
+            if entry and (entry[0], entry[1]) == (stat.st_mtime_ns, stat.st_size):
+                error = entry[2]
+            else:
+                error = check_image(path)
+                rows.append((image_file, stat.st_mtime_ns, stat.st_size, error))
+            results.append(error)
+        if rows:
+            store.put_many(rows)
+        return results
+
+    # Pillow's decoders release the GIL, so threads use every core
+    return map_chunks(check_chunk, image_files, workers or os.cpu_count() or 1, CHECK_CHUNK_SIZE, progress)
@@ -0,0 +1,187 @@
+import os
+import struct
+
+import numpy as np
+from PIL import Image
+
+from provider_cache import SqliteCache
+from .cache import dataset_cache_dir
+from .tag_index import map_chunks
+
+DEFAULT_RESOLUTION = 1024
+DEFAULT_STEP = 64
+DEFAULT_MIN_SIDE = 512
+HEADER_BYTES = 32  # enough for every fixed-position header below
+JPEG_FRAME_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}  # SOF0-15 minus DHT, JPG and DAC
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}  # TEM and RST carry no length
+
+def read_exact(f, count):
+    data = f.read(count)
+    if len(data) != count:
+        raise ValueError("Truncated image header")
+    return data
+
+def jpeg_size(f):
+    # Walks the marker segments up to the frame header, seeking past EXIF, ICC profiles and thumbnails
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        while byte and byte != b"\xff":
+            byte = f.read(1)  # stray bytes between segments, as some encoders leave
+        while byte == b"\xff":
+            byte = f.read(1)  # fill bytes
+        if not byte:
+            raise ValueError("No JPEG frame header")
+        marker = byte[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):
+            raise ValueError("No JPEG frame header before the image data")
+        length, = struct.unpack(">H", read_exact(f, 2))
+        if marker in JPEG_FRAME_MARKERS:
+            _, height, width = struct.unpack(">BHH", read_exact(f, 5))
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+def header_size(f):
+    # (width, height) as stored, the same size PIL reports; None for formats not parsed here
+    head = f.read(HEADER_BYTES)
+    if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+        return struct.unpack(">II", head[16:24])
+    if head.startswith(b"\xff\xd8"):
+        return jpeg_size(f)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        chunk = head[12:16]
+        if chunk == b"VP8 " and head[23:26] == b"\x9d\x01\x2a":
+            width, height = struct.unpack("<HH", head[26:30])
+            return width & 0x3FFF, height & 0x3FFF  # the top bits are upscaling hints
+        if chunk == b"VP8L" and head[20:21] == b"\x2f":
+            bits = int.from_bytes(head[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+    if head.startswith(b"BM"):
+        dib_size, = struct.unpack("<I", head[14:18])
+        if dib_size == 12:  # OS/2 core header
+            return struct.unpack("<HH", head[18:22])
+        width, height = struct.unpack("<ii", head[18:26])
+        return abs(width), abs(height)  # negative heights are stored top-down
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return struct.unpack("<HH", head[6:10])
+    return None
+
+def read_image_size(path):
+    try:
+        with open(path, "rb") as f:
+            size = header_size(f)
+    except struct.error:
+        raise ValueError("Truncated image header") from None
+    if size is None:
+        with Image.open(path) as image:  # PIL only reads the header on open too
+            size = image.size
+    if not size[0] or not size[1]:
+        raise ValueError("Image header has no size")
+    return size
+
+class SizeStore(SqliteCache):
+    def __init__(self, path):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS sizes (name TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "width INTEGER NOT NULL, height INTEGER NOT NULL)",
+        )
+
+    @classmethod
+    def for_directory(cls, directory):
+        return cls(dataset_cache_dir(directory) / "sizes.sqlite")
+
+    def load(self):
+        return {row[0]: row[1:] for row in self.execute("SELECT * FROM sizes")}
+
+    def put_many(self, rows):
+        self.executemany("INSERT OR REPLACE INTO sizes VALUES (?, ?, ?, ?, ?)", rows)
+
+class ImageSizes:
+    def __init__(self, image_files, rows):
+        self.image_files = image_files
+        self.valid = np.array([row is not None for row in rows], dtype=bool)
+        columns = np.array([row or (0, 0) for row in rows], dtype=np.int64).reshape(-1, 2)
+        self.width, self.height = columns[:, 0], columns[:, 1]
+
+def scan_sizes(directory, image_files, store, workers=8, progress=None):
+    # Header reads only, cached by name, mtime and size; unreadable images are left out rather than failing the scan
+    cached = store.load()
+
+    def scan_chunk(chunk):
+        results, rows = [], []
+        for image_file in chunk:
+            path = os.path.join(directory, image_file)
+            try:
+                stat = os.stat(path)
+                entry = cached.get(image_file)
+                if entry and (entry[0], entry[1]) == (stat.st_mtime_ns, stat.st_size):
+                    width, height = entry[2:]
+                else:
+                    width, height = read_image_size(path)
+                    rows.append((image_file, stat.st_mtime_ns, stat.st_size, width, height))
+            except Exception as e:
+                print(f"Could not read the size of {image_file}: {e}")
+                results.append(None)
+                continue
+            results.append((width, height))
+        if rows:
+            store.put_many(rows)
+        return results
+
+    return ImageSizes(image_files, map_chunks(scan_chunk, image_files, workers, progress=progress))
+
+def make_buckets(resolution=DEFAULT_RESOLUTION, step=DEFAULT_STEP, min_side=None, max_side=None):
+    # The kohya-ss bucket grid: every width on the step grid paired with the largest height that keeps
+    # the area within resolution², sorted by aspect ratio
+    min_side = min_side or resolution // 4
+    max_side = max_side or resolution * 2
+    buckets = set()
+    for width in range(-(-min_side // step) * step, max_side + 1, step):
+        height = min(max_side, resolution * resolution // width // step * step)
+        if height >= min_side:
+            buckets.add((width, height))
+    return np.array(sorted(buckets, key=lambda bucket: bucket[0] / bucket[1]), dtype=np.int64)
+
+def assign_buckets(widths, heights, buckets):
+    # Nearest bucket by aspect ratio, as the trainers pick it
+    ratios = buckets[:, 0] / buckets[:, 1]
+    aspect = widths / np.maximum(heights, 1)
+    upper = np.clip(np.searchsorted(ratios, aspect), 1, len(ratios) - 1)
+    lower = upper - 1
+    return np.where(aspect - ratios[lower] <= ratios[upper] - aspect, lower, upper)
+
+class BucketReport:
+    def __init__(self, image_sizes, resolution=DEFAULT_RESOLUTION, step=DEFAULT_STEP, min_side=DEFAULT_MIN_SIDE):
+        self.image_sizes = image_sizes
+        self.min_side = min_side
+        self.buckets = make_buckets(resolution, step)
+        self.positions = np.flatnonzero(image_sizes.valid)
+        widths, heights = image_sizes.width[self.positions], image_sizes.height[self.positions]
+        self.assigned = assign_buckets(widths, heights, self.buckets)
+        self.counts = np.bincount(self.assigned, minlength=len(self.buckets))
+        # Trainers scale an image to cover its bucket, anything smaller than the bucket gets upscaled
+        upscaled = (widths < self.buckets[self.assigned, 0]) | (heights < self.buckets[self.assigned, 1])
+        self.upscaled = np.bincount(self.assigned[upscaled], minlength=len(self.buckets))
+        shorter = np.minimum(widths, heights)
+        small = shorter < min_side
+        self.small = self.positions[small][np.argsort(shorter[small], kind="stable")]  # smallest first
+
+    def lines(self):
+        unreadable = len(self.image_sizes.valid) - len(self.positions)
+        lines = [f"Images: {len(self.positions)}   buckets in use: {int((self.counts > 0).sum())}/{len(self.buckets)}   "
+                 f"upscaled: {int(self.upscaled.sum())}   shorter side below {self.min_side}: {len(self.small)}"
+                 + (f"   unreadable: {unreadable}" if unreadable else ""), ""]
+        total = max(len(self.positions), 1)
+        peak = max(int(self.counts.max(initial=0)), 1)
+        lines.append("Bucket        aspect   images   share  upscaled")
+        for (width, height), count, upscaled in zip(self.buckets.tolist(), self.counts.tolist(), self.upscaled.tolist()):
+            if count:
+                bar = "#" * max(1, round(30 * count / peak))
+                lines.append(f"  {width:4d}x{height:<4d} {width / height:7.2f} {count:8d} {count / total:7.1%} "
+                             f"{upscaled:9d}  {bar}")
+        return lines
@@ -0,0 +1,167 @@
+import os
+
+import numpy as np
+
+from provider_cache import SqliteCache
+from .cache import dataset_cache_dir
+from .tag_index import map_chunks
+
+PROBABILITY_FLOOR = 0.05  # probabilities below this aren't stored, so thresholds can only be explored above it
+GENERAL_CATEGORY = 0
+
+def model_tag_name(tag):
+    # The tagger escapes parentheses in its captions, the tag table doesn't
+    return tag.replace("\\(", "(").replace("\\)", ")")
+
+class ProbabilityStore(SqliteCache):
+    # Sparse per-image tagger output, keyed by image name and invalidated when the image changes
+    def __init__(self, path):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS probabilities (name TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, tag_ids BLOB NOT NULL, probs BLOB NOT NULL)",
+        )
+        self.execute("CREATE TABLE IF NOT EXISTS tags (position INTEGER PRIMARY KEY, name TEXT NOT NULL, "
+                     "category INTEGER NOT NULL)")
+        self.has_tags = bool(self.execute("SELECT 1 FROM tags LIMIT 1"))
+
+    @classmethod
+    def for_model(cls, directory, model):
+        return cls(dataset_cache_dir(directory) / f"probabilities-{model}.sqlite")
+
+    def set_tags(self, tag_table):
+        if not self.has_tags:
+            self.executemany(
+                "INSERT OR REPLACE INTO tags (position, name, category) VALUES (?, ?, ?)",
+                [(i, tag_table.name(i), int(tag_table.categories[i])) for i in range(len(tag_table))],
+            )
+            self.has_tags = True
+
+    def tags(self):
+        rows = self.execute("SELECT name, category FROM tags ORDER BY position")
+        return [name for name, _ in rows], np.array([category for _, category in rows], dtype=np.uint8)
+
+    def put(self, image_path, probs, tag_table):
+        self.set_tags(tag_table)
+        stat = os.stat(image_path)
+        tag_ids = np.flatnonzero(probs >= PROBABILITY_FLOOR).astype(np.int32)
+        self.execute(
+            "INSERT OR REPLACE INTO probabilities (name, mtime_ns, size, tag_ids, probs) VALUES (?, ?, ?, ?, ?)",
+            (os.path.basename(image_path), stat.st_mtime_ns, stat.st_size, tag_ids.tobytes(),
+             probs[tag_ids].astype(np.float16).tobytes()),
+        )
+
+    def load(self, directory, image_files, workers=8):
+        rows = {name: (mtime_ns, size, tag_ids, probs)
+                for name, mtime_ns, size, tag_ids, probs in self.execute("SELECT * FROM probabilities")}
+
+        def lookup(chunk):
+            results = []
+            for image_file in chunk:
+                row = rows.get(image_file)
+                if row:
+                    try:
+                        stat = os.stat(os.path.join(directory, image_file))
+                    except FileNotFoundError:
+                        row = None
+                    else:
+                        row = row if (row[0], row[1]) == (stat.st_mtime_ns, stat.st_size) else None
+                results.append(row)
+            return results
+
+        found = map_chunks(lookup, image_files, workers)
+        names, categories = self.tags()
+        ids = [np.frombuffer(row[2], dtype=np.int32) if row else np.zeros(0, dtype=np.int32) for row in found]
+        values = [np.frombuffer(row[3], dtype=np.float16) if row else np.zeros(0, dtype=np.float16) for row in found]
+        indptr = np.zeros(len(found) + 1, dtype=np.int64)
+        np.cumsum([len(row_ids) for row_ids in ids], out=indptr[1:])
+        covered = np.array([row is not None for row in found], dtype=bool)
+        return SparseProbabilities(indptr, np.concatenate(ids) if ids else np.zeros(0, dtype=np.int32),
+                                   np.concatenate(values) if values else np.zeros(0, dtype=np.float16),
+                                   covered, names, categories)
+
+class SparseProbabilities:
+    # CSR image x tag matrix of cached probabilities, rows line up with the labeler's image_files
+    def __init__(self, indptr, indices, values, covered, names, categories):
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values.astype(np.float32)
+        self.covered = covered
+        self.names = names
+        self.categories = categories
+        self.positions = {name: i for i, name in enumerate(names)}
+        rows = np.repeat(np.arange(len(covered), dtype=np.int64), np.diff(indptr))
+        self.keys = rows * max(len(names), 1) + indices  # sorted, rows are stored in order and ids ascend
+
+    def lookup(self, images, tag_id):
+        # Probability of one tag for many images, anything below the floor reads as 0
+        if not len(self.keys):
+            return np.zeros(len(images), dtype=np.float32)
+        keys = images.astype(np.int64) * len(self.names) + tag_id
+        found = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[found] == keys, self.values[found], 0)
+
+    def counts_at(self, threshold):
+        return np.bincount(self.indices[self.values >= threshold], minlength=len(self.names))
+
+class DatasetStatistics:
+    # Everything is read from the tag index (and cached probabilities), nothing touches the sidecars
+    def __init__(self, index, probabilities=None):
+        self.index = index
+        self.probabilities = probabilities
+        self.tags = list(index.postings)
+        self.counts = np.fromiter((len(index.postings[tag]) for tag in self.tags), dtype=np.int64, count=len(self.tags))
+        # The postings laid end to end are the sparse image x tag matrix in coordinate form
+        self.rows = np.concatenate([index.postings[tag] for tag in self.tags]) if self.tags else np.zeros(0, dtype=np.int32)
+        self.cols = np.repeat(np.arange(len(self.tags)), self.counts)
+        self.images = len(index)
+        self.labeled = sum(1 for tags in index.doc_tags if tags)
+
+    def top_tags(self, n):
+        order = np.argsort(-self.counts, kind="stable")[:n]
+        return [(self.tags[i], int(self.counts[i])) for i in order]
+
+    def rare_tags(self, max_count, n):
+        rare = np.flatnonzero(self.counts <= max_count)
+        order = rare[np.argsort(self.counts[rare], kind="stable")][:n]
+        return [(self.tags[i], int(self.counts[i])) for i in order]
+
+    def cooccurrence(self, tags):
+        # images x tags indicator matrix, its Gram matrix holds the pairwise co-occurrence counts
+        matrix = np.zeros((self.images, len(tags)), dtype=np.float32)
+        for column, tag in enumerate(tags):
+            matrix[self.index.positions(tag), column] = 1
+        return (matrix.T @ matrix).astype(np.int64)
+
+    def related_tags(self, tag, n):
+        # One row of the full co-occurrence matrix: how often every other tag appears alongside this one
+        selected = np.zeros(self.images, dtype=bool)
+        selected[self.index.positions(tag)] = True
+        counts = np.bincount(self.cols[selected[self.rows]], minlength=len(self.tags))
+        order = [i for i in np.argsort(-counts, kind="stable")[:n + 1] if counts[i] and self.tags[i] != tag][:n]
+        return [(self.tags[i], int(counts[i])) for i in order], int(selected.sum())
+
+    def mean_confidence(self, tag):
+        # Mean model probability over the captioned images carrying this tag, None when unknown to the model
+        if self.probabilities is None:
+            return None
+        tag_id = self.probabilities.positions.get(model_tag_name(tag))
+        if tag_id is None:
+            return None
+        images = self.index.positions(tag)
+        images = images[self.probabilities.covered[images]]
+        if not len(images):
+            return None
+        return float(self.probabilities.lookup(images, tag_id).mean())
+
+    def threshold_effect(self, old, new, n):
+        # How general tag counts move if the tagger threshold changed, from cached probabilities alone
+        probabilities = self.probabilities
+        general = probabilities.categories == GENERAL_CATEGORY
+        old_counts = np.where(general, probabilities.counts_at(max(old, PROBABILITY_FLOOR)), 0)
+        new_counts = np.where(general, probabilities.counts_at(max(new, PROBABILITY_FLOOR)), 0)
+        delta = new_counts - old_counts
+        order = np.argsort(-np.abs(delta), kind="stable")[:n]
+        covered = max(int(probabilities.covered.sum()), 1)
+        changes = [(probabilities.names[i], int(old_counts[i]), int(new_counts[i])) for i in order if delta[i]]
+        return changes, old_counts.sum() / covered, new_counts.sum() / covered
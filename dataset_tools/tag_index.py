@@ -0,0 +1,250 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+import numpy as np
+
+from provider_cache import SqliteCache
+from .cache import dataset_cache_dir
+
+SCAN_CHUNK_SIZE = 1024
+REBUILD_FRACTION = 0.05  # past this share of changed images, rebuilding beats patching postings one by one
+EMPTY = np.zeros(0, dtype=np.int32)
+
+def sidecar_name(image_file):
+    return os.path.splitext(image_file)[0] + ".txt"
+
+def parse_tags(text):
+    tags = dict.fromkeys(map(str.strip, text.split(",")))
+    tags.pop("", None)
+    return list(tags)
+
+def parse_query(query):
+    # "1girl, long hair, -solo": every plain term must be present, "-" terms must be absent
+    include, exclude = [], []
+    for term in query.split(","):
+        term = term.strip()
+        if term.startswith("-") and term[1:].strip():
+            exclude.append(term[1:].strip())
+        elif term:
+            include.append(term)
+    return include, exclude
+
+def map_chunks(function, items, workers=8, chunk_size=SCAN_CHUNK_SIZE, progress=None):
+    # One task per chunk rather than per file keeps executor overhead out of 100k-file scans.
+    # progress(done, total) may raise to stop early, chunks that haven't started are dropped.
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    results = []
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for chunk_results in pool.map(function, chunks):
+            results.extend(chunk_results)
+            if progress:
+                progress(len(results), len(items))
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return results
+
+def read_sidecar(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            stat = os.fstat(f.fileno())
+            return stat.st_mtime_ns, stat.st_size, f.read().strip()
+    except FileNotFoundError:
+        return None
+
+class CaptionStore(SqliteCache):
+    def __init__(self, path):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS captions (name TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, text TEXT NOT NULL)",
+        )
+
+    def load(self):
+        return {name: (mtime_ns, size, text) for name, mtime_ns, size, text in self.execute("SELECT * FROM captions")}
+
+    def get(self, name):
+        rows = self.execute("SELECT mtime_ns, size, text FROM captions WHERE name = ?", (name,))
+        return rows[0] if rows else None
+
+    def put_many(self, rows):
+        self.executemany("INSERT OR REPLACE INTO captions (name, mtime_ns, size, text) VALUES (?, ?, ?, ?)", rows)
+
+    def discard(self, name):
+        self.execute("DELETE FROM captions WHERE name = ?", (name,))
+
+    def discard_many(self, names):
+        self.executemany("DELETE FROM captions WHERE name = ?", [(name,) for name in names])
+
+def scan_captions(directory, image_files, store, workers=8):
+    # Only sidecars whose mtime or size changed since the last scan are read again
+    cached = store.load()
+
+    def scan(chunk):
+        results = []
+        for image_file in chunk:
+            name = sidecar_name(image_file)
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                results.append(("", None))
+                continue
+            entry = cached.get(name)
+            if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                results.append((entry[2], None))
+                continue
+            sidecar = read_sidecar(path)
+            results.append((sidecar[2], (name, *sidecar)) if sidecar else ("", None))
+        return results
+
+    results = map_chunks(scan, image_files, workers)
+    changed = [row for _, row in results if row]
+    if changed:
+        store.put_many(changed)
+    return [text for text, _ in results]
+
+def build_postings(doc_tags):
+    flat = list(chain.from_iterable(doc_tags))
+    tag_ids = dict.fromkeys(flat)
+    for i, tag in enumerate(tag_ids):
+        tag_ids[tag] = i
+    ids = np.fromiter(map(tag_ids.__getitem__, flat), dtype=np.int32, count=len(flat))
+    docs = np.repeat(np.arange(len(doc_tags), dtype=np.int32), [len(tags) for tags in doc_tags])
+    # A stable sort by tag keeps every posting list in ascending image order
+    order = np.argsort(ids, kind="stable")
+    bounds = np.searchsorted(ids[order], np.arange(len(tag_ids) + 1))
+    sorted_docs = docs[order]
+    return {tag: sorted_docs[bounds[i]:bounds[i + 1]] for tag, i in tag_ids.items()}
+
+def contains(sorted_array, values):
+    if not len(sorted_array):
+        return np.zeros(len(values), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_array, values), len(sorted_array) - 1)
+    return sorted_array[positions] == values
+
+def step_match(matches, position, step):
+    if not len(matches):
+        return None
+    if step > 0:
+        return int(matches[np.searchsorted(matches, position, "right") % len(matches)])
+    return int(matches[np.searchsorted(matches, position, "left") - 1])
+
+def match_number(matches, position):
+    i = int(np.searchsorted(matches, position))
+    return i + 1 if i < len(matches) and matches[i] == position else 0
+
+class TagIndex:
+    # Maps each tag to the sorted positions (into the labeler's image_files) of the images carrying it
+    def __init__(self, directory, doc_tags, store=None):
+        self.directory = directory
+        self.doc_tags = doc_tags
+        self.store = store
+        self.postings = build_postings(doc_tags)
+
+    @classmethod
+    def open(cls, directory, image_files, workers=8, store_path=None):
+        store = CaptionStore(store_path or dataset_cache_dir(directory) / "captions.sqlite")
+        texts = scan_captions(directory, image_files, store, workers)
+        return cls(directory, [parse_tags(text) for text in texts], store)
+
+    def __len__(self):
+        return len(self.doc_tags)
+
+    def refresh(self, position, image_file):
+        # Re-reads one sidecar after it was written, a no-op when it didn't change
+        name = sidecar_name(image_file)
+        path = os.path.join(self.directory, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if self.store:
+                self.store.discard(name)
+            self.set_tags(position, [])
+            return
+        entry = self.store.get(name) if self.store else None
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            text = entry[2]
+        else:
+            sidecar = read_sidecar(path)
+            text = sidecar[2] if sidecar else ""
+            if self.store and sidecar:
+                self.store.put_many([(name, *sidecar)])
+        self.set_tags(position, parse_tags(text))
+
+    def refresh_many(self, items, workers=8):
+        # items are (position, image_file) pairs whose sidecars were rewritten, e.g. by a bulk edit
+        def read(chunk):
+            return [(position, image_file, read_sidecar(os.path.join(self.directory, sidecar_name(image_file))))
+                    for position, image_file in chunk]
+
+        results = map_chunks(read, list(items), workers)
+        if self.store:
+            self.store.put_many([(sidecar_name(image_file), *sidecar) for _, image_file, sidecar in results if sidecar])
+            self.store.discard_many([sidecar_name(image_file) for _, image_file, sidecar in results if not sidecar])
+        if len(results) > REBUILD_FRACTION * len(self.doc_tags):
+            for position, _, sidecar in results:
+                self.doc_tags[position] = parse_tags(sidecar[2]) if sidecar else []
+            self.postings = build_postings(self.doc_tags)
+        else:
+            for position, _, sidecar in results:
+                self.set_tags(position, parse_tags(sidecar[2]) if sidecar else [])
+
+    def set_tags(self, position, tags):
+        old, new = set(self.doc_tags[position]), set(tags)
+        for tag in old - new:
+            postings = self.postings[tag]
+            postings = np.delete(postings, np.searchsorted(postings, position))
+            if len(postings):
+                self.postings[tag] = postings
+            else:
+                del self.postings[tag]
+        for tag in new - old:
+            postings = self.postings.get(tag, EMPTY)
+            self.postings[tag] = np.insert(postings, np.searchsorted(postings, position), position)
+        self.doc_tags[position] = tags
+
+    def remove(self, position, image_file):
+        self.set_tags(position, [])
+        del self.doc_tags[position]
+        for postings in self.postings.values():
+            postings[np.searchsorted(postings, position):] -= 1
+        if self.store:
+            self.store.discard(sidecar_name(image_file))
+
+    def remove_many(self, items):
+        # items are (position, image_file) pairs; one rebuild instead of shifting every posting per image
+        if len(items) <= 8:
+            for position, image_file in sorted(items, reverse=True):
+                self.remove(position, image_file)
+            return
+        removed = {position for position, _ in items}
+        self.doc_tags = [tags for position, tags in enumerate(self.doc_tags) if position not in removed]
+        self.postings = build_postings(self.doc_tags)
+        if self.store:
+            self.store.discard_many([sidecar_name(image_file) for _, image_file in items])
+
+    def tags(self, position):
+        return self.doc_tags[position]
+
+    def positions(self, tag):
+        return self.postings.get(tag, EMPTY).copy()
+
+    def query(self, query):
+        include, exclude = parse_query(query)
+        if include:
+            candidates = sorted((self.postings.get(tag, EMPTY) for tag in include), key=len)
+            result = candidates[0].copy()
+            for postings in candidates[1:]:
+                result = result[contains(postings, result)]
+        else:
+            result = np.arange(len(self.doc_tags), dtype=np.int32)
+        for tag in exclude:
+            if tag in self.postings:
+                result = result[~contains(self.postings[tag], result)]
+        return result
+
+    def close(self):
+        if self.store:
+            self.store.close()
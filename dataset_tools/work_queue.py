@@ -0,0 +1,200 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+from provider_cache import SqliteCache
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')  # the labeler's open_directory filter
+DEFAULT_SHARD_SIZE = 500
+DEFAULT_LEASE_SECONDS = 120
+POLL_SECONDS = 5
+
+def list_images(directory):
+    return sorted(f for f in os.listdir(directory) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+def read_manifest(path):
+    # One image file name per line, relative to the dataset directory
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def default_worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class Lease:
+    def __init__(self, shard, token, image_files):
+        self.shard = shard
+        self.token = token
+        self.image_files = image_files
+
+class WorkQueue(SqliteCache):
+    # Shards of one dataset handed out to tagging nodes under expiring leases. It sits on the shared
+    # storage, so it uses a rollback journal: WAL needs shared memory, which doesn't work across machines
+    def __init__(self, path):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS items (position INTEGER PRIMARY KEY, image_file TEXT NOT NULL)",
+            journal_mode="DELETE",
+        )
+        self.execute("CREATE TABLE IF NOT EXISTS shards (id INTEGER PRIMARY KEY, first INTEGER NOT NULL, "
+                     "count INTEGER NOT NULL, state TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease TEXT, "
+                     "lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, started REAL, finished REAL, "
+                     "processed INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0)")
+        self.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def populate(self, directory, image_files, shard_size=DEFAULT_SHARD_SIZE, job=None):
+        # job is the JobConfig every node tags with, stored as JSON so it reaches them unchanged
+        shards = [(i, first, min(shard_size, len(image_files) - first))
+                  for i, first in enumerate(range(0, len(image_files), shard_size))]
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if self.connection.execute("SELECT 1 FROM items LIMIT 1").fetchall():
+                    raise ValueError("This queue already holds a dataset")
+                meta = [("directory", os.path.abspath(directory)), ("created", str(time.time()))]
+                if job is not None:
+                    meta.append(("job", job.to_json()))
+                self.connection.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", meta)
+                self.connection.executemany("INSERT INTO items (position, image_file) VALUES (?, ?)", enumerate(image_files))
+                self.connection.executemany("INSERT INTO shards (id, first, count) VALUES (?, ?, ?)", shards)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+        return len(shards)
+
+    def directory(self):
+        rows = self.execute("SELECT value FROM meta WHERE key = 'directory'")
+        return rows[0][0] if rows else None
+
+    def job(self):
+        from jobs import job_from_json
+        rows = self.execute("SELECT value FROM meta WHERE key = 'job'")
+        return job_from_json(rows[0][0]) if rows else None
+
+    def lease(self, worker, lease_seconds=DEFAULT_LEASE_SECONDS):
+        # A single UPDATE ... RETURNING, so two nodes can never take the same shard. Shards whose
+        # lease ran out (the node died or hung) are handed out again
+        now = time.time()
+        token = uuid.uuid4().hex
+        rows = self.execute(
+            "UPDATE shards SET state = 'leased', worker = ?, lease = ?, lease_expires = ?, attempts = attempts + 1, "
+            "started = ?, processed = 0, failed = 0 WHERE id = (SELECT id FROM shards WHERE state = 'pending' "
+            "OR (state = 'leased' AND lease_expires < ?) ORDER BY id LIMIT 1) RETURNING id, first, count",
+            (worker, token, now + lease_seconds, now, now),
+        )
+        if not rows:
+            return None
+        shard, first, count = rows[0]
+        image_files = [image_file for image_file, in self.execute(
+            "SELECT image_file FROM items WHERE position >= ? AND position < ? ORDER BY position", (first, first + count))]
+        return Lease(shard, token, image_files)
+
+    def heartbeat(self, lease, lease_seconds=DEFAULT_LEASE_SECONDS, processed=0):
+        # False once the lease expired and went to another node, the holder should stop
+        return bool(self.execute(
+            "UPDATE shards SET lease_expires = ?, processed = ? WHERE id = ? AND lease = ? AND state = 'leased' "
+            "RETURNING id", (time.time() + lease_seconds, processed, lease.shard, lease.token)))
+
+    def complete(self, lease, processed, failed):
+        return bool(self.execute(
+            "UPDATE shards SET state = 'done', finished = ?, processed = ?, failed = ?, lease_expires = NULL "
+            "WHERE id = ? AND lease = ? AND state = 'leased' RETURNING id",
+            (time.time(), processed, failed, lease.shard, lease.token)))
+
+    def release(self, lease):
+        # Hands an unfinished shard straight back instead of waiting for the lease to run out
+        self.execute("UPDATE shards SET state = 'pending', worker = NULL, lease = NULL, lease_expires = NULL "
+                     "WHERE id = ? AND lease = ? AND state = 'leased'", (lease.shard, lease.token))
+
+    def remaining(self):
+        return self.execute("SELECT COUNT(*) FROM shards WHERE state != 'done'")[0][0]
+
+    def status(self):
+        now = time.time()
+        shards = {"pending": 0, "leased": 0, "expired": 0, "done": 0}
+        for state, expired, count in self.execute(
+                "SELECT state, state = 'leased' AND lease_expires < ?, COUNT(*) FROM shards GROUP BY 1, 2", (now,)):
+            shards["expired" if expired else state] += count
+        images, done_images, processed, failed, reissued, first_start, last_finish = self.execute(
+            "SELECT COALESCE(SUM(count), 0), COALESCE(SUM(CASE WHEN state = 'done' THEN count END), 0), "
+            "COALESCE(SUM(processed), 0), COALESCE(SUM(failed), 0), COALESCE(SUM(attempts > 1), 0), "
+            "MIN(started), MAX(finished) FROM shards")[0]
+        workers = [{"worker": worker, "shards": shard_count, "processed": worker_processed,
+                    "rate": worker_processed / busy if busy else 0.0}
+                   for worker, shard_count, worker_processed, busy in self.execute(
+                       "SELECT worker, COUNT(*), SUM(processed), SUM(finished - started) FROM shards "
+                       "WHERE state = 'done' GROUP BY worker ORDER BY worker")]
+        # Wall clock from the first lease to the last completion (or now, while work remains)
+        elapsed = ((now if shards["done"] < sum(shards.values()) else last_finish) - first_start) if first_start else 0
+        return {"shards": shards, "images": images, "done_images": done_images, "processed": processed,
+                "failed": failed, "reissued": reissued, "elapsed": elapsed,
+                "throughput": processed / elapsed if elapsed else 0.0, "workers": workers}
+
+def format_status(status):
+    shards = status["shards"]
+    lines = [
+        f"shards: {shards['done']} done, {shards['leased']} leased, {shards['expired']} expired, "
+        f"{shards['pending']} pending ({status['reissued']} re-issued after a lost lease)",
+        f"images: {status['done_images']}/{status['images']} in finished shards, {status['processed']} processed, "
+        f"{status['failed']} failed",
+        f"throughput: {status['throughput']:.2f} images/s over {status['elapsed']:.0f} s",
+    ]
+    lines += [f"  {worker['worker']}: {worker['shards']} shards, {worker['processed']} images, "
+              f"{worker['rate']:.2f} images/s" for worker in status["workers"]]
+    return "\n".join(lines)
+
+def run_shard(queue, lease, process, lease_seconds, stop, log, batch_size=1):
+    processed = failed = 0
+    finished = threading.Event()
+    lost = threading.Event()
+
+    def keep_alive():
+        while not finished.wait(lease_seconds / 3):
+            if not queue.heartbeat(lease, lease_seconds, processed):
+                lost.set()
+                return
+
+    heartbeat = threading.Thread(target=keep_alive, daemon=True)
+    heartbeat.start()
+    try:
+        for start in range(0, len(lease.image_files), batch_size):
+            if stop.is_set() or lost.is_set():
+                break
+            image_files = lease.image_files[start:start + batch_size]
+            try:
+                errors = process(image_files)
+            except Exception as e:
+                errors = [e] * len(image_files)
+            for image_file, error in zip(image_files, errors):
+                if error:
+                    log(f"{image_file}: {error}")
+                    failed += 1
+                else:
+                    processed += 1
+    finally:
+        finished.set()
+        heartbeat.join()
+        if lost.is_set():
+            log(f"Lost the lease on shard {lease.shard}, another node has it now")
+        elif processed + failed < len(lease.image_files):
+            queue.release(lease)
+        else:
+            queue.complete(lease, processed, failed)
+
+def run_worker(queue, process, worker=None, lease_seconds=DEFAULT_LEASE_SECONDS, stop=None, poll_seconds=POLL_SECONDS,
+               log=print, batch_size=1):
+    # process(image_files) handles up to batch_size images and returns an error (or None) for each.
+    # Returns once every shard is done, polling while other nodes still hold leases in case one of them dies
+    worker = worker or default_worker_name()
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        lease = queue.lease(worker, lease_seconds)
+        if lease is None:
+            if not queue.remaining():
+                return
+            stop.wait(poll_seconds)
+            continue
+        log(f"{worker}: shard {lease.shard} ({len(lease.image_files)} images)")
+        run_shard(queue, lease, process, lease_seconds, stop, log, batch_size)
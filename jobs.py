@@ -0,0 +1,250 @@
+import json
+import os
+
+from providers import FAL_UPLOAD_LOOKAHEAD, PACK_MAX_ITEMS, UploadOptions, summarize_uploads
+
+CAPTION_MODES = ("Replace", "Append")
+
+def read_caption(image_path):
+    txt_path = os.path.splitext(image_path)[0] + ".txt"
+    try:
+        with open(txt_path, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+def merge_caption(current, caption, caption_mode):
+    if caption_mode == "Append" and current:
+        return f"{current}, {caption}"
+    return caption
+
+def fill_prompt(prompt, caption):
+    return prompt.replace("{caption}", f'"{caption}"')
+
+class JobConfig:
+    # Every setting a captioning job uses, taken once when the job starts so nothing changed in the
+    # window afterwards leaks into it. Plain values only: it pickles for worker processes and
+    # round-trips through JSON for the command line and work queues
+    provider = None
+    runs_locally = False  # local jobs share the tagger slot and can run on work-queue nodes
+    defaults = {}
+
+    def __init__(self, **values):
+        unknown = set(values) - set(self.defaults)
+        if unknown:
+            raise TypeError(f"Unknown {self.provider} job settings: {', '.join(sorted(unknown))}")
+        if values.get("caption_mode", "Replace") not in CAPTION_MODES:
+            raise ValueError(f"Caption mode must be one of {', '.join(CAPTION_MODES)}")
+        self.__dict__.update({**self.defaults, **values})
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only, use replace()")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is read-only, use replace()")
+
+    def replace(self, **changes):
+        return type(self)(**{**self.as_dict(), **changes})
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.defaults}
+
+    def to_json(self):
+        return json.dumps({"provider": self.provider, **self.as_dict()}, sort_keys=True)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+    def __hash__(self):
+        return hash(self.to_json())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{name}={value!r}' for name, value in self.as_dict().items())})"
+
+class LocalJob(JobConfig):
+    provider = "local"
+    runs_locally = True
+    defaults = {
+        "model": "vitv3", "general": True, "rating": True, "character": True, "general_threshold": 0.35,
+        "character_threshold": 0.85, "general_mcut": False, "character_mcut": False, "save_embeddings": False,
+        "tiling": False, "tile_grid": 2, "tile_overlap": 0.25, "tile_merge": "max", "caption_mode": "Replace",
+    }
+
+    def tiling_options(self):
+        if not self.tiling:
+            return None
+        from wd_tagger.tiling import TilingOptions
+        return TilingOptions(self.tile_grid, self.tile_overlap, self.tile_merge)
+
+    def tag_options(self):
+        return dict(model=self.model, general=self.general, rating=self.rating, character=self.character,
+                    general_threshold=self.general_threshold, character_threshold=self.character_threshold,
+                    general_mcut=self.general_mcut, character_mcut=self.character_mcut, tiling=self.tiling_options())
+
+class LocalCaptionJob(JobConfig):
+    provider = "local_caption"
+    runs_locally = True
+    defaults = {"model": "Florence_2_Base", "task": "<MORE_DETAILED_CAPTION>", "max_tokens": 256, "caption_mode": "Replace"}
+
+    def caption_options(self):
+        return dict(model=self.model, task=self.task, max_tokens=self.max_tokens)
+
+class FalJob(JobConfig):
+    provider = "fal"
+    defaults = {
+        "model": "Florence_2_Large", "prompt": "", "include_caption": True, "max_tokens": 256, "temperature": 0.2,
+        "top_p": 1.0, "repetition_penalty": 1.0, "upload_max_side": 1024, "upload_format": "JPEG",
+        "upload_quality": 90, "use_cache": True, "caption_mode": "Replace",
+    }
+
+    def upload_options(self):
+        return UploadOptions(self.upload_max_side, self.upload_format, self.upload_quality)
+
+class OpenRouterJob(JobConfig):
+    provider = "openrouter"
+    defaults = {
+        "model": "llama-3.1-8B (free)", "prompt": "", "include_caption": True, "pack": False, "max_tokens": 256,
+        "temperature": 0.7, "repetition_penalty": 1.0, "use_cache": True, "caption_mode": "Replace",
+    }
+
+    def packs(self):
+        # Packing only works when the request is about the caption text alone
+        return self.pack and self.include_caption and "{caption}" in self.prompt
+
+JOB_TYPES = {job_type.provider: job_type for job_type in (LocalJob, LocalCaptionJob, FalJob, OpenRouterJob)}
+
+def job_from_dict(data):
+    data = dict(data)
+    provider = data.pop("provider", None)
+    if provider not in JOB_TYPES:
+        raise ValueError(f"Unknown job provider {provider!r}, expected one of {', '.join(JOB_TYPES)}")
+    return JOB_TYPES[provider](**data)
+
+def job_from_json(text):
+    return job_from_dict(json.loads(text))
+
+class CaptionProvider:
+    # Runs one job over images. caption_chunk is a single scheduler call's worth of work and returns a
+    # caption per image, or the exception that image failed with
+    reads_images = True
+    chunk_size = 1
+
+    def __init__(self, job):
+        self.job = job
+
+    def prepare(self, image_paths):
+        pass
+
+    def caption(self, image_path, caption=""):
+        raise NotImplementedError
+
+    def caption_chunk(self, image_paths):
+        results = []
+        for image_path in image_paths:
+            try:
+                results.append(self.caption(image_path, read_caption(image_path) if self.job.include_caption else ""))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def summary(self):
+        return ""
+
+class LocalProvider(CaptionProvider):
+    def __init__(self, job, tagger, on_probabilities=None, on_embedding=None):
+        # The callbacks get the image path first, on_embedding is only used when the job saves embeddings
+        super().__init__(job)
+        self.tagger = tagger
+        self.on_probabilities = on_probabilities
+        self.on_embedding = on_embedding if job.save_embeddings else None
+        self.tiling_stats = tagger.predictor.tiling_stats.snapshot()
+
+    def prepare(self, image_paths):
+        self.tagger.preload(self.job.model)
+        self.chunk_size = self.tagger.predictor.tuning.batch_size  # this host's tuning for the model
+
+    def caption(self, image_path, caption=""):
+        bind = lambda callback: (lambda *args: callback(image_path, *args)) if callback else None
+        return self.tagger.tag_image(image_path, **self.job.tag_options(), on_probabilities=bind(self.on_probabilities),
+                                     on_embedding=bind(self.on_embedding))
+
+    def caption_chunk(self, image_paths):
+        return self.tagger.tag_images(image_paths, **self.job.tag_options(), on_probabilities=self.on_probabilities,
+                                      on_embedding=self.on_embedding)
+
+    def summary(self):
+        if not self.job.tiling:
+            return ""
+        from wd_tagger.tiling import summarize_tiling
+        return summarize_tiling(self.tiling_stats, self.tagger.predictor.tiling_stats.snapshot())
+
+class LocalCaptionProvider(CaptionProvider):
+    def __init__(self, job, captioner):
+        super().__init__(job)
+        self.captioner = captioner
+        self.generation_stats = captioner.generator.stats.snapshot()
+
+    def prepare(self, image_paths):
+        self.captioner.preload(self.job.model)
+        self.chunk_size = self.captioner.generator.tuning.batch_size
+
+    def caption(self, image_path, caption=""):
+        return self.captioner.caption_image(image_path, **self.job.caption_options())
+
+    def caption_chunk(self, image_paths):
+        return self.captioner.caption_images(image_paths, **self.job.caption_options())
+
+    def summary(self):
+        return self.captioner.summary(self.generation_stats)
+
+class FalProvider(CaptionProvider):
+    def __init__(self, job, client):
+        super().__init__(job)
+        self.client = client
+        self.upload_options = job.upload_options()
+        self.upcoming = []
+        self.prefetched = 0
+        self.upload_stats = client.upload_stats.snapshot()
+
+    def prepare(self, image_paths):
+        # Uploads stay a few images ahead so submits don't wait on the network
+        self.upcoming = list(image_paths)
+        self.prefetched = min(FAL_UPLOAD_LOOKAHEAD, len(self.upcoming))
+        self.client.prefetch_uploads(self.upcoming[:self.prefetched], self.upload_options)
+
+    def caption(self, image_path, caption=""):
+        prompt = fill_prompt(self.job.prompt, caption) if self.job.include_caption else self.job.prompt
+        return self.client.describe(image_path, prompt, self.job.max_tokens, self.job.temperature, self.job.top_p,
+                                    self.job.model, self.job.repetition_penalty, self.upload_options, self.job.use_cache)
+
+    def caption_chunk(self, image_paths):
+        ahead = self.upcoming[self.prefetched:self.prefetched + len(image_paths)]
+        if ahead:
+            self.client.prefetch_uploads(ahead, self.upload_options)
+            self.prefetched += len(ahead)
+        return super().caption_chunk(image_paths)
+
+    def summary(self):
+        return summarize_uploads(self.upload_stats, self.client.upload_stats.snapshot())
+
+class OpenRouterProvider(CaptionProvider):
+    reads_images = False  # only the prompt and caption text are sent
+
+    def __init__(self, job, client):
+        super().__init__(job)
+        self.client = client
+        if job.packs():
+            self.chunk_size = PACK_MAX_ITEMS
+
+    def caption(self, image_path, caption=""):
+        prompt = fill_prompt(self.job.prompt, caption) if self.job.include_caption else self.job.prompt
+        return self.client.describe(prompt, self.job.model, self.job.max_tokens, self.job.temperature,
+                                    self.job.repetition_penalty, self.job.use_cache)
+
+    def caption_chunk(self, image_paths):
+        if not self.job.packs():
+            return super().caption_chunk(image_paths)
+        # Rephrasing only needs the caption text, so the whole chunk shares one request
+        captions = [read_caption(image_path) for image_path in image_paths]
+        return self.client.describe_many(self.job.prompt, captions, self.job.model, self.job.max_tokens,
+                                         self.job.temperature, self.job.repetition_penalty, self.job.use_cache)
@@ -1,14 +1,24 @@
 import os
 import sys
-import requests
-from wd_tagger.tagger import ImageTagger
-import fal_client
+import threading
+import time
+from providers import ProviderClients
+from jobs import (LocalJob, LocalCaptionJob, FalJob, OpenRouterJob, LocalProvider, LocalCaptionProvider, FalProvider,
+                  OpenRouterProvider, fill_prompt, merge_caption)
+from scheduler import INTERACTIVE, BATCH, PriorityScheduler, format_wait_stats
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QTextEdit, QLabel, QFileDialog, 
                              QSplitter, QLineEdit, QStyle, QStyleFactory, QScrollArea, QDialog, QCheckBox, QFormLayout, QMessageBox,
-                             QFrame, QComboBox, QStackedWidget, QSpinBox, QSlider, QProgressBar)
-from PyQt5.QtGui import QPixmap, QPalette, QColor, QResizeEvent
+                             QFrame, QComboBox, QStackedWidget, QSpinBox, QSlider, QProgressBar, QTreeWidget,
+                             QTreeWidgetItem)
+from PyQt5.QtGui import QPixmap, QPalette, QColor, QResizeEvent, QTextCursor
 from PyQt5.QtCore import Qt, QSettings, QThread, pyqtSignal
 
+LOCAL_MODELS = {"vit3": "vitv3", "vit3-Large": "vitv3-large", "swinv3": "swinv3", "convnextv3": "convnextv3"}
+LOCAL_CAPTION_MODELS = {"Florence-2 base": "Florence_2_Base", "Florence-2 large": "Florence_2_Large"}
+LOCAL_CAPTION_TASKS = {"Caption": "<CAPTION>", "Detailed caption": "<DETAILED_CAPTION>",
+                       "More detailed caption": "<MORE_DETAILED_CAPTION>"}
+PROVIDER_WORKERS = 4  # remote calls are network-bound, a few may be in flight at once
+
 class ScalableImageLabel(QLabel):
     def __init__(self):
         super().__init__()
@@ -52,6 +62,35 @@ class SettingsDialog(QDialog):
         self.openrouter_api_key_input.setEchoMode(QLineEdit.Password)
         layout.addRow("OpenRouter API Key:", self.openrouter_api_key_input)
 
+        self.upload_max_side_input = QSpinBox()
+        self.upload_max_side_input.setRange(0, 8192)
+        self.upload_max_side_input.setSpecialValueText("Original size")
+        self.upload_max_side_input.setValue(self.settings.value("upload_max_side", 1024, type=int))
+        layout.addRow("Fal upload max side:", self.upload_max_side_input)
+
+        self.upload_format_dropdown = QComboBox()
+        self.upload_format_dropdown.addItems(["JPEG", "WEBP", "Original"])
+        self.upload_format_dropdown.setCurrentText(self.settings.value("upload_format", "JPEG"))
+        self.upload_format_dropdown.setToolTip("Re-encode images before uploading to fal (Original uploads the file as is)")
+        layout.addRow("Fal upload format:", self.upload_format_dropdown)
+
+        self.upload_quality_input = QSpinBox()
+        self.upload_quality_input.setRange(1, 100)
+        self.upload_quality_input.setValue(self.settings.value("upload_quality", 90, type=int))
+        layout.addRow("Fal upload quality:", self.upload_quality_input)
+
+        self.bypass_cache_checkbox = QCheckBox()
+        self.bypass_cache_checkbox.setChecked(self.settings.value("bypass_response_cache", False, type=bool))
+        self.bypass_cache_checkbox.setToolTip("Always call the API and overwrite cached Fal/OpenRouter responses")
+        layout.addRow("Bypass response cache:", self.bypass_cache_checkbox)
+
+        self.tagging_server_input = QLineEdit()
+        self.tagging_server_input.setText(self.settings.value("tagging_server", ""))
+        self.tagging_server_input.setPlaceholderText("Run wd models in this window")
+        self.tagging_server_input.setToolTip("Address of a `python -m wd_tagger serve` process, e.g. 127.0.0.1:8765 "
+                                             "or unix:/tmp/wd_tagger.sock, shared by every labeler on the machine")
+        layout.addRow("Tagging server:", self.tagging_server_input)
+
         self.theme_dropdown = QComboBox()
         self.theme_dropdown.addItems(["Dark", "Light", "Lime"])
         self.theme_dropdown.setCurrentText(self.settings.value("theme", "Dark"))
@@ -65,7 +104,12 @@ class SettingsDialog(QDialog):
         self.settings.setValue("autosave", self.autosave_checkbox.isChecked())
         self.settings.setValue("fal_api_key", self.fal_api_key_input.text())
         self.settings.setValue("openrouter_api_key", self.openrouter_api_key_input.text())
+        self.settings.setValue("upload_max_side", self.upload_max_side_input.value())
+        self.settings.setValue("upload_format", self.upload_format_dropdown.currentText())
+        self.settings.setValue("upload_quality", self.upload_quality_input.value())
+        self.settings.setValue("bypass_response_cache", self.bypass_cache_checkbox.isChecked())
         self.settings.setValue("theme", self.theme_dropdown.currentText())
+        self.settings.setValue("tagging_server", self.tagging_server_input.text().strip())
         self.accept()
 
 class BatchProcessingDialog(QDialog):
@@ -73,7 +117,8 @@ class BatchProcessingDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("Batch Processing")
         self.setGeometry(100, 100, 500, 200)
-        self.setModal(True)
+        # Not modal, so Generate in the main window keeps working and jumps ahead of queued batch items
+        self.setModal(False)
         self.layout = QVBoxLayout(self)
         
         # Provider label
@@ -91,13 +136,10 @@ class BatchProcessingDialog(QDialog):
 
         # Caption range
         self.caption_range_min = QSpinBox()
-        self.caption_range_min.setRange(1, len(self.parent().image_files))
         self.caption_range_min.valueChanged.connect(self.update_button_text)
         self.to_label = QLabel("to")
         self.to_label.setFixedWidth(10)
         self.caption_range_max = QSpinBox()
-        self.caption_range_max.setRange(1, len(self.parent().image_files))
-        self.caption_range_max.setValue(len(self.parent().image_files))
         self.caption_range_max.valueChanged.connect(self.update_button_text)
         line_layout = QHBoxLayout()
         line_layout.setSpacing(5)
@@ -114,15 +156,36 @@ class BatchProcessingDialog(QDialog):
         self.action_button = QPushButton("Caption All Images")
         self.action_button.clicked.connect(self.toggle_processing)
 
+        # Hand the same range to `python -m wd_tagger queue work` on several machines instead
+        self.queue_button = QPushButton("Create Work Queue...")
+        self.queue_button.setToolTip("Split the range into shards that tagging nodes on the shared storage lease")
+        self.queue_button.clicked.connect(self.create_work_queue)
+
         self.layout.addStretch(1) 
         self.layout.addWidget(self.progress_label)
         self.layout.addWidget(self.action_button)
+        self.layout.addWidget(self.queue_button)
         self.layout.addWidget(self.progress_bar)
 
         self.worker = None
         self.is_processing = False
+        self.refresh()
+
+    def refresh(self):
+        # The dialog is kept between openings, pick up the provider and directory of the main window
+        image_count = len(self.parent().image_files)
+        self.provider_label.setText(f"Provider: {self.parent().provider_dropdown.currentText()}")
+        self.caption_range_min.setRange(1, image_count)
+        self.caption_range_max.setRange(1, image_count)
+        self.caption_range_min.setValue(1)
+        self.caption_range_max.setValue(image_count)
         self.update_button_text()
 
+    def closeEvent(self, event):
+        if self.is_processing:
+            self.stop_processing()
+        super().closeEvent(event)
+
     def update_button_text(self):
         min_image = self.caption_range_min.value()
         max_image = self.caption_range_max.value()
@@ -149,14 +212,43 @@ class BatchProcessingDialog(QDialog):
             self.start_processing()
 
     def start_processing(self):
+        main_app = self.parent()
+        # Everything the job needs is read from the window here, once; the worker never touches a widget
+        job = main_app.batch_job()
         self.is_processing = True
         self.update_button_text()
-        self.worker = BatchProcessingWorker(self.parent(), self.skip_captioned.isChecked(), int(self.caption_range_min.value()), int(self.caption_range_max.value()))
+        self.worker = BatchProcessingWorker(main_app, job, main_app.caption_provider(job), self.skip_captioned.isChecked(),
+                                            int(self.caption_range_min.value()), int(self.caption_range_max.value()))
         self.worker.progress_updated.connect(self.update_progress)
-        self.worker.caption_generated.connect(self.parent().update_caption)
+        self.worker.check_progress.connect(
+            lambda done, total: self.progress_label.setText(f"Checked {done} out of {total} images for damage"))
+        self.worker.caption_generated.connect(
+            lambda image_path, result: main_app.update_caption(image_path, result, job.caption_mode))
         self.worker.finished.connect(self.on_finished)
         self.worker.start()
 
+    def create_work_queue(self):
+        from dataset_tools.work_queue import WorkQueue
+        path, _ = QFileDialog.getSaveFileName(self, "Create Work Queue",
+                                              os.path.join(self.parent().current_directory, "work_queue.sqlite"),
+                                              "Work queue (*.sqlite)")
+        if not path:
+            return
+        min_image, max_image = sorted((self.caption_range_min.value(), self.caption_range_max.value()))
+        image_files = self.parent().image_files[min_image - 1:max_image]
+        # Nodes tag with the Local settings as they are now, unless their command line overrides them
+        job = self.parent().local_job() if "Local" in self.parent().provider_panels else None
+        queue = WorkQueue(path)
+        try:
+            shards = queue.populate(self.parent().current_directory, image_files, job=job)
+        except ValueError as e:
+            QMessageBox.warning(self, "Work Queue", str(e))
+            return
+        finally:
+            queue.close()
+        self.progress_label.setText(f"Queued {len(image_files)} images in {shards} shards, "
+                                    f"run `python -m wd_tagger queue work {path}` on each node")
+
     def handle_error(self, error_message):
         # Display the error message to the user
         QMessageBox.critical(self, "Error", f"An error occurred: {error_message}")
@@ -173,99 +265,1310 @@ class BatchProcessingDialog(QDialog):
         self.progress_label.setText(f"Processed {value} out of {total} images")
 
     def on_finished(self):
+        if not self.is_processing:
+            return  # stop_processing already reported
         self.is_processing = False
         self.update_button_text()
-        self.progress_label.setText("Batch processing completed")
+        if self.worker and self.worker.summary:
+            self.progress_label.setText(f"Batch processing completed\n{self.worker.summary}")
+        else:
+            self.progress_label.setText("Batch processing completed")
+
+class BulkEditDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Bulk Tag Edit")
+        self.setGeometry(100, 100, 700, 500)
+        self.setModal(True)
+        self.layout = QVBoxLayout(self)
+
+        form_layout = QFormLayout()
+        self.operation_dropdown = QComboBox()
+        self.operation_dropdown.addItems(["Rename tag", "Remove tag", "Add trigger word", "Dedupe tags", "Sort by tagger confidence"])
+        self.operation_dropdown.currentTextChanged.connect(self.update_fields)
+        form_layout.addRow("Operation:", self.operation_dropdown)
+        self.tag_label = QLabel("Tag:")
+        self.tag_input = QLineEdit()
+        self.tag_input.textChanged.connect(self.invalidate_plan)
+        form_layout.addRow(self.tag_label, self.tag_input)
+        self.replacement_label = QLabel("New tag:")
+        self.replacement_input = QLineEdit()
+        self.replacement_input.textChanged.connect(self.invalidate_plan)
+        form_layout.addRow(self.replacement_label, self.replacement_input)
+        self.model_label = QLabel("Model:")
+        self.model_dropdown = QComboBox()
+        self.model_dropdown.addItems(list(LOCAL_MODELS))
+        self.model_dropdown.currentTextChanged.connect(self.invalidate_plan)
+        form_layout.addRow(self.model_label, self.model_dropdown)
+        self.layout.addLayout(form_layout)
+
+        matches = self.parent().tag_filter_matches
+        self.filter_checkbox = QCheckBox("Only images matching the current filter" + (f" ({len(matches)})" if matches is not None else ""))
+        self.filter_checkbox.setEnabled(matches is not None)
+        self.filter_checkbox.setChecked(matches is not None)
+        self.filter_checkbox.stateChanged.connect(self.invalidate_plan)
+        self.layout.addWidget(self.filter_checkbox)
+
+        self.preview_text = QTextEdit()
+        self.preview_text.setReadOnly(True)
+        self.preview_text.setPlaceholderText("Preview shows what would change before anything is written")
+        self.layout.addWidget(self.preview_text)
+
+        self.status_label = QLabel("")
+        self.layout.addWidget(self.status_label)
+
+        button_layout = QHBoxLayout()
+        self.preview_button = QPushButton("Preview")
+        self.preview_button.clicked.connect(self.preview)
+        self.apply_button = QPushButton("Apply")
+        self.apply_button.clicked.connect(self.apply)
+        self.undo_button = QPushButton("Undo Last Bulk Edit")
+        self.undo_button.clicked.connect(self.undo)
+        button_layout.addWidget(self.preview_button)
+        button_layout.addWidget(self.apply_button)
+        button_layout.addStretch(1)
+        button_layout.addWidget(self.undo_button)
+        self.layout.addLayout(button_layout)
+
+        self.plan = None
+        self.worker = None
+        self.update_fields()
+
+    def update_fields(self):
+        operation = self.operation_dropdown.currentText()
+        self.tag_label.setText("Trigger word:" if operation == "Add trigger word" else "Tag:")
+        for widget in (self.tag_label, self.tag_input):
+            widget.setVisible(operation in ("Rename tag", "Remove tag", "Add trigger word"))
+        for widget in (self.replacement_label, self.replacement_input):
+            widget.setVisible(operation == "Rename tag")
+        for widget in (self.model_label, self.model_dropdown):
+            widget.setVisible(operation == "Sort by tagger confidence")
+        self.invalidate_plan()
+
+    def invalidate_plan(self):
+        self.plan = None
+        self.apply_button.setEnabled(False)
+
+    def build_operation(self):
+        from dataset_tools import bulk
+        operation = self.operation_dropdown.currentText()
+        if operation == "Rename tag":
+            return bulk.RenameTag(self.tag_input.text(), self.replacement_input.text())
+        if operation == "Remove tag":
+            return bulk.RemoveTag(self.tag_input.text())
+        if operation == "Add trigger word":
+            return bulk.AddTriggerWord(self.tag_input.text())
+        if operation == "Dedupe tags":
+            return bulk.DedupeTags()
+        return bulk.SortByConfidence(self.parent().local_tagger(), LOCAL_MODELS[self.model_dropdown.currentText()])
+
+    def run_task(self, status, task, on_done):
+        self.set_busy(True)
+        self.status_label.setText(status)
+        self.worker = TaskWorker(task)
+        self.worker.done.connect(on_done)
+        self.worker.failed.connect(self.on_failed)
+        self.worker.start()
+
+    def set_busy(self, busy):
+        self.preview_button.setEnabled(not busy)
+        self.undo_button.setEnabled(not busy)
+        self.apply_button.setEnabled(not busy and bool(self.plan and self.plan.changes))
+
+    def preview(self):
+        from dataset_tools.bulk import plan_bulk_edit
+        main_app = self.parent()
+        if main_app.tag_index is None:
+            QMessageBox.warning(self, "Indexing", "Captions are still being indexed, try again in a moment.")
+            return
+        if main_app.should_autosave():
+            main_app.save_description()
+        self.invalidate_plan()
+        operation = self.build_operation()
+        positions = main_app.tag_filter_matches if self.filter_checkbox.isChecked() else None
+        directory, image_files, index = main_app.current_directory, list(main_app.image_files), main_app.tag_index
+        self.run_task("Planning...", lambda: plan_bulk_edit(directory, image_files, index, operation, positions),
+                      self.on_planned)
+
+    def on_planned(self, plan):
+        self.plan = plan
+        self.preview_text.setPlainText(plan.preview())
+        self.status_label.setText(plan.summary())
+        self.set_busy(False)
+
+    def apply(self):
+        from dataset_tools.bulk import commit_bulk_edit
+        main_app = self.parent()
+        if main_app.should_autosave():
+            main_app.save_description()
+        directory, index, plan = main_app.current_directory, main_app.tag_index, self.plan
+
+        def task():
+            journal = commit_bulk_edit(directory, plan)
+            index.refresh_many([(position, image_file) for position, image_file, _, _ in plan.changes])
+            skipped = len(journal["skipped"])
+            return f"Applied: {plan.summary()}" + (f", {skipped} edited since the preview and kept" if skipped else "")
+
+        self.run_task(f"Writing {len(plan.changes)} captions...", task, self.on_written)
+
+    def undo(self):
+        from dataset_tools.bulk import undo_last_bulk_edit
+        main_app = self.parent()
+        if main_app.should_autosave():
+            main_app.save_description()
+        directory, index = main_app.current_directory, main_app.tag_index
+        positions = {image_file: i for i, image_file in enumerate(main_app.image_files)}
+
+        def task():
+            journal, reverted = undo_last_bulk_edit(directory)
+            if journal is None:
+                return "Nothing to undo"
+            if index is not None:
+                index.refresh_many([(positions[entry["image"]], entry["image"])
+                                    for entry in reverted if entry["image"] in positions])
+            skipped = len(journal["changes"]) - len(reverted)
+            return f"Undid {journal['description']}: {len(reverted)} captions restored, {skipped} edited since and kept"
+
+        self.run_task("Undoing...", task, self.on_written)
+
+    def on_written(self, message):
+        self.invalidate_plan()
+        self.preview_text.clear()
+        self.status_label.setText(message)
+        self.set_busy(False)
+        self.parent().on_bulk_edit_written()
+
+    def on_failed(self, error):
+        self.status_label.setText(f"Failed: {error}")
+        self.set_busy(False)
+
+    def reject(self):
+        if self.worker and self.worker.isRunning():
+            return  # never walk away from a half written bulk edit
+        super().reject()
+
+class StatisticsDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Dataset Statistics")
+        self.setGeometry(100, 100, 800, 700)
+        self.layout = QVBoxLayout(self)
+
+        options_layout = QHBoxLayout()
+        self.top_input = QSpinBox()
+        self.top_input.setRange(1, 1000)
+        self.top_input.setValue(50)
+        self.rare_input = QSpinBox()
+        self.rare_input.setRange(1, 1000)
+        self.rare_input.setValue(2)
+        self.related_input = QLineEdit()
+        self.related_input.setPlaceholderText("Co-occurring with tag...")
+        options_layout.addWidget(QLabel("Top:"))
+        options_layout.addWidget(self.top_input)
+        options_layout.addWidget(QLabel("Rare at most:"))
+        options_layout.addWidget(self.rare_input)
+        options_layout.addWidget(self.related_input)
+        self.layout.addLayout(options_layout)
+
+        confidence_layout = QHBoxLayout()
+        self.model_dropdown = QComboBox()
+        self.model_dropdown.addItems(list(LOCAL_MODELS))
+        self.model_dropdown.currentTextChanged.connect(self.load_probabilities)
+        self.threshold_input = QSpinBox()
+        self.threshold_input.setRange(5, 100)
+        if "Local" in self.parent().provider_panels:
+            self.threshold_input.setValue(self.parent().general_threshold_slider.value())
+        else:
+            self.threshold_input.setValue(35)
+        self.new_threshold_input = QSpinBox()
+        self.new_threshold_input.setRange(5, 100)
+        self.new_threshold_input.setValue(50)
+        self.scan_button = QPushButton("Scan Probabilities")
+        self.scan_button.setToolTip("Run the tagger over images without cached probabilities")
+        self.scan_button.clicked.connect(self.toggle_scan)
+        confidence_layout.addWidget(QLabel("Model:"))
+        confidence_layout.addWidget(self.model_dropdown)
+        confidence_layout.addWidget(QLabel("Threshold %:"))
+        confidence_layout.addWidget(self.threshold_input)
+        confidence_layout.addWidget(QLabel("to"))
+        confidence_layout.addWidget(self.new_threshold_input)
+        confidence_layout.addWidget(self.scan_button)
+        self.layout.addLayout(confidence_layout)
+
+        for widget in (self.top_input, self.rare_input, self.threshold_input, self.new_threshold_input):
+            widget.valueChanged.connect(self.refresh)
+        self.related_input.returnPressed.connect(self.refresh)
+
+        self.report = QTextEdit()
+        self.report.setReadOnly(True)
+        self.report.setLineWrapMode(QTextEdit.NoWrap)
+        self.report.setStyleSheet("font-family: monospace;")
+        self.layout.addWidget(self.report)
+        self.status_label = QLabel("")
+        self.layout.addWidget(self.status_label)
+
+        self.probabilities = None
+        self.loader = None
+        self.scan_worker = None
+        self.load_probabilities()
+
+    def selected_model(self):
+        return LOCAL_MODELS[self.model_dropdown.currentText()]
+
+    def load_probabilities(self):
+        main_app = self.parent()
+        store = main_app.probability_store(self.selected_model())
+        directory, image_files = main_app.current_directory, list(main_app.image_files)
+        self.probabilities = None
+        self.status_label.setText("Loading cached probabilities...")
+        self.loader = TaskWorker(lambda: store.load(directory, image_files))
+        self.loader.done.connect(lambda probabilities, loader=self.loader: self.on_probabilities_loaded(loader, probabilities))
+        self.loader.failed.connect(lambda error: self.status_label.setText(f"Loading probabilities failed ({error})"))
+        self.loader.start()
+
+    def on_probabilities_loaded(self, loader, probabilities):
+        if loader is self.loader and len(probabilities.covered) == len(self.parent().image_files):
+            self.probabilities = probabilities
+            covered = int(probabilities.covered.sum())
+            self.status_label.setText(f"{covered}/{len(probabilities.covered)} images have cached {self.selected_model()} probabilities")
+            self.refresh()
+
+    def refresh(self):
+        from dataset_tools.stats import DatasetStatistics
+        index = self.parent().tag_index
+        if index is None:
+            self.report.setPlainText("Captions are still being indexed...")
+            return
+        probabilities = self.probabilities if self.probabilities is not None and len(self.probabilities.covered) == len(index) else None
+        statistics = DatasetStatistics(index, probabilities)
+
+        lines = [f"Images: {statistics.images}   labeled: {statistics.labeled}   distinct tags: {len(statistics.tags)}", ""]
+        labeled = max(statistics.labeled, 1)
+
+        def confidence(tag):
+            value = statistics.mean_confidence(tag)
+            return "" if value is None else f"{value:6.2f}"
+
+        top = statistics.top_tags(self.top_input.value())
+        lines.append(f"Top {len(top)} tags (images, share of labeled, mean {self.selected_model()} confidence):")
+        lines += [f"  {tag[:40]:40s} {count:8d} {count / labeled:7.1%} {confidence(tag)}" for tag, count in top]
+
+        rare = statistics.rare_tags(self.rare_input.value(), self.top_input.value())
+        rare_total = int((statistics.counts <= self.rare_input.value()).sum())
+        lines += ["", f"Rare tags (on at most {self.rare_input.value()} images): {rare_total}"]
+        lines += [f"  {tag[:40]:40s} {count:8d}" for tag, count in rare]
+
+        matrix_tags = [tag for tag, _ in top[:10]]
+        if matrix_tags:
+            matrix = statistics.cooccurrence(matrix_tags)
+            lines += ["", "Co-occurrence of the top tags:", " " * 16 + "".join(f"{i:>8d}" for i in range(len(matrix_tags)))]
+            lines += [f"{i:2d} {tag[:12]:12s} " + "".join(f"{value:8d}" for value in row)
+                      for i, (tag, row) in enumerate(zip(matrix_tags, matrix))]
+
+        related = self.related_input.text().strip()
+        if related:
+            tags, count = statistics.related_tags(related, self.top_input.value())
+            lines += ["", f'Tags appearing with "{related}" ({count} images):']
+            lines += [f"  {tag[:40]:40s} {shared:8d} {shared / max(count, 1):7.1%}" for tag, shared in tags]
+
+        if probabilities is not None and probabilities.covered.any():
+            old, new = self.threshold_input.value() / 100, self.new_threshold_input.value() / 100
+            changes, old_average, new_average = statistics.threshold_effect(old, new, self.top_input.value())
+            lines += ["", f"General threshold {old:.2f} -> {new:.2f} over {int(probabilities.covered.sum())} images "
+                          f"with cached probabilities: {old_average:.1f} -> {new_average:.1f} tags per image"]
+            lines += [f"  {tag[:40]:40s} {before:8d} -> {after:8d}" for tag, before, after in changes]
+
+        self.report.setPlainText("\n".join(lines))
+
+    def toggle_scan(self):
+        if self.scan_worker is not None and self.scan_worker.isRunning():
+            self.scan_worker.requestInterruption()
+            return
+        if self.probabilities is None:
+            return
+        main_app = self.parent()
+        model = self.selected_model()
+        image_files = [main_app.image_files[i] for i in range(len(self.probabilities.covered)) if not self.probabilities.covered[i]]
+        self.scan_worker = ProbabilityScanWorker(main_app, model, image_files)
+        self.scan_worker.progress_updated.connect(
+            lambda done, total: self.status_label.setText(f"Scanned {done}/{total} images"))
+        self.scan_worker.finished.connect(self.on_scan_finished)
+        self.scan_button.setText("Stop Scan")
+        self.scan_worker.start()
+
+    def on_scan_finished(self):
+        self.scan_button.setText("Scan Probabilities")
+        failed = self.scan_worker.failed_images
+        self.load_probabilities()
+        if failed:
+            self.status_label.setText(f"{failed} images could not be tagged")
+
+    def closeEvent(self, event):
+        if self.scan_worker is not None and self.scan_worker.isRunning():
+            self.scan_worker.requestInterruption()
+            self.scan_worker.wait()
+        super().closeEvent(event)
+
+class DuplicatesDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Find Duplicates")
+        self.setGeometry(100, 100, 1000, 650)
+        self.layout = QVBoxLayout(self)
+
+        options_layout = QHBoxLayout()
+        self.method_dropdown = QComboBox()
+        self.method_dropdown.addItems(["pHash", "dHash"])
+        self.method_dropdown.setToolTip("pHash tolerates re-encoding and resizing best, dHash is stricter about edits")
+        self.distance_input = QSpinBox()
+        self.distance_input.setRange(0, 16)
+        self.distance_input.setValue(8)
+        self.distance_input.setToolTip("Maximum differing bits out of 64, 0 only finds exact visual copies")
+        self.find_button = QPushButton("Find Duplicates")
+        self.find_button.clicked.connect(self.toggle_scan)
+        options_layout.addWidget(QLabel("Hash:"))
+        options_layout.addWidget(self.method_dropdown)
+        options_layout.addWidget(QLabel("Max distance:"))
+        options_layout.addWidget(self.distance_input)
+        options_layout.addWidget(self.find_button)
+        self.layout.addLayout(options_layout)
+
+        self.progress_bar = QProgressBar()
+        self.layout.addWidget(self.progress_bar)
+        self.status_label = QLabel("Hashes are cached, so rescanning with other settings is quick")
+        self.layout.addWidget(self.status_label)
+
+        splitter = QSplitter(Qt.Horizontal)
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(["Image", "Resolution", "Size"])
+        self.tree.setColumnWidth(0, 300)
+        self.tree.currentItemChanged.connect(self.show_preview)
+        self.preview = ScalableImageLabel()
+        self.preview.setMinimumWidth(300)
+        splitter.addWidget(self.tree)
+        splitter.addWidget(self.preview)
+        self.layout.addWidget(splitter, 1)
+
+        self.move_button = QPushButton("Move Checked to deleted/")
+        self.move_button.setToolTip("The largest copy in each group is left unchecked")
+        self.move_button.clicked.connect(self.move_checked)
+        self.layout.addWidget(self.move_button)
+
+        self.scan_worker = None
+
+    def toggle_scan(self):
+        if self.scan_worker is not None and self.scan_worker.isRunning():
+            self.scan_worker.requestInterruption()
+            return
+        main_app = self.parent()
+        method = self.method_dropdown.currentText().lower()
+        self.tree.clear()
+        self.scan_worker = DuplicateScanWorker(main_app.current_directory, list(main_app.image_files),
+                                               method, self.distance_input.value())
+        self.scan_worker.progress_updated.connect(self.on_progress)
+        self.scan_worker.done.connect(self.on_found)
+        self.scan_worker.failed.connect(lambda error: self.status_label.setText(f"Duplicate scan failed ({error})"))
+        self.scan_worker.finished.connect(lambda: self.find_button.setText("Find Duplicates"))
+        self.find_button.setText("Stop")
+        self.status_label.setText("Hashing images...")
+        self.scan_worker.start()
+
+    def on_progress(self, done, total):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.status_label.setText(f"Hashed {done}/{total} images")
+
+    def on_found(self, result):
+        image_hashes, groups = result
+        self.tree.clear()
+        for number, group in enumerate(groups, 1):
+            group_item = QTreeWidgetItem([f"Group {number} ({len(group)} images)"])
+            for rank, position in enumerate(group):
+                image_file = image_hashes.image_files[position]
+                item = QTreeWidgetItem([image_file, f"{image_hashes.width[position]}x{image_hashes.height[position]}",
+                                        f"{image_hashes.size[position] / 1024:.0f} KB"])
+                item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+                item.setCheckState(0, Qt.Unchecked if rank == 0 else Qt.Checked)
+                item.setData(0, Qt.UserRole, image_file)
+                group_item.addChild(item)
+            self.tree.addTopLevelItem(group_item)
+            group_item.setExpanded(True)
+        duplicates = sum(len(group) - 1 for group in groups)
+        unreadable = int((~image_hashes.valid).sum())
+        status = f"{len(groups)} groups, {duplicates} images checked for removal"
+        if unreadable:
+            status += f", {unreadable} images could not be read"
+        self.status_label.setText(status)
+
+    def show_preview(self, item, previous=None):
+        image_file = item.data(0, Qt.UserRole) if item is not None else None
+        if image_file:
+            self.preview.setPixmap(QPixmap(os.path.join(self.parent().current_directory, image_file)))
+
+    def checked_items(self):
+        for i in range(self.tree.topLevelItemCount()):
+            group_item = self.tree.topLevelItem(i)
+            for j in range(group_item.childCount()):
+                if group_item.child(j).checkState(0) == Qt.Checked:
+                    yield group_item, group_item.child(j)
+
+    def move_checked(self):
+        checked = list(self.checked_items())
+        if not checked:
+            return
+        reply = QMessageBox.question(self, "Move Duplicates",
+                                     f"Move {len(checked)} images and their captions to the deleted folder?",
+                                     QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if reply != QMessageBox.Yes:
+            return
+        moved = self.parent().delete_images([item.data(0, Qt.UserRole) for _, item in checked])
+        for group_item, item in checked:
+            group_item.removeChild(item)
+        for i in reversed(range(self.tree.topLevelItemCount())):
+            if self.tree.topLevelItem(i).childCount() < 2:
+                self.tree.takeTopLevelItem(i)
+        self.status_label.setText(f"Moved {moved} images to the deleted folder")
+
+    def reject(self):
+        if self.scan_worker is not None and self.scan_worker.isRunning():
+            self.scan_worker.requestInterruption()
+            self.scan_worker.wait()
+        super().reject()
+
+class DuplicateScanWorker(QThread):
+    progress_updated = pyqtSignal(int, int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, directory, image_files, method, max_distance):
+        super().__init__()
+        self.directory = directory
+        self.image_files = image_files
+        self.method = method
+        self.max_distance = max_distance
+
+    def report_progress(self, done, total):
+        if self.isInterruptionRequested():
+            raise InterruptedError
+        self.progress_updated.emit(done, total)
+
+    def run(self):
+        from dataset_tools.dedupe import HashStore, compute_hashes, find_duplicate_groups
+        store = HashStore.for_directory(self.directory)
+        try:
+            image_hashes = compute_hashes(self.directory, self.image_files, store, progress=self.report_progress)
+            self.done.emit((image_hashes, find_duplicate_groups(image_hashes, self.method, self.max_distance)))
+        except InterruptedError:
+            pass
+        except Exception as e:
+            self.failed.emit(str(e))
+        finally:
+            store.close()
+
+class ResolutionsDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Resolutions and Buckets")
+        self.setGeometry(100, 100, 1000, 700)
+        self.layout = QVBoxLayout(self)
+
+        options_layout = QHBoxLayout()
+        self.resolution_input = QSpinBox()
+        self.resolution_input.setRange(256, 4096)
+        self.resolution_input.setSingleStep(64)
+        self.resolution_input.setValue(1024)
+        self.resolution_input.setToolTip("Training resolution, buckets keep their area within its square")
+        self.step_input = QSpinBox()
+        self.step_input.setRange(8, 256)
+        self.step_input.setSingleStep(8)
+        self.step_input.setValue(64)
+        self.step_input.setToolTip("Bucket sides are multiples of this")
+        self.min_side_input = QSpinBox()
+        self.min_side_input.setRange(0, 8192)
+        self.min_side_input.setSingleStep(64)
+        self.min_side_input.setValue(512)
+        self.min_side_input.setToolTip("Images whose shorter side is below this are listed")
+        self.scan_button = QPushButton("Scan")
+        self.scan_button.clicked.connect(self.toggle_scan)
+        options_layout.addWidget(QLabel("Resolution:"))
+        options_layout.addWidget(self.resolution_input)
+        options_layout.addWidget(QLabel("Step:"))
+        options_layout.addWidget(self.step_input)
+        options_layout.addWidget(QLabel("Min side:"))
+        options_layout.addWidget(self.min_side_input)
+        options_layout.addWidget(self.scan_button)
+        self.layout.addLayout(options_layout)
+        for widget in (self.resolution_input, self.step_input, self.min_side_input):
+            widget.valueChanged.connect(self.refresh)
+
+        self.progress_bar = QProgressBar()
+        self.layout.addWidget(self.progress_bar)
+        self.status_label = QLabel("Only image headers are read, and sizes are cached")
+        self.layout.addWidget(self.status_label)
+
+        splitter = QSplitter(Qt.Horizontal)
+        lists = QSplitter(Qt.Vertical)
+        self.report = QTextEdit()
+        self.report.setReadOnly(True)
+        self.report.setLineWrapMode(QTextEdit.NoWrap)
+        self.report.setStyleSheet("font-family: monospace;")
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(["Small image", "Resolution"])
+        self.tree.setColumnWidth(0, 300)
+        self.tree.currentItemChanged.connect(self.show_preview)
+        lists.addWidget(self.report)
+        lists.addWidget(self.tree)
+        self.preview = ScalableImageLabel()
+        self.preview.setMinimumWidth(300)
+        splitter.addWidget(lists)
+        splitter.addWidget(self.preview)
+        self.layout.addWidget(splitter, 1)
+
+        self.move_button = QPushButton("Move Checked to deleted/")
+        self.move_button.clicked.connect(self.move_checked)
+        self.layout.addWidget(self.move_button)
+
+        self.image_sizes = None
+        self.scan_worker = None
+        self.toggle_scan()
+
+    def toggle_scan(self):
+        if self.scan_worker is not None and self.scan_worker.isRunning():
+            self.scan_worker.requestInterruption()
+            return
+        main_app = self.parent()
+        self.scan_worker = ResolutionScanWorker(main_app.current_directory, list(main_app.image_files))
+        self.scan_worker.progress_updated.connect(self.on_progress)
+        self.scan_worker.done.connect(self.on_scanned)
+        self.scan_worker.failed.connect(lambda error: self.status_label.setText(f"Resolution scan failed ({error})"))
+        self.scan_worker.finished.connect(lambda: self.scan_button.setText("Scan"))
+        self.scan_button.setText("Stop")
+        self.status_label.setText("Reading image headers...")
+        self.scan_worker.start()
+
+    def on_progress(self, done, total):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.status_label.setText(f"Read {done}/{total} image headers")
+
+    def on_scanned(self, image_sizes):
+        self.image_sizes = image_sizes
+        self.status_label.setText(f"{int(image_sizes.valid.sum())}/{len(image_sizes.valid)} image sizes read")
+        self.refresh()
+
+    def refresh(self):
+        from dataset_tools.resolution import BucketReport
+        if self.image_sizes is None:
+            return
+        report = BucketReport(self.image_sizes, self.resolution_input.value(), self.step_input.value(),
+                              self.min_side_input.value())
+        self.report.setPlainText("\n".join(report.lines()))
+        self.tree.clear()
+        for position in report.small.tolist():
+            image_file = self.image_sizes.image_files[position]
+            item = QTreeWidgetItem([image_file, f"{self.image_sizes.width[position]}x{self.image_sizes.height[position]}"])
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(0, Qt.Unchecked)
+            item.setData(0, Qt.UserRole, image_file)
+            self.tree.addTopLevelItem(item)
+
+    def show_preview(self, item, previous=None):
+        if item is not None:
+            self.preview.setPixmap(QPixmap(os.path.join(self.parent().current_directory, item.data(0, Qt.UserRole))))
+
+    def move_checked(self):
+        checked = [self.tree.topLevelItem(i) for i in range(self.tree.topLevelItemCount())
+                   if self.tree.topLevelItem(i).checkState(0) == Qt.Checked]
+        if not checked:
+            return
+        reply = QMessageBox.question(self, "Move Small Images",
+                                     f"Move {len(checked)} images and their captions to the deleted folder?",
+                                     QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if reply != QMessageBox.Yes:
+            return
+        moved = self.parent().delete_images([item.data(0, Qt.UserRole) for item in checked])
+        self.toggle_scan()  # positions shifted, the rescan is all cache hits
+        self.scan_worker.finished.connect(lambda: self.status_label.setText(f"Moved {moved} images to the deleted folder"))
+
+    def reject(self):
+        if self.scan_worker is not None and self.scan_worker.isRunning():
+            self.scan_worker.requestInterruption()
+            self.scan_worker.wait()
+        super().reject()
+
+class ResolutionScanWorker(QThread):
+    progress_updated = pyqtSignal(int, int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, directory, image_files):
+        super().__init__()
+        self.directory = directory
+        self.image_files = image_files
+
+    def report_progress(self, done, total):
+        if self.isInterruptionRequested():
+            raise InterruptedError
+        self.progress_updated.emit(done, total)
+
+    def run(self):
+        from dataset_tools.resolution import SizeStore, scan_sizes
+        store = SizeStore.for_directory(self.directory)
+        try:
+            self.done.emit(scan_sizes(self.directory, self.image_files, store, progress=self.report_progress))
+        except InterruptedError:
+            pass
+        except Exception as e:
+            self.failed.emit(str(e))
+        finally:
+            store.close()
+
+class IntegrityDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Check Images")
+        self.setGeometry(100, 100, 800, 500)
+        self.layout = QVBoxLayout(self)
+
+        self.check_button = QPushButton("Check Images")
+        self.check_button.setToolTip("Decode every image on all cores, verdicts are cached until a file changes")
+        self.check_button.clicked.connect(self.toggle_check)
+        self.layout.addWidget(self.check_button)
+        self.progress_bar = QProgressBar()
+        self.layout.addWidget(self.progress_bar)
+        self.status_label = QLabel("")
+        self.layout.addWidget(self.status_label)
+
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(["Image", "Problem"])
+        self.tree.setColumnWidth(0, 300)
+        self.layout.addWidget(self.tree, 1)
+
+        self.move_button = QPushButton("Move Checked to quarantine/")
+        self.move_button.setToolTip("Images and their captions leave the dataset but are kept for inspection")
+        self.move_button.clicked.connect(self.move_checked)
+        self.layout.addWidget(self.move_button)
+
+        self.check_worker = None
+        self.toggle_check()
+
+    def toggle_check(self):
+        if self.check_worker is not None and self.check_worker.isRunning():
+            self.check_worker.requestInterruption()
+            return
+        main_app = self.parent()
+        image_files = list(main_app.image_files)
+        self.tree.clear()
+        self.check_worker = IntegrityCheckWorker(main_app, image_files)
+        self.check_worker.progress_updated.connect(self.on_progress)
+        self.check_worker.done.connect(lambda errors: self.on_checked(image_files, errors))
+        self.check_worker.failed.connect(lambda error: self.status_label.setText(f"Image check failed ({error})"))
+        self.check_worker.finished.connect(lambda: self.check_button.setText("Check Images"))
+        self.check_button.setText("Stop")
+        self.status_label.setText("Checking images...")
+        self.check_worker.start()
+
+    def on_progress(self, done, total):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.status_label.setText(f"Checked {done}/{total} images")
+
+    def on_checked(self, image_files, errors):
+        self.tree.clear()
+        for image_file, error in zip(image_files, errors):
+            if error:
+                item = QTreeWidgetItem([image_file, error])
+                item.setToolTip(1, error)
+                item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+                item.setCheckState(0, Qt.Checked)
+                item.setData(0, Qt.UserRole, image_file)
+                self.tree.addTopLevelItem(item)
+        self.status_label.setText(f"{self.tree.topLevelItemCount()} of {len(image_files)} images can't be read")
+
+    def move_checked(self):
+        checked = [self.tree.topLevelItem(i) for i in range(self.tree.topLevelItemCount())
+                   if self.tree.topLevelItem(i).checkState(0) == Qt.Checked]
+        if not checked:
+            return
+        from dataset_tools.integrity import QUARANTINE_DIRNAME
+        reply = QMessageBox.question(self, "Quarantine Images",
+                                     f"Move {len(checked)} images and their captions to the {QUARANTINE_DIRNAME} folder?",
+                                     QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if reply != QMessageBox.Yes:
+            return
+        moved = self.parent().delete_images([item.data(0, Qt.UserRole) for item in checked], QUARANTINE_DIRNAME)
+        for item in checked:
+            self.tree.takeTopLevelItem(self.tree.indexOfTopLevelItem(item))
+        self.status_label.setText(f"Moved {moved} images to the {QUARANTINE_DIRNAME} folder")
+
+    def reject(self):
+        if self.check_worker is not None and self.check_worker.isRunning():
+            self.check_worker.requestInterruption()
+            self.check_worker.wait()
+        super().reject()
+
+class IntegrityCheckWorker(QThread):
+    progress_updated = pyqtSignal(int, int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, main_app, image_files):
+        super().__init__()
+        self.main_app = main_app
+        self.image_files = image_files
+
+    def report_progress(self, done, total):
+        if self.isInterruptionRequested():
+            raise InterruptedError
+        self.progress_updated.emit(done, total)
+
+    def run(self):
+        from dataset_tools.integrity import check_images
+        try:
+            self.done.emit(check_images(self.main_app.current_directory, self.image_files,
+                                        self.main_app.integrity_store(), progress=self.report_progress))
+        except InterruptedError:
+            pass
+        except Exception as e:
+            self.failed.emit(str(e))
+
+class ExportDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Export Training Set")
+        self.setGeometry(100, 100, 600, 300)
+        self.layout = QVBoxLayout(self)
+
+        form_layout = QFormLayout()
+        output_layout = QHBoxLayout()
+        self.output_input = QLineEdit(self.parent().settings.value("export_directory", ""))
+        browse_button = QPushButton("Browse...")
+        browse_button.clicked.connect(self.browse)
+        output_layout.addWidget(self.output_input)
+        output_layout.addWidget(browse_button)
+        form_layout.addRow("Output folder:", output_layout)
+        self.tar_checkbox = QCheckBox("WebDataset tar shards")
+        self.tar_checkbox.setChecked(True)
+        self.parquet_checkbox = QCheckBox("Parquet caption table (needs pyarrow)")
+        form_layout.addRow("Write:", self.tar_checkbox)
+        form_layout.addRow("", self.parquet_checkbox)
+        self.resolution_input = QSpinBox()
+        self.resolution_input.setRange(0, 8192)
+        self.resolution_input.setSpecialValueText("Original")
+        self.resolution_input.setToolTip("Longest side in pixels, images are only ever scaled down")
+        form_layout.addRow("Resize to:", self.resolution_input)
+        self.format_dropdown = QComboBox()
+        self.format_dropdown.addItems(["Keep", "JPEG", "PNG", "WebP"])
+        form_layout.addRow("Image format:", self.format_dropdown)
+        self.shard_size_input = QSpinBox()
+        self.shard_size_input.setRange(10, 100000)
+        self.shard_size_input.setValue(1000)
+        form_layout.addRow("Images per shard:", self.shard_size_input)
+        self.workers_input = QSpinBox()
+        self.workers_input.setRange(1, 64)
+        self.workers_input.setValue(os.cpu_count() or 1)
+        form_layout.addRow("Worker processes:", self.workers_input)
+        self.verify_checkbox = QCheckBox("Re-hash shards from earlier runs before reusing them")
+        form_layout.addRow("Resume:", self.verify_checkbox)
+        self.layout.addLayout(form_layout)
+
+        self.progress_bar = QProgressBar()
+        self.layout.addWidget(self.progress_bar)
+        self.status_label = QLabel("Exporting into a folder again only repacks shards that changed")
+        self.layout.addWidget(self.status_label)
+        self.export_button = QPushButton("Export")
+        self.export_button.clicked.connect(self.toggle_export)
+        self.layout.addWidget(self.export_button)
+
+        self.worker = None
+
+    def browse(self):
+        directory = QFileDialog.getExistingDirectory(self, "Export To", self.output_input.text())
+        if directory:
+            self.output_input.setText(directory)
+
+    def toggle_export(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.requestInterruption()
+            return
+        output_dir = self.output_input.text().strip()
+        main_app = self.parent()
+        if not output_dir:
+            QMessageBox.warning(self, "Export", "Choose an output folder first.")
+            return
+        if os.path.abspath(output_dir) == os.path.abspath(main_app.current_directory):
+            QMessageBox.warning(self, "Export", "Export into a folder outside the dataset.")
+            return
+        main_app.settings.setValue("export_directory", output_dir)
+        if main_app.should_autosave():
+            main_app.save_description()  # the export reads captions from disk
+        image_format = self.format_dropdown.currentText()
+        options = dict(
+            tar=self.tar_checkbox.isChecked(),
+            parquet=self.parquet_checkbox.isChecked(),
+            resolution=self.resolution_input.value() or None,
+            image_format=None if image_format == "Keep" else image_format.lower(),
+            shard_size=self.shard_size_input.value(),
+            workers=self.workers_input.value(),
+            verify=self.verify_checkbox.isChecked(),
+        )
+        self.worker = ExportWorker(main_app.current_directory, list(main_app.image_files), output_dir, options)
+        self.worker.progress_updated.connect(self.on_progress)
+        self.worker.done.connect(self.on_done)
+        self.worker.failed.connect(lambda error: self.status_label.setText(f"Export failed ({error})"))
+        self.worker.finished.connect(lambda: self.export_button.setText("Export"))
+        self.export_button.setText("Stop")
+        self.status_label.setText("Reading captions...")
+        self.worker.start()
+
+    def on_progress(self, done, total):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.status_label.setText(f"Packed {done}/{total} shards")
+
+    def on_done(self, summary):
+        self.progress_bar.setMaximum(max(summary["shards"], 1))
+        self.progress_bar.setValue(summary["shards"])
+        self.status_label.setText(
+            f"Exported {summary['samples']} images in {summary['shards']} shards ({summary['packed']} packed, "
+            f"the rest unchanged) in {summary['seconds']:.1f} s, {summary['skipped']} skipped "
+            f"({summary['unreadable']} unreadable, the rest without a caption)")
+
+    def reject(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.requestInterruption()
+            self.worker.wait()
+        super().reject()
+
+class ExportWorker(QThread):
+    progress_updated = pyqtSignal(int, int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, directory, image_files, output_dir, options):
+        super().__init__()
+        self.directory = directory
+        self.image_files = image_files
+        self.output_dir = output_dir
+        self.options = options
+
+    def report_progress(self, done, total):
+        if self.isInterruptionRequested():
+            raise InterruptedError
+        self.progress_updated.emit(done, total)
+
+    def run(self):
+        from dataset_tools.export import export_dataset
+        try:
+            self.done.emit(export_dataset(self.directory, self.image_files, self.output_dir,
+                                          progress=self.report_progress, **self.options))
+        except InterruptedError:
+            pass
+        except Exception as e:
+            self.failed.emit(str(e))
+
+class SimilarImagesDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Similar Images")
+        self.setGeometry(100, 100, 700, 700)
+        self.layout = QVBoxLayout(self)
+
+        model_layout = QHBoxLayout()
+        self.model_dropdown = QComboBox()
+        self.model_dropdown.addItems(list(LOCAL_MODELS))
+        self.model_dropdown.currentTextChanged.connect(self.load_index)
+        self.scan_button = QPushButton("Scan Embeddings")
+        self.scan_button.setToolTip("Run the tagger over images without saved embeddings")
+        self.scan_button.clicked.connect(self.toggle_scan)
+        model_layout.addWidget(QLabel("Model:"))
+        model_layout.addWidget(self.model_dropdown)
+        model_layout.addWidget(self.scan_button)
+        self.layout.addLayout(model_layout)
+
+        search_layout = QHBoxLayout()
+        self.neighbours_input = QSpinBox()
+        self.neighbours_input.setRange(1, 500)
+        self.neighbours_input.setValue(20)
+        similar_button = QPushButton("Similar to Current")
+        similar_button.clicked.connect(self.show_similar)
+        self.clusters_input = QSpinBox()
+        self.clusters_input.setRange(2, 1000)
+        self.clusters_input.setValue(20)
+        self.cluster_button = QPushButton("Cluster")
+        self.cluster_button.clicked.connect(self.show_clusters)
+        search_layout.addWidget(QLabel("Neighbours:"))
+        search_layout.addWidget(self.neighbours_input)
+        search_layout.addWidget(similar_button)
+        search_layout.addWidget(QLabel("Clusters:"))
+        search_layout.addWidget(self.clusters_input)
+        search_layout.addWidget(self.cluster_button)
+        self.layout.addLayout(search_layout)
+
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(["Image", "Similarity"])
+        self.tree.setColumnWidth(0, 450)
+        self.tree.currentItemChanged.connect(self.on_item_selected)
+        self.layout.addWidget(self.tree)
+        self.status_label = QLabel("")
+        self.layout.addWidget(self.status_label)
+
+        self.index = None
+        self.index_positions = {}
+        self.loader = None
+        self.clusterer = None
+        self.scan_worker = None
+
+    def selected_model(self):
+        return LOCAL_MODELS[self.model_dropdown.currentText()]
+
+    def load_index(self):
+        main_app = self.parent()
+        store = main_app.embedding_store(self.selected_model())
+        directory, image_files = main_app.current_directory, list(main_app.image_files)
+        self.index = None
+        self.status_label.setText("Loading saved embeddings...")
+        self.loader = TaskWorker(lambda: (image_files, store.load(directory, image_files)))
+        self.loader.done.connect(lambda result, loader=self.loader: self.on_index_loaded(loader, result))
+        self.loader.failed.connect(lambda error: self.status_label.setText(f"Loading embeddings failed ({error})"))
+        self.loader.start()
+
+    def on_index_loaded(self, loader, result):
+        if loader is not self.loader:
+            return
+        image_files, self.index = result
+        self.index_positions = {image_file: i for i, image_file in enumerate(image_files)}
+        covered = int(self.index.covered.sum())
+        self.status_label.setText(f"{covered}/{len(image_files)} images have saved {self.selected_model()} embeddings")
+
+    def show_similar(self):
+        main_app = self.parent()
+        if self.index is None or not main_app.image_files:
+            return
+        image_file = main_app.image_files[main_app.current_image_index]
+        position = self.index_positions.get(image_file)
+        if position is None or not self.index.covered[position]:
+            self.status_label.setText(f"{image_file} has no saved embedding yet, scan or tag it first")
+            return
+        files = list(self.index_positions)
+        self.tree.clear()
+        for neighbour, similarity in self.index.similar(position, self.neighbours_input.value()):
+            item = QTreeWidgetItem([files[neighbour], f"{similarity:.3f}"])
+            item.setData(0, Qt.UserRole, files[neighbour])
+            self.tree.addTopLevelItem(item)
+        self.status_label.setText(f"Images most similar to {image_file}")
+
+    def show_clusters(self):
+        if self.index is None or (self.clusterer is not None and self.clusterer.isRunning()):
+            return
+        index, count = self.index, self.clusters_input.value()
+        self.status_label.setText("Clustering...")
+        self.clusterer = TaskWorker(lambda: index.clusters(count))
+        self.clusterer.done.connect(lambda groups, clusterer=self.clusterer: self.on_clustered(clusterer, groups))
+        self.clusterer.failed.connect(lambda error: self.status_label.setText(f"Clustering failed ({error})"))
+        self.clusterer.start()
+
+    def on_clustered(self, clusterer, groups):
+        if clusterer is not self.clusterer:
+            return
+        files = list(self.index_positions)
+        self.tree.clear()
+        for number, group in enumerate(groups, 1):
+            group_item = QTreeWidgetItem([f"Cluster {number} ({len(group)} images)"])
+            for position in group:
+                item = QTreeWidgetItem([files[position]])
+                item.setData(0, Qt.UserRole, files[position])
+                group_item.addChild(item)
+            self.tree.addTopLevelItem(group_item)
+        self.status_label.setText(f"{len(groups)} clusters, most typical image first")
+
+    def on_item_selected(self, item, previous=None):
+        image_file = item.data(0, Qt.UserRole) if item is not None else None
+        main_app = self.parent()
+        if image_file and image_file in main_app.image_files:
+            main_app.go_to_image(main_app.image_files.index(image_file))
+
+    def toggle_scan(self):
+        if self.scan_worker is not None and self.scan_worker.isRunning():
+            self.scan_worker.requestInterruption()
+            return
+        if self.index is None:
+            return
+        main_app = self.parent()
+        image_files = [image_file for image_file, i in self.index_positions.items() if not self.index.covered[i]]
+        self.scan_worker = EmbeddingScanWorker(main_app, self.selected_model(), image_files)
+        self.scan_worker.progress_updated.connect(
+            lambda done, total: self.status_label.setText(f"Embedded {done}/{total} images"))
+        self.scan_worker.finished.connect(self.on_scan_finished)
+        self.scan_button.setText("Stop Scan")
+        self.scan_worker.start()
+
+    def on_scan_finished(self):
+        self.scan_button.setText("Scan Embeddings")
+        error, failed = self.scan_worker.error, self.scan_worker.failed_images
+        self.load_index()
+        if error:
+            self.status_label.setText(f"Scan failed ({error})")
+        elif failed:
+            self.status_label.setText(f"{failed} images could not be embedded")
+
+    def closeEvent(self, event):
+        if self.scan_worker is not None and self.scan_worker.isRunning():
+            self.scan_worker.requestInterruption()
+            self.scan_worker.wait()
+        super().closeEvent(event)
+
+class EmbeddingScanWorker(QThread):
+    progress_updated = pyqtSignal(int, int)
+
+    def __init__(self, main_app, model, image_files):
+        super().__init__()
+        self.main_app = main_app
+        self.model = model
+        self.image_files = image_files
+        self.failed_images = 0
+        self.error = None
+
+    def run(self):
+        tagger = self.main_app.local_tagger()
+        model_repo, revision = tagger.model_spec(self.model)
+        try:
+            tagger.predictor.load_model(model_repo, revision, embeddings=True)
+        except Exception as e:
+            self.error = str(e)
+            return
+        embeddings = self.main_app.embedding_store(self.model)
+        probabilities = self.main_app.probability_store(self.model)
+        directory = self.main_app.current_directory
+        for done, image_file in enumerate(self.image_files, 1):
+            if self.isInterruptionRequested():
+                break
+            image_path = os.path.join(directory, image_file)
+            try:
+                # The probabilities come for free, keep them for the statistics view too
+                probs, embedding = self.main_app.local_scheduler.run(
+                    lambda: tagger.predictor.features(image_path, model_repo, revision), BATCH)
+                embeddings.put(image_path, embedding)
+                probabilities.put(image_path, probs, tagger.predictor.tag_table)
+            except Exception as e:
+                print(f"Could not embed {image_file}: {e}")
+                self.failed_images += 1
+            self.progress_updated.emit(done, len(self.image_files))
+
+class ProbabilityScanWorker(QThread):
+    progress_updated = pyqtSignal(int, int)
+
+    def __init__(self, main_app, model, image_files):
+        super().__init__()
+        self.main_app = main_app
+        self.model = model
+        self.image_files = image_files
+        self.failed_images = 0
+
+    def run(self):
+        tagger = self.main_app.local_tagger()
+        model_repo, revision = tagger.model_spec(self.model)
+        store = self.main_app.probability_store(self.model)
+        directory = self.main_app.current_directory
+        for done, image_file in enumerate(self.image_files, 1):
+            if self.isInterruptionRequested():
+                break
+            image_path = os.path.join(directory, image_file)
+            try:
+                probs = self.main_app.local_scheduler.run(
+                    lambda: tagger.predictor.probabilities(image_path, model_repo, revision), BATCH)
+                store.put(image_path, probs, tagger.predictor.tag_table)
+            except Exception as e:
+                print(f"Could not tag {image_file}: {e}")
+                self.failed_images += 1
+            self.progress_updated.emit(done, len(self.image_files))
+
+class TaskWorker(QThread):
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, task):
+        super().__init__()
+        self.task = task
+
+    def run(self):
+        try:
+            self.done.emit(self.task())
+        except Exception as e:
+            self.failed.emit(str(e))
 
 class BatchProcessingWorker(QThread):
     progress_updated = pyqtSignal(int, int)
-    caption_generated = pyqtSignal(int, str)
+    check_progress = pyqtSignal(int, int)
+    caption_generated = pyqtSignal(str, str)
     finished = pyqtSignal()
 
-    def __init__(self, main_app, skip_captioned, min_image, max_image):
+    def __init__(self, main_app, job, provider, skip_captioned, min_image, max_image):
         super().__init__()
         self.main_app = main_app
+        self.job = job
+        self.provider = provider
+        self.scheduler = main_app.local_scheduler if job.runs_locally else main_app.provider_scheduler
+        self.directory = main_app.current_directory
+        self.image_files = list(main_app.image_files)
         self.skip_captioned = skip_captioned
         self.min_image = min_image
         self.max_image = max_image
+        self.summary = ""
+        self.skipped = []  # (image file, why it can't be read)
+        self.failed = []  # (image file, error) for images the provider call failed on
+        self.error = None
 
     def run(self):
         if self.max_image < self.min_image:
             self.max_image, self.min_image = self.min_image, self.max_image # swap max and min if they're reversed
-        total_images = self.max_image - self.min_image + 1
-        processed = 0
+        batch = []
         for i in range(self.min_image, self.max_image + 1):
-            if self.isInterruptionRequested():
-                break
-            image_file = self.main_app.image_files[i - 1]
-            current_image = os.path.join(self.main_app.current_directory, image_file)
-            txt_path = os.path.splitext(current_image)[0] + '.txt'
-            if self.skip_captioned and os.path.exists(txt_path):
-                total_images -= 1 # decrease total for every captioned image  
-            
-            image_file = self.main_app.image_files[i - 1]
-            current_image = os.path.join(self.main_app.current_directory, image_file)
+            current_image = os.path.join(self.directory, self.image_files[i - 1])
             txt_path = os.path.splitext(current_image)[0] + '.txt'
             if self.skip_captioned and os.path.exists(txt_path):
                 continue
-            
-            if self.main_app.provider_dropdown.currentText() == "Local":
-                result = self.generate_local_caption(current_image)
-            elif self.main_app.provider_dropdown.currentText() == "Fal":
-                result = self.generate_fal_caption(current_image)
-            else:  # OpenRouter
-                result = self.generate_openrouter_caption(current_image)
-            self.caption_generated.emit(i - 1, result)
-            processed += 1
-            self.progress_updated.emit(processed, total_images)
+            batch.append(current_image)
+
+        try:
+            if self.provider.reads_images:
+                batch = self.drop_unreadable(batch)
+            self.scheduler.run(lambda: self.provider.prepare(batch), BATCH)
+            self.caption_batch(batch)
+        except InterruptedError:  # stopped while checking images
+            self.finished.emit()
+            return
+        except Exception as e:  # the integrity check (cache, directory) or the model itself failed
+            self.error = str(e)
+        uploads = self.provider.summary()
+        self.summary = "\n".join(self.problem_summary() + ([uploads] if uploads else []) +
+                                 [f"Queue wait: {format_wait_stats(self.scheduler.wait_stats())}"])
         self.finished.emit()
 
-    def generate_local_caption(self, image_path):
-        model = self.main_app.local_model_dropdown.currentText().lower().replace("-", "")
-        general_threshold = self.main_app.general_threshold_slider.value() / 100
-        character_threshold = self.main_app.character_threshold_slider.value() / 100
-
-        wdtagger = ImageTagger()
-        result = wdtagger.tag_image(
-            image_path,
-            model=model,
-            general=self.main_app.include_general.isChecked(),
-            rating=self.main_app.include_rating.isChecked(),
-            character=self.main_app.include_character.isChecked(),
-            general_threshold=general_threshold,
-            character_threshold=character_threshold,
-            general_mcut=self.main_app.general_mcut.isChecked(),
-            character_mcut=self.main_app.character_mcut.isChecked()
-        )
-        return result
-
-    def generate_fal_caption(self, image_path):
-        prompt = self.main_app.prompt_input.toPlainText()
-        max_tokens = self.main_app.max_tokens_input.value()
-        temp = self.main_app.temp_slider.value() / 10
-        top_p = self.main_app.top_p_slider.value() / 10
-        model = self.main_app.models_dropdown.currentText()
-        api_key = self.main_app.settings.value("fal_api_key", "")
-
-        return self.main_app.fal_describe_image(image_path, prompt, max_tokens, temp, top_p, model, api_key)
-
-    def generate_openrouter_caption(self, image_path):
-        prompt = self.main_app.openrouter_prompt_input.toPlainText()
-        model = self.main_app.openrouter_models_dropdown.currentText()
-        api_key = self.main_app.settings.value("openrouter_api_key", "")
-        max_tokens = self.main_app.openrouter_max_tokens_input.value()
-        temperature = self.main_app.openrouter_temp_slider.value() / 100
-        repetition_penalty = self.main_app.openrouter_rep_penalty_slider.value() / 100
-
-        if self.main_app.openrouter_include_caption_checkbox.isChecked():
-            current_caption = ""
-            txt_path = os.path.splitext(image_path)[0] + '.txt'
-            if os.path.exists(txt_path):
-                with open(txt_path, 'r') as f:
-                    current_caption = f.read().strip()
-            prompt = prompt.replace("{caption}", f'"{current_caption}"')
-
-        return self.main_app.openrouter_describe_image(prompt, model, api_key, max_tokens, temperature, repetition_penalty)
+    def caption_batch(self, batch):
+        # One scheduler call per chunk (a tuned tagger batch, a packed request or a single image),
+        # so a Generate click from the main window gets in between
+        processed = 0
+        chunk_size = self.provider.chunk_size
+        for start in range(0, len(batch), chunk_size):
+            if self.isInterruptionRequested():
+                break
+            image_paths = batch[start:start + chunk_size]
+            try:
+                results = self.scheduler.run(lambda: self.provider.caption_chunk(image_paths), BATCH)
+            except Exception as e:
+                results = [e] * len(image_paths)
+            for image_path, result in zip(image_paths, results):
+                if isinstance(result, Exception):
+                    self.record_failure(image_path, result)
+                else:
+                    self.caption_generated.emit(image_path, result)
+                processed += 1
+            self.progress_updated.emit(processed, len(batch))
+
+    def drop_unreadable(self, batch):
+        # Every file is decoded up front on all cores (verdicts are cached) so a broken one is skipped
+        # with its reason rather than failing mid-batch
+        from dataset_tools.integrity import check_images
+        image_files = [os.path.basename(image_path) for image_path in batch]
+        errors = check_images(self.directory, image_files, self.main_app.integrity_store(),
+                              progress=self.report_check_progress)
+        readable = []
+        for image_path, image_file, error in zip(batch, image_files, errors):
+            if error:
+                print(f"Skipping {image_file}: {error}")
+                self.skipped.append((image_file, error))
+            else:
+                readable.append(image_path)
+        return readable
+
+    def report_check_progress(self, done, total):
+        if self.isInterruptionRequested():
+            raise InterruptedError
+        self.check_progress.emit(done, total)
+
+    def record_failure(self, image_path, error):
+        print(f"Could not caption {os.path.basename(image_path)}: {error}")
+        self.failed.append((os.path.basename(image_path), str(error)))
+
+    def problem_summary(self):
+        lines = [f"Batch stopped: {self.error}"] if self.error else []
+        if self.skipped:
+            lines.append(f"{len(self.skipped)} unreadable images skipped, Check Images lists them")
+        if self.failed:
+            image_file, error = self.failed[-1]
+            lines.append(f"{len(self.failed)} images failed, last: {image_file} ({error})")
+        return lines
+
+class ModelPreloadWorker(QThread):
+    loaded = pyqtSignal(str)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, load_backend, model):
+        super().__init__()
+        self.load_backend = load_backend  # created here too, its imports stay off the GUI thread
+        self.model = model
+
+    def run(self):
+        try:
+            self.load_backend().preload(self.model)
+            self.loaded.emit(self.model)
+        except Exception as e:
+            self.failed.emit(self.model, str(e))
+
+class TagIndexWorker(QThread):
+    built = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, directory, image_files):
+        super().__init__()
+        self.directory = directory
+        self.image_files = image_files
+
+    def run(self):
+        try:
+            from dataset_tools.bulk import recover_interrupted_edit
+            from dataset_tools.tag_index import TagIndex
+            recover_interrupted_edit(self.directory)
+            self.built.emit(TagIndex.open(self.directory, self.image_files))
+        except Exception as e:
+            self.failed.emit(str(e))
+
+class OpenRouterStreamWorker(QThread):
+    token_received = pyqtSignal(str)
+    first_token = pyqtSignal(float)
+    completed = pyqtSignal(float)
+    failed = pyqtSignal(str)
+
+    def __init__(self, client, prompt, model, max_tokens, temperature, repetition_penalty, use_cache):
+        super().__init__()
+        self.client = client
+        self.request = (prompt, model, max_tokens, temperature, repetition_penalty, use_cache)
+        self.response = None
+
+    def run(self):
+        start = time.perf_counter()
+        received = False
+        try:
+            for token in self.client.stream(*self.request, on_response=self.set_response):
+                if self.isInterruptionRequested():
+                    return
+                if not received:
+                    received = True
+                    self.first_token.emit(time.perf_counter() - start)
+                self.token_received.emit(token)
+            self.completed.emit(time.perf_counter() - start)
+        except Exception as e:
+            if not self.isInterruptionRequested():
+                self.failed.emit(str(e))
+
+    def set_response(self, response):
+        self.response = response
+
+    def cancel(self):
+        self.requestInterruption()
+        if self.response is not None:
+            self.response.close()  # unblocks a read that is waiting on the socket
 
 class ImageTextPairApp(QWidget):
     def __init__(self):
@@ -274,13 +1577,49 @@ class ImageTextPairApp(QWidget):
         self.image_files = []
         self.current_directory = ""
         self.settings = QSettings("GoodCompany", "Labeler")
+        self.wdtagger = None
+        self.wdcaptioner = None
+        self.wdtagger_lock = threading.Lock()
+        self.preload_workers = []
+        self.provider_clients = ProviderClients()
+        self.stream_worker = None
+        self.stream_workers = []
+        self.stream_original_text = ""
+        self.stream_first_token = None
+        self.tag_index = None
+        self.tag_index_worker = None
+        self.tag_index_workers = []
+        self.pending_tag_refresh = set()
+        self.tag_filter_matches = None
+        self.statistics_dialog = None
+        self.similar_images_dialog = None
+        self.probability_stores = {}
+        self.embedding_stores = {}
+        self.verdict_store = None
+        self.dataset_stores_lock = threading.Lock()
+        # The local session is shared by everything that tags, so one call at a time; batch items queue
+        # behind anything interactive
+        self.local_scheduler = PriorityScheduler("tagger")
+        self.provider_scheduler = PriorityScheduler("provider", PROVIDER_WORKERS)
+        self.interactive_workers = []
+        self.batch_dialog = None
         self.initUI()
         self.apply_theme()
         self.setFocusPolicy(Qt.StrongFocus)
     
     def closeEvent(self, event):
+        self.cancel_openrouter_stream()
         if self.should_autosave():
             self.save_description()
+        if self.batch_dialog is not None:
+            self.batch_dialog.close()
+        self.local_scheduler.close()
+        self.provider_scheduler.close()
+        for worker in list(self.interactive_workers):
+            worker.wait()  # a call that was already running still finishes
+        self.provider_clients.close()
+        self.close_tag_index()
+        self.close_dataset_stores()
         super().closeEvent(event)
 
     def keyPressEvent(self, event):
@@ -309,17 +1648,81 @@ class ImageTextPairApp(QWidget):
         self.repetition_penalty_value.setVisible(show)
 
     def reset_generation_status(self):
-        if hasattr(self, 'generation_status'):
+        if "Fal" in self.provider_panels:
             self.generation_status.setText("Status: Ready")
+        if "Local" in self.provider_panels:
             self.local_status_label.setText("Status: Ready")
 
+    def provider_panel(self, provider):
+        if provider not in self.provider_panels:
+            if provider == "Fal":
+                panel = self.build_fal_panel()
+            elif provider == "Local":
+                panel = self.build_local_panel()
+            else:  # OpenRouter
+                panel = self.build_openrouter_panel()
+            self.stacked_widget.addWidget(panel)
+            self.provider_panels[provider] = panel
+        return self.provider_panels[provider]
+
     def on_provider_changed(self, provider):
-        if provider == "Fal":
-            self.stacked_widget.setCurrentIndex(0)
-        elif provider == "Local":
-            self.stacked_widget.setCurrentIndex(1)
-        else:  # OpenRouter
-            self.stacked_widget.setCurrentIndex(2)
+        self.stacked_widget.setCurrentWidget(self.provider_panel(provider))
+        if provider == "Local":
+            self.preload_local_model()
+
+    def local_tagger(self):
+        # onnxruntime, pandas and friends are only imported once the Local provider is actually used
+        with self.wdtagger_lock:
+            if self.wdtagger is None:
+                from wd_tagger.tagger import ImageTagger
+                tagging_server = self.settings.value("tagging_server", "")
+                if tagging_server:
+                    from wd_tagger.server import RemotePredictor
+                    self.wdtagger = ImageTagger(RemotePredictor(tagging_server))
+                else:
+                    self.wdtagger = ImageTagger()
+            return self.wdtagger
+
+    def local_captioner(self):
+        # Always runs here, a tagging server only serves the wd taggers
+        with self.wdtagger_lock:
+            if self.wdcaptioner is None:
+                from wd_tagger.captioner import ImageCaptioner
+                self.wdcaptioner = ImageCaptioner()
+            return self.wdcaptioner
+
+    def uses_local_captioner(self):
+        return self.type_dropdown.currentText() == "florence-2"
+
+    def selected_local_model(self):
+        if self.uses_local_captioner():
+            return LOCAL_CAPTION_MODELS.get(self.local_caption_model_dropdown.currentText(), "Florence_2_Base")
+        return LOCAL_MODELS.get(self.local_model_dropdown.currentText(), "vitv3")
+
+    def on_local_type_changed(self):
+        captioner = self.uses_local_captioner()
+        self.tagger_options.setVisible(not captioner)
+        self.captioner_options.setVisible(captioner)
+        self.preload_local_model()
+
+    def preload_local_model(self):
+        # Load the session in the background so the first Generate click doesn't pay for it
+        self.local_status_label.setText("Status: Loading model...")
+        backend = self.local_captioner if self.uses_local_captioner() else self.local_tagger
+        worker = ModelPreloadWorker(backend, self.selected_local_model())
+        worker.loaded.connect(self.on_local_model_loaded)
+        worker.failed.connect(self.on_local_model_failed)
+        worker.finished.connect(lambda: self.preload_workers.remove(worker))
+        self.preload_workers.append(worker)
+        worker.start()
+
+    def on_local_model_loaded(self, model):
+        if model == self.selected_local_model():
+            self.local_status_label.setText("Status: Ready")
+
+    def on_local_model_failed(self, model, error):
+        if model == self.selected_local_model():
+            self.local_status_label.setText(f"Status: Model load failed ({error})")
 
     def update_openrouter_temp_value(self):
         value = self.openrouter_temp_slider.value() / 100
@@ -350,162 +1753,244 @@ class ImageTextPairApp(QWidget):
         if not self.image_files:
             QMessageBox.warning(self, "No Images", "Please load a directory with images first.")
             return
-        dialog = BatchProcessingDialog(self)
+        if self.batch_dialog is None:
+            self.batch_dialog = BatchProcessingDialog(self)
+        elif not self.batch_dialog.isVisible():
+            self.batch_dialog.refresh()
+        self.batch_dialog.show()
+        self.batch_dialog.raise_()
+
+    def open_bulk_edit(self):
+        if not self.image_files:
+            QMessageBox.warning(self, "No Images", "Please load a directory with images first.")
+            return
+        self.cancel_openrouter_stream()
+        dialog = BulkEditDialog(self)
         dialog.exec_()
 
-    def update_caption(self, index, result):
-        self.current_image_index = index
-        self.load_current_image()
+    def open_statistics(self):
+        if not self.image_files:
+            QMessageBox.warning(self, "No Images", "Please load a directory with images first.")
+            return
+        if self.statistics_dialog is None:
+            self.statistics_dialog = StatisticsDialog(self)
+        self.statistics_dialog.show()
+        self.statistics_dialog.raise_()
+        self.statistics_dialog.refresh()
 
-        caption_mode = self.local_caption_mode_dropdown.currentText()
-        if caption_mode == "Append":
-            current_text = self.text_edit.toPlainText()
-            if current_text:
-                new_text = f"{current_text}, {result}"
-            else:
-                new_text = result
-        else:  # Replace
-            new_text = result
+    def open_duplicates(self):
+        if not self.image_files:
+            QMessageBox.warning(self, "No Images", "Please load a directory with images first.")
+            return
+        dialog = DuplicatesDialog(self)
+        dialog.exec_()
 
-        self.text_edit.setText(new_text)
-        self.save_description()
+    def open_resolutions(self):
+        if not self.image_files:
+            QMessageBox.warning(self, "No Images", "Please load a directory with images first.")
+            return
+        dialog = ResolutionsDialog(self)
+        dialog.exec_()
 
-    def generate_wd_caption(self, batch_mode=False):
+    def open_integrity_check(self):
         if not self.image_files:
-            QMessageBox.warning(self, "No Image", "Please load an image first.")
+            QMessageBox.warning(self, "No Images", "Please load a directory with images first.")
             return
+        dialog = IntegrityDialog(self)
+        dialog.exec_()
 
-        if not batch_mode:
-            self.local_status_label.setText("Status: Generating...")
-            self.local_generate_button.setEnabled(False)
-            self.prev_button.setEnabled(False)
-            self.next_button.setEnabled(False)
-        QApplication.processEvents()
+    def open_export(self):
+        if not self.image_files:
+            QMessageBox.warning(self, "No Images", "Please load a directory with images first.")
+            return
+        dialog = ExportDialog(self)
+        dialog.exec_()
 
-        try:
-            current_image = os.path.join(self.current_directory, self.image_files[self.current_image_index])
-            model = self.local_model_dropdown.currentText().lower().replace("-", "")
-
-            general_threshold = self.general_threshold_slider.value() / 100
-            character_threshold = self.character_threshold_slider.value() / 100
-
-            wdtagger = ImageTagger()
-            result = wdtagger.tag_image(
-                current_image,
-                model=model,
-                general=self.include_general.isChecked(),
-                rating=self.include_rating.isChecked(),
-                character=self.include_character.isChecked(),
-                general_threshold=general_threshold,
-                character_threshold=character_threshold,
-                general_mcut=self.general_mcut.isChecked(),
-                character_mcut=self.character_mcut.isChecked()
-            )
+    def open_similar_images(self):
+        if not self.image_files:
+            QMessageBox.warning(self, "No Images", "Please load a directory with images first.")
+            return
+        if self.similar_images_dialog is None:
+            self.similar_images_dialog = SimilarImagesDialog(self)
+        if not self.similar_images_dialog.isVisible():
+            self.similar_images_dialog.load_index()  # picks up the directory and anything tagged since
+        self.similar_images_dialog.show()
+        self.similar_images_dialog.raise_()
+
+    def on_bulk_edit_written(self):
+        self.on_tag_index_changed()
+        # Reload so the editor doesn't write the old caption back on the next autosave
+        self.load_current_image()
 
-            caption_mode = self.local_caption_mode_dropdown.currentText()
-            if caption_mode == "Append":
-                current_text = self.text_edit.toPlainText()
-                if current_text:
-                    new_text = f"{current_text}, {result}"
-                else:
-                    new_text = result
-            else:  # Replace
-                new_text = result
+    def is_current_image(self, image_path):
+        return bool(self.image_files) and image_path == os.path.join(self.current_directory,
+                                                                     self.image_files[self.current_image_index])
+
+    def update_caption(self, image_path, result, caption_mode):
+        # The batch window isn't modal, so results for other images go straight to their sidecar
+        # rather than pulling the view away from whatever the user is looking at
+        current = self.is_current_image(image_path)
+        txt_path = os.path.splitext(image_path)[0] + '.txt'
+        if current:
+            self.cancel_openrouter_stream()
+            current_text = self.text_edit.toPlainText()
+        elif not os.path.exists(image_path):
+            return  # deleted while it was being captioned
+        elif os.path.exists(txt_path):
+            with open(txt_path, 'r') as f:
+                current_text = f.read().strip()
+        else:
+            current_text = ""
 
+        new_text = merge_caption(current_text, result, caption_mode)
+        if current:
             self.text_edit.setText(new_text)
             self.save_description()
+            return
+        with open(txt_path, 'w') as f:
+            f.write(new_text)
+        if os.path.dirname(image_path) == self.current_directory:
+            try:
+                self.refresh_tag_index(self.image_files.index(os.path.basename(image_path)))
+            except ValueError:
+                pass
+            self.update_counters()
 
-            if not batch_mode:
-                self.local_status_label.setText("Status: Generation Complete")
-        except Exception as e:
-            if not batch_mode:
-                QMessageBox.critical(self, "Error", f"An error occurred: {str(e)}")
-                self.local_status_label.setText("Status: Generation Failed")
-        finally:
-            if not batch_mode:
-                self.local_generate_button.setEnabled(True)
-                self.prev_button.setEnabled(True)
-                self.next_button.setEnabled(True)
+    def run_interactive(self, scheduler, task, on_done, on_failed):
+        # Queued ahead of any batch items, and waited on off the GUI thread. on_done gets the result
+        # and the time the call spent in the queue
+        future = scheduler.submit(task, INTERACTIVE)
+        worker = TaskWorker(lambda: (future.result(), future.queue_wait))
+        worker.done.connect(lambda outcome: on_done(*outcome))
+        worker.failed.connect(on_failed)
+        worker.finished.connect(lambda: self.interactive_workers.remove(worker))
+        self.interactive_workers.append(worker)
+        worker.start()
+
+    def generate_wd_caption(self):
+        if not self.image_files:
+            QMessageBox.warning(self, "No Image", "Please load an image first.")
+            return
+
+        self.local_status_label.setText("Status: Generating...")
+        self.local_generate_button.setEnabled(False)
+        self.prev_button.setEnabled(False)
+        self.next_button.setEnabled(False)
+
+        current_image = os.path.join(self.current_directory, self.image_files[self.current_image_index])
+        job = self.local_job()
+        provider = self.caption_provider(job)
+        self.run_interactive(self.local_scheduler, lambda: provider.caption(current_image),
+                             lambda result, wait: self.on_wd_caption_done(current_image, provider, result, wait),
+                             lambda error: self.on_wd_caption_failed(current_image, error))
+
+    def on_wd_caption_done(self, image_path, provider, result, wait):
+        self.update_caption(image_path, result, provider.job.caption_mode)
+        summary = provider.summary()  # tiling cost or captioner throughput
+        self.local_status_label.setText(f"Status: Generation Complete (queued {wait * 1000:.0f} ms)"
+                                        + (f"\n{summary}" if summary else ""))
+        self.end_wd_caption()
+
+    def on_wd_caption_failed(self, image_path, error):
+        reason = self.unreadable_reason(image_path)
+        if reason:
+            self.local_status_label.setText(f"Status: Unreadable image ({reason})")
+        else:
+            QMessageBox.critical(self, "Error", f"An error occurred: {error}")
+            self.local_status_label.setText("Status: Generation Failed")
+        self.end_wd_caption()
+
+    def end_wd_caption(self):
+        self.local_generate_button.setEnabled(True)
+        self.prev_button.setEnabled(True)
+        self.next_button.setEnabled(True)
 
     def generate_openrouter_caption(self):
         if not self.image_files:
             QMessageBox.warning(self, "No Image", "Please load an image first.")
             return
         
-        prompt = self.openrouter_prompt_input.toPlainText()
-        
-        if self.openrouter_include_caption_checkbox.isChecked():
-            current_caption = self.text_edit.toPlainText()
-            prompt = prompt.replace("{caption}", f'"{current_caption}"')
-        model = self.openrouter_models_dropdown.currentText()
+        job = self.openrouter_job()
+        prompt = fill_prompt(job.prompt, self.text_edit.toPlainText()) if job.include_caption else job.prompt
         api_key = self.settings.value("openrouter_api_key", "")
-        max_tokens = self.openrouter_max_tokens_input.value()
-        temperature = self.openrouter_temp_slider.value() / 100
-        repetition_penalty = self.openrouter_rep_penalty_slider.value() / 100
-        
+
         if not api_key:
             QMessageBox.warning(self, "Missing API Key", "Please set your OpenRouter API key in the Settings.")
             return
-        
+
+        self.cancel_openrouter_stream()
         self.openrouter_status_label.setText("Status: Generating...")
         self.openrouter_generate_button.setEnabled(False)
-        self.prev_button.setEnabled(False)
-        self.next_button.setEnabled(False)
-        QApplication.processEvents()
-        
-        try:
-            output_text = self.openrouter_describe_image(prompt, model, api_key, max_tokens, temperature, repetition_penalty)
-            
-            caption_mode = self.caption_mode_dropdown.currentText()
-            if caption_mode == "Append":
-                current_text = self.text_edit.toPlainText()
-                if current_text:
-                    self.text_edit.setText(f"{current_text}\n\n{output_text}")
-                else:
-                    self.text_edit.setText(output_text)
-            else:  # Replace
-                self.text_edit.setText(output_text)
-            
-            self.openrouter_status_label.setText("Status: Generation Complete")
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"An error occurred: {str(e)}")
-            self.openrouter_status_label.setText("Status: Generation Failed")
-        finally:
-            self.openrouter_generate_button.setEnabled(True)
-            self.prev_button.setEnabled(True)
-            self.next_button.setEnabled(True)
-
-    def openrouter_describe_image(self, prompt, model, api_key, max_tokens, temperature, repetition_penalty):
-        models = {
-            "llama-3.1-8B (free)": "meta-llama/llama-3.1-8b-instruct:free",
-            "phi3-mini (free)": "microsoft/phi-3-mini-128k-instruct:free",
-            "phi3-medium (free)": "microsoft/phi-3-medium-128k-instruct:free",
-            "Gemma-2-9B (free)": "google/gemma-2-9b-it:free",
-        }
-        model_id = models.get(model, "meta-llama/llama-3.1-8b-instruct:free")
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "HTTP-Referer": f"https://github.com/BetaDoggo/Assisted-Image-Labeler",
-            "X-Title": f"Assisted-Image-Labeler",
-            "Content-Type": "application/json"
-        }
-       
-        data = {
-            "model": model_id,
-            "messages": [
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
-                ]}
-            ],
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "repetition_penalty": repetition_penalty
-        }
-       
-        response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=data)
-        response.raise_for_status()
-       
-        return response.json()['choices'][0]['message']['content']
+
+        # Tokens are appended as they arrive, navigating away cancels and restores this text
+        self.stream_original_text = self.text_edit.toPlainText()
+        if job.caption_mode == "Append":
+            if self.stream_original_text:
+                self.text_edit.setText(f"{self.stream_original_text}\n\n")
+        else:  # Replace
+            self.text_edit.clear()
+
+        worker = OpenRouterStreamWorker(
+            self.provider_clients.openrouter(api_key), prompt, job.model, job.max_tokens, job.temperature,
+            job.repetition_penalty, job.use_cache
+        )
+        worker.token_received.connect(lambda token: self.on_stream_token(worker, token))
+        worker.first_token.connect(lambda seconds: self.on_stream_first_token(worker, seconds))
+        worker.completed.connect(lambda seconds: self.on_stream_completed(worker, seconds))
+        worker.failed.connect(lambda error: self.on_stream_failed(worker, error))
+        worker.finished.connect(lambda: self.stream_workers.remove(worker))
+        self.stream_workers.append(worker)
+        self.stream_worker = worker
+        self.stream_first_token = None
+        worker.start()
+
+    def on_stream_token(self, worker, token):
+        if worker is not self.stream_worker:
+            return  # queued from a stream that has since been cancelled
+        self.text_edit.moveCursor(QTextCursor.End)
+        self.text_edit.insertPlainText(token)
+
+    def on_stream_first_token(self, worker, seconds):
+        if worker is self.stream_worker:
+            self.stream_first_token = seconds
+            self.openrouter_status_label.setText(f"Status: Streaming (first token {seconds:.2f}s)")
+
+    def on_stream_completed(self, worker, seconds):
+        if worker is not self.stream_worker:
+            return
+        self.stream_worker = None
+        first_token = f"first token {self.stream_first_token:.2f}s, " if self.stream_first_token is not None else ""
+        self.openrouter_status_label.setText(f"Status: Generation Complete ({first_token}total {seconds:.2f}s)")
+        self.openrouter_generate_button.setEnabled(True)
+
+    def on_stream_failed(self, worker, error):
+        if worker is not self.stream_worker:
+            return
+        self.stream_worker = None
+        self.text_edit.setText(self.stream_original_text)
+        QMessageBox.critical(self, "Error", f"An error occurred: {error}")
+        self.openrouter_status_label.setText("Status: Generation Failed")
+        self.openrouter_generate_button.setEnabled(True)
+
+    def cancel_openrouter_stream(self):
+        worker = self.stream_worker
+        if worker is None:
+            return
+        self.stream_worker = None
+        worker.cancel()
+        # Put back what was there so autosave doesn't store half a caption
+        self.text_edit.setText(self.stream_original_text)
+        self.openrouter_status_label.setText("Status: Cancelled")
+        self.openrouter_generate_button.setEnabled(True)
+
+    def remote_caption_mode(self):
+        # The Caption Mode dropdown on the Fal panel is shared with OpenRouter, which may be built first
+        if "Fal" in self.provider_panels:
+            return self.caption_mode_dropdown.currentText()
+        return "Replace"
+
+    def use_response_cache(self):
+        return not self.settings.value("bypass_response_cache", False, type=bool)
 
     def generate_fal_caption(self):
         if not self.image_files:
@@ -513,18 +1998,9 @@ class ImageTextPairApp(QWidget):
             return
 
         current_image = os.path.join(self.current_directory, self.image_files[self.current_image_index])
-        prompt = self.prompt_input.toPlainText()
-        
-        if self.fal_include_caption_checkbox.isChecked():
-            current_caption = self.text_edit.toPlainText()
-            prompt = prompt.replace("{caption}", f'"{current_caption}"')
-        max_tokens = self.max_tokens_input.value()
-        temp = self.temp_slider.value() / 10
-        top_p = self.top_p_slider.value() / 10
-        repetition_penalty = self.repetition_penalty_slider.value() / 100
-        model = self.models_dropdown.currentText()
+        current_caption = self.text_edit.toPlainText()
+        job = self.fal_job()
         api_key = self.settings.value("fal_api_key", "")
-        caption_mode = self.caption_mode_dropdown.currentText()
 
         if not api_key:
             QMessageBox.warning(self, "Missing API Key", "Please set your Fal API key in the Settings.")
@@ -534,11 +2010,16 @@ class ImageTextPairApp(QWidget):
         self.generate_button.setEnabled(False)
         self.prev_button.setEnabled(False)
         self.next_button.setEnabled(False)
-        QApplication.processEvents()
 
-        try:
-            output_text = self.fal_describe_image(current_image, prompt, max_tokens, temp, top_p, model, api_key, repetition_penalty)
+        provider = self.caption_provider(job)
+        self.run_interactive(
+            self.provider_scheduler,
+            lambda: provider.caption(current_image, current_caption),
+            lambda output_text, wait: self.on_fal_caption_done(current_image, job.caption_mode, output_text, wait),
+            lambda error: self.on_fal_caption_failed(current_image, error))
 
+    def on_fal_caption_done(self, image_path, caption_mode, output_text, wait):
+        if self.is_current_image(image_path):
             if caption_mode == "Append":
                 current_text = self.text_edit.toPlainText()
                 if current_text:
@@ -547,75 +2028,92 @@ class ImageTextPairApp(QWidget):
                     self.text_edit.setText(output_text)
             else:  # Replace
                 self.text_edit.setText(output_text)
+        self.generation_status.setText(f"Status: Generation Complete (queued {wait * 1000:.0f} ms)")
+        self.end_fal_caption()
 
-            self.generation_status.setText("Status: Generation Complete")
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"An error occurred: {str(e)}")
-            self.generation_status.setText("Status: Generation Failed")
-        finally:
-            self.generate_button.setEnabled(True)
-            self.prev_button.setEnabled(True)
-            self.next_button.setEnabled(True)
-
-    def fal_describe_image(self, image_path, prompt, max_tokens, temp, top_p, model, api_key, repetition_penalty=1):
-        # Set api key
-        os.environ["FAL_KEY"] = api_key
-        models = {
-            "LLavaV15_13B": "fal-ai/llavav15-13b",
-            "LLavaV16_34B": "fal-ai/llava-next",
-            "Florence_2_Large": "fal-ai/florence-2-large/detailed-caption",
-            "moondream_2": "fal-ai/moondream/batched",
-            "moondream_2_docci": "fal-ai/moondream/batched" # these models share an endpoint
-        }
-        endpoint = models.get(model)
-        if model == "moondream_2_docci":
-            model_id = "fal-ai/moondream2-docci"
+    def on_fal_caption_failed(self, image_path, error):
+        reason = self.unreadable_reason(image_path)
+        if reason:
+            self.generation_status.setText(f"Status: Unreadable image ({reason})")
         else:
-            model_id = "vikhyatk/moondream2"
-        # Upload image
-        with open(image_path, 'rb') as img_file:
-            file = img_file.read()
-        image_url = fal_client.upload(file, "image/png")
-        
-        if endpoint == "fal-ai/florence-2-large/detailed-caption": 
-            handler = fal_client.submit(
-            endpoint,
-            arguments={
-                "image_url": image_url,})
-            result = handler.get()
-            output_text = result['results']
-        elif endpoint == "fal-ai/moondream/batched":
-            handler = fal_client.submit(
-                endpoint,
-                arguments={
-                    "model_id": model_id,
-                    "inputs": [
-                        {
-                        "prompt": prompt,
-                        "image_url": image_url,
-                        }
-                    ],
-                    "max_tokens": max_tokens,
-                    "temperature": temp,
-                    "top_p": top_p,
-                    "repetition_penalty": repetition_penalty,
-                })
-            result = handler.get()
-            output_text = result['outputs'][0]
-        else: # llava
-            handler = fal_client.submit(
-                endpoint,
-                arguments={
-                    "image_url": image_url,
-                    "prompt": prompt,
-                    "max_tokens": max_tokens,
-                    "temperature": temp,
-                    "top_p": top_p,
-                }
+            QMessageBox.critical(self, "Error", f"An error occurred: {error}")
+            self.generation_status.setText("Status: Generation Failed")
+        self.end_fal_caption()
+
+    def end_fal_caption(self):
+        self.generate_button.setEnabled(True)
+        self.prev_button.setEnabled(True)
+        self.next_button.setEnabled(True)
+
+    def local_job(self):
+        if self.uses_local_captioner():
+            return LocalCaptionJob(
+                model=self.selected_local_model(),
+                task=LOCAL_CAPTION_TASKS[self.local_caption_task_dropdown.currentText()],
+                max_tokens=self.local_caption_max_tokens.value(),
+                caption_mode=self.local_caption_mode_dropdown.currentText(),
             )
-            result = handler.get()
-            output_text = result['output']
-        return output_text
+        return LocalJob(
+            model=self.selected_local_model(),
+            general=self.include_general.isChecked(),
+            rating=self.include_rating.isChecked(),
+            character=self.include_character.isChecked(),
+            general_threshold=self.general_threshold_slider.value() / 100,
+            character_threshold=self.character_threshold_slider.value() / 100,
+            general_mcut=self.general_mcut.isChecked(),
+            character_mcut=self.character_mcut.isChecked(),
+            save_embeddings=self.save_embeddings.isChecked(),
+            tiling=self.tile_images.isChecked(),
+            tile_merge=self.tile_merge_dropdown.currentText(),
+            caption_mode=self.local_caption_mode_dropdown.currentText(),
+        )
+
+    def fal_job(self):
+        return FalJob(
+            model=self.models_dropdown.currentText(),
+            prompt=self.prompt_input.toPlainText(),
+            include_caption=self.fal_include_caption_checkbox.isChecked(),
+            max_tokens=self.max_tokens_input.value(),
+            temperature=self.temp_slider.value() / 10,
+            top_p=self.top_p_slider.value() / 10,
+            repetition_penalty=self.repetition_penalty_slider.value() / 100,
+            upload_max_side=self.settings.value("upload_max_side", 1024, type=int),
+            upload_format=self.settings.value("upload_format", "JPEG"),
+            upload_quality=self.settings.value("upload_quality", 90, type=int),
+            use_cache=self.use_response_cache(),
+            caption_mode=self.caption_mode_dropdown.currentText(),
+        )
+
+    def openrouter_job(self):
+        return OpenRouterJob(
+            model=self.openrouter_models_dropdown.currentText(),
+            prompt=self.openrouter_prompt_input.toPlainText(),
+            include_caption=self.openrouter_include_caption_checkbox.isChecked(),
+            pack=self.openrouter_pack_checkbox.isChecked(),
+            max_tokens=self.openrouter_max_tokens_input.value(),
+            temperature=self.openrouter_temp_slider.value() / 100,
+            repetition_penalty=self.openrouter_rep_penalty_slider.value() / 100,
+            use_cache=self.use_response_cache(),
+            caption_mode=self.remote_caption_mode(),
+        )
+
+    def batch_job(self):
+        provider = self.provider_dropdown.currentText()
+        return {"Local": self.local_job, "Fal": self.fal_job, "OpenRouter": self.openrouter_job}[provider]()
+
+    def caption_provider(self, job):
+        # API keys stay out of the job, it may be written to a work queue or a file
+        if job.provider == "local":
+            return LocalProvider(
+                job, self.local_tagger(),
+                # Keeps the tagger's full output so statistics can explore thresholds without re-running it
+                on_probabilities=lambda path, probs, tag_table: self.probability_store(job.model).put(path, probs, tag_table),
+                on_embedding=lambda path, embedding: self.embedding_store(job.model).put(path, embedding))
+        if job.provider == "local_caption":
+            return LocalCaptionProvider(job, self.local_captioner())
+        if job.provider == "fal":
+            return FalProvider(job, self.provider_clients.fal(self.settings.value("fal_api_key", "")))
+        return OpenRouterProvider(job, self.provider_clients.openrouter(self.settings.value("openrouter_api_key", "")))
 
     def initUI(self):
         self.setWindowTitle('Labeler')
@@ -698,9 +2196,13 @@ class ImageTextPairApp(QWidget):
         next_unlabeled_button = QPushButton('Next Unlabeled', self)
         next_unlabeled_button.clicked.connect(self.next_unlabeled_image)
         next_unlabeled_button.setToolTip("Jump to the next unlabeled image")
+        export_button = QPushButton('Export', self)
+        export_button.clicked.connect(self.open_export)
+        export_button.setToolTip("Pack captioned images into tar shards and/or a Parquet table for training")
         button_layout.addWidget(load_button)
         button_layout.addWidget(save_button)
         button_layout.addWidget(next_unlabeled_button)
+        button_layout.addWidget(export_button)
 
         left_panel.addLayout(button_layout)
 
@@ -723,6 +2225,44 @@ class ImageTextPairApp(QWidget):
 
         left_panel.addLayout(jump_models_layout)
 
+        # Tag filter, restricts navigation to images whose caption matches
+        filter_layout = QHBoxLayout()
+        self.filter_input = QLineEdit(self)
+        self.filter_input.setPlaceholderText("Filter by tags, e.g. 1girl, -solo")
+        self.filter_input.setToolTip("Comma separated tags, prefix with - to exclude. "
+                                     "While a filter is active, Jump to Image counts matching images.")
+        self.filter_input.textChanged.connect(self.apply_tag_filter)
+        self.filter_input.returnPressed.connect(self.next_image)
+        self.filter_status = QLabel("")
+        statistics_button = QPushButton('Statistics', self)
+        statistics_button.clicked.connect(self.open_statistics)
+        statistics_button.setToolTip("Tag frequencies, co-occurrence and tagger confidence across the dataset")
+        bulk_edit_button = QPushButton('Bulk Edit', self)
+        bulk_edit_button.clicked.connect(self.open_bulk_edit)
+        bulk_edit_button.setToolTip("Rename, remove, dedupe or sort tags across the whole dataset")
+        duplicates_button = QPushButton('Find Duplicates', self)
+        duplicates_button.clicked.connect(self.open_duplicates)
+        duplicates_button.setToolTip("Group visually near-identical images and move the extra copies to deleted/")
+        filter_layout.addWidget(self.filter_input)
+        filter_layout.addWidget(self.filter_status)
+        filter_layout.addWidget(statistics_button)
+        filter_layout.addWidget(bulk_edit_button)
+        similar_button = QPushButton('Similar Images', self)
+        similar_button.clicked.connect(self.open_similar_images)
+        similar_button.setToolTip("Nearest neighbours and clusters from the tagger's image embeddings")
+        resolutions_button = QPushButton('Resolutions', self)
+        resolutions_button.clicked.connect(self.open_resolutions)
+        resolutions_button.setToolTip("Aspect-ratio bucket histogram for training, and images below a minimum size")
+        filter_layout.addWidget(duplicates_button)
+        filter_layout.addWidget(similar_button)
+        filter_layout.addWidget(resolutions_button)
+        integrity_button = QPushButton('Check Images', self)
+        integrity_button.clicked.connect(self.open_integrity_check)
+        integrity_button.setToolTip("Find truncated or corrupt images and move them to quarantine/")
+        filter_layout.addWidget(integrity_button)
+
+        left_panel.addLayout(filter_layout)
+
         # Add left panel to main layout
         main_layout.addLayout(left_panel, 7)  # Giving more space to the left panel
 
@@ -741,10 +2281,18 @@ class ImageTextPairApp(QWidget):
         provider_layout.addWidget(self.provider_dropdown)
         right_layout.addLayout(provider_layout)
 
-        # Stacked widget for Providers
+        # Stacked widget for Providers, panels are built the first time they are shown
         self.stacked_widget = QStackedWidget()
+        self.provider_panels = {}
+        right_layout.addWidget(self.stacked_widget)
+        right_layout.addStretch(1)  # Push everything to the top
+    
+        self.right_panel.hide()  # Initially hidden
+        main_layout.addWidget(self.right_panel, 3)  # Giving less space to the right panel
 
-        # Fal layout
+        self.setLayout(main_layout)
+
+    def build_fal_panel(self):
         fal_widget = QWidget()
         fal_layout = QVBoxLayout(fal_widget)
 
@@ -832,9 +2380,9 @@ class ImageTextPairApp(QWidget):
         self.toggle_model_options(self.models_dropdown.currentText()) # set visible items (Must be after loading all elements)
         
         fal_layout.addStretch(1)  # Push everything to the top
-        self.stacked_widget.addWidget(fal_widget)
+        return fal_widget
 
-        # Local layout
+    def build_local_panel(self):
         Local_widget = QWidget()
         Local_layout = QVBoxLayout(Local_widget)
         Local_layout.setSpacing(5)
@@ -842,18 +2390,26 @@ class ImageTextPairApp(QWidget):
         type_layout = QHBoxLayout()
         type_label = QLabel("Type:")
         self.type_dropdown = QComboBox()
-        self.type_dropdown.addItem("wd-tagger")
+        self.type_dropdown.addItems(["wd-tagger", "florence-2"])
         type_layout.addWidget(type_label)
         type_layout.addWidget(self.type_dropdown)
         Local_layout.addLayout(type_layout)
 
+        # Tagger and captioner settings, only the selected type's are shown
+        self.tagger_options = QWidget()
+        tagger_layout = QVBoxLayout(self.tagger_options)
+        tagger_layout.setContentsMargins(0, 0, 0, 0)
+        tagger_layout.setSpacing(5)
+        Local_layout.addWidget(self.tagger_options)
+
         model_layout = QHBoxLayout()
         model_label = QLabel("Model:")
         self.local_model_dropdown = QComboBox()
-        self.local_model_dropdown.addItems(["vit3", "vit3-Large", "swinv3", "convnextv3"])
+        self.local_model_dropdown.addItems(list(LOCAL_MODELS))
         model_layout.addWidget(model_label)
         model_layout.addWidget(self.local_model_dropdown)
-        Local_layout.addLayout(model_layout)
+        tagger_layout.addLayout(model_layout)
+        self.local_model_dropdown.currentTextChanged.connect(self.preload_local_model)
 
         # Add checkboxes
         self.include_general = QCheckBox("Include general")
@@ -862,9 +2418,9 @@ class ImageTextPairApp(QWidget):
         self.include_general.setChecked(True)
         self.include_character.setChecked(True)
         self.include_rating.setChecked(True)
-        Local_layout.addWidget(self.include_general)
-        Local_layout.addWidget(self.include_character)
-        Local_layout.addWidget(self.include_rating)
+        tagger_layout.addWidget(self.include_general)
+        tagger_layout.addWidget(self.include_character)
+        tagger_layout.addWidget(self.include_rating)
 
         # Add sliders for thresholds
         self.general_threshold_slider = QSlider(Qt.Horizontal)
@@ -872,22 +2428,71 @@ class ImageTextPairApp(QWidget):
         self.general_threshold_slider.setValue(35)
         self.general_threshold_label = QLabel("General Threshold: 0.35")
         self.general_threshold_slider.valueChanged.connect(self.update_general_threshold_label)
-        Local_layout.addWidget(self.general_threshold_label)
-        Local_layout.addWidget(self.general_threshold_slider)
+        tagger_layout.addWidget(self.general_threshold_label)
+        tagger_layout.addWidget(self.general_threshold_slider)
 
         self.character_threshold_slider = QSlider(Qt.Horizontal)
         self.character_threshold_slider.setRange(0, 100)
         self.character_threshold_slider.setValue(85)
         self.character_threshold_label = QLabel("Character Threshold: 0.85")
         self.character_threshold_slider.valueChanged.connect(self.update_character_threshold_label)
-        Local_layout.addWidget(self.character_threshold_label)
-        Local_layout.addWidget(self.character_threshold_slider)
+        tagger_layout.addWidget(self.character_threshold_label)
+        tagger_layout.addWidget(self.character_threshold_slider)
 
         # Add checkboxes for mcut options
         self.general_mcut = QCheckBox("General MCUT")
         self.character_mcut = QCheckBox("Character MCUT")
-        Local_layout.addWidget(self.general_mcut)
-        Local_layout.addWidget(self.character_mcut)
+        tagger_layout.addWidget(self.general_mcut)
+        tagger_layout.addWidget(self.character_mcut)
+
+        self.save_embeddings = QCheckBox("Save embeddings")
+        self.save_embeddings.setToolTip("Keep the model's image features while tagging, for Similar Images "
+                                        "(needs the onnx package)")
+        tagger_layout.addWidget(self.save_embeddings)
+
+        tiling_layout = QHBoxLayout()
+        self.tile_images = QCheckBox("Tile large images")
+        self.tile_images.setToolTip("Also tag overlapping crops of wide or large images, in the same batch as the "
+                                    "whole image, and merge their tags. Costs one extra pass per crop")
+        self.tile_merge_dropdown = QComboBox()
+        self.tile_merge_dropdown.addItems(["max", "mean"])
+        self.tile_merge_dropdown.setToolTip("max keeps details seen in any crop, mean only what most crops agree on")
+        tiling_layout.addWidget(self.tile_images)
+        tiling_layout.addWidget(QLabel("Merge:"))
+        tiling_layout.addWidget(self.tile_merge_dropdown)
+        tagger_layout.addLayout(tiling_layout)
+
+        self.captioner_options = QWidget()
+        captioner_layout = QVBoxLayout(self.captioner_options)
+        captioner_layout.setContentsMargins(0, 0, 0, 0)
+        captioner_layout.setSpacing(5)
+        Local_layout.addWidget(self.captioner_options)
+
+        caption_model_layout = QHBoxLayout()
+        self.local_caption_model_dropdown = QComboBox()
+        self.local_caption_model_dropdown.addItems(list(LOCAL_CAPTION_MODELS))
+        caption_model_layout.addWidget(QLabel("Model:"))
+        caption_model_layout.addWidget(self.local_caption_model_dropdown)
+        captioner_layout.addLayout(caption_model_layout)
+        self.local_caption_model_dropdown.currentTextChanged.connect(self.preload_local_model)
+
+        task_layout = QHBoxLayout()
+        self.local_caption_task_dropdown = QComboBox()
+        self.local_caption_task_dropdown.addItems(list(LOCAL_CAPTION_TASKS))
+        self.local_caption_task_dropdown.setCurrentText("More detailed caption")
+        task_layout.addWidget(QLabel("Task:"))
+        task_layout.addWidget(self.local_caption_task_dropdown)
+        captioner_layout.addLayout(task_layout)
+
+        caption_tokens_layout = QHBoxLayout()
+        self.local_caption_max_tokens = QSpinBox()
+        self.local_caption_max_tokens.setRange(16, 1024)
+        self.local_caption_max_tokens.setValue(256)
+        caption_tokens_layout.addWidget(QLabel("Max Tokens:"))
+        caption_tokens_layout.addWidget(self.local_caption_max_tokens)
+        captioner_layout.addLayout(caption_tokens_layout)
+        self.captioner_options.hide()
+        self.type_dropdown.currentTextChanged.connect(self.on_local_type_changed)
 
         # Add caption mode dropdown
         caption_mode_layout = QHBoxLayout()
@@ -900,6 +2505,7 @@ class ImageTextPairApp(QWidget):
 
         # Add status label
         self.local_status_label = QLabel("Status: Ready")
+        self.local_status_label.setWordWrap(True)
         Local_layout.addWidget(self.local_status_label)
 
         # Add generate button
@@ -913,15 +2519,9 @@ class ImageTextPairApp(QWidget):
         Local_layout.addWidget(self.batch_process_button)
 
         Local_layout.addStretch(1)
-        self.stacked_widget.addWidget(Local_widget)
+        return Local_widget
 
-        right_layout.addWidget(self.stacked_widget)
-        right_layout.addStretch(1)  # Push everything to the top
-    
-        self.right_panel.hide()  # Initially hidden
-        main_layout.addWidget(self.right_panel, 3)  # Giving less space to the right panel
-
-        # OpenRouter layout
+    def build_openrouter_panel(self):
         openrouter_widget = QWidget()
         openrouter_layout = QVBoxLayout(openrouter_widget)
         
@@ -942,6 +2542,10 @@ class ImageTextPairApp(QWidget):
         self.openrouter_include_caption_checkbox.setChecked(True)
         openrouter_layout.addWidget(self.openrouter_include_caption_checkbox)
 
+        self.openrouter_pack_checkbox = QCheckBox("Pack captions in batch mode")
+        self.openrouter_pack_checkbox.setToolTip("Send several {caption} rephrasings per request during batch processing")
+        openrouter_layout.addWidget(self.openrouter_pack_checkbox)
+
         # Add max_tokens input
         max_tokens_layout = QHBoxLayout()
         max_tokens_label = QLabel("Max Tokens:")
@@ -990,12 +2594,11 @@ class ImageTextPairApp(QWidget):
         openrouter_layout.addWidget(self.openrouter_batch_process_button)
         
         openrouter_layout.addStretch(1)
-        self.stacked_widget.addWidget(openrouter_widget)
-
-        self.setLayout(main_layout)
+        return openrouter_widget
 
     def toggle_models_panel(self):
         if self.show_models_button.isChecked():
+            self.stacked_widget.setCurrentWidget(self.provider_panel(self.provider_dropdown.currentText()))
             self.right_panel.show()
             self.show_models_button.setText('Hide Models')
         else:
@@ -1003,9 +2606,13 @@ class ImageTextPairApp(QWidget):
             self.show_models_button.setText('Show Models')
 
     def open_settings(self):
+        tagging_server = self.settings.value("tagging_server", "")
         dialog = SettingsDialog(self)
         if dialog.exec_():
             self.apply_theme()
+            if self.settings.value("tagging_server", "") != tagging_server:
+                with self.wdtagger_lock:
+                    self.wdtagger = None  # the next tagging call picks up the new backend
 
     def should_autosave(self):
         return self.settings.value("autosave", True, type=bool)
@@ -1013,14 +2620,147 @@ class ImageTextPairApp(QWidget):
     def load_directory(self):
         dir_path = QFileDialog.getExistingDirectory(self, "Select Directory")
         if dir_path:
-            self.current_directory = dir_path
-            self.image_files = [f for f in os.listdir(dir_path) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
-            if self.image_files:
-                self.current_image_index = 0
-                self.load_current_image()
-                self.update_counters()
+            self.open_directory(dir_path)
+
+    def open_directory(self, dir_path):
+        self.cancel_openrouter_stream()
+        self.current_directory = dir_path
+        self.image_files = [f for f in os.listdir(dir_path) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
+        # Dialogs first, their scans write into the stores
+        if self.batch_dialog is not None:
+            self.batch_dialog.close()  # its range points into the old image list
+        if self.statistics_dialog is not None:
+            self.statistics_dialog.close()
+        if self.similar_images_dialog is not None:
+            self.similar_images_dialog.close()
+        self.close_tag_index()
+        self.close_dataset_stores()
+        if self.image_files:
+            self.build_tag_index()
+            self.current_image_index = 0
+            self.load_current_image()
+            self.update_counters()
+        else:
+            self.image_label.setText("No images found in the selected directory")
+
+    def build_tag_index(self):
+        # Sidecars are read on a worker thread, navigation stays unfiltered until the index is ready
+        worker = TagIndexWorker(self.current_directory, list(self.image_files))
+        worker.built.connect(lambda index: self.on_tag_index_built(worker, index))
+        worker.failed.connect(lambda error: self.on_tag_index_failed(worker, error))
+        worker.finished.connect(lambda: self.tag_index_workers.remove(worker))
+        self.tag_index_worker = worker
+        self.tag_index_workers.append(worker)
+        self.update_filter_status()
+        worker.start()
+
+    def on_tag_index_built(self, worker, index):
+        if worker is not self.tag_index_worker:
+            index.close()
+            return
+        if worker.image_files != self.image_files:  # an image was deleted while indexing
+            index.close()
+            self.build_tag_index()
+            return
+        self.tag_index_worker = None
+        self.tag_index = index
+        for image_file in self.pending_tag_refresh:
+            self.tag_index.refresh(self.image_files.index(image_file), image_file)
+        self.pending_tag_refresh.clear()
+        self.on_tag_index_changed()
+
+    def on_tag_index_failed(self, worker, error):
+        if worker is self.tag_index_worker:
+            self.tag_index_worker = None
+            self.filter_status.setText(f"Indexing failed ({error})")
+
+    def close_tag_index(self):
+        self.tag_index_worker = None
+        self.pending_tag_refresh.clear()
+        self.tag_filter_matches = None
+        if self.tag_index is not None:
+            self.tag_index.close()
+            self.tag_index = None
+
+    def probability_store(self, model):
+        from dataset_tools.stats import ProbabilityStore
+        with self.dataset_stores_lock:
+            if model not in self.probability_stores:
+                self.probability_stores[model] = ProbabilityStore.for_model(self.current_directory, model)
+            return self.probability_stores[model]
+
+    def embedding_store(self, model):
+        from dataset_tools.embeddings import EmbeddingStore
+        with self.dataset_stores_lock:
+            if model not in self.embedding_stores:
+                self.embedding_stores[model] = EmbeddingStore.for_model(self.current_directory, model)
+            return self.embedding_stores[model]
+
+    def integrity_store(self):
+        from dataset_tools.integrity import IntegrityStore
+        with self.dataset_stores_lock:
+            if self.verdict_store is None:
+                self.verdict_store = IntegrityStore.for_directory(self.current_directory)
+            return self.verdict_store
+
+    def unreadable_reason(self, image_path):
+        # Why a failed generation's image can't be decoded, None when the file is fine and the failure lies elsewhere
+        from dataset_tools.integrity import check_images
+        if os.path.dirname(image_path) != self.current_directory:
+            return None
+        return check_images(self.current_directory, [os.path.basename(image_path)], self.integrity_store(), workers=1)[0]
+
+    def close_dataset_stores(self):
+        with self.dataset_stores_lock:
+            for store in [*self.probability_stores.values(), *self.embedding_stores.values()]:
+                store.close()
+            if self.verdict_store is not None:
+                self.verdict_store.close()
+            self.probability_stores = {}
+            self.embedding_stores = {}
+            self.verdict_store = None
+
+    def refresh_tag_index(self, index):
+        image_file = self.image_files[index]
+        if self.tag_index is not None:
+            self.tag_index.refresh(index, image_file)
+            self.on_tag_index_changed()
+        elif self.tag_index_worker is not None:
+            self.pending_tag_refresh.add(image_file)
+
+    def on_tag_index_changed(self):
+        self.apply_tag_filter()
+        if self.statistics_dialog is not None and self.statistics_dialog.isVisible():
+            self.statistics_dialog.refresh()
+
+    def apply_tag_filter(self):
+        query = self.filter_input.text().strip()
+        if query and self.tag_index is not None:
+            self.tag_filter_matches = self.tag_index.query(query)
+        else:
+            self.tag_filter_matches = None
+        self.update_filter_status()
+
+    def update_filter_status(self):
+        if not self.filter_input.text().strip():
+            self.filter_status.setText("")
+        elif self.tag_index is None:
+            if self.tag_index_worker is not None:
+                self.filter_status.setText("Indexing captions...")
+        else:
+            from dataset_tools.tag_index import match_number
+            matches = self.tag_filter_matches
+            number = match_number(matches, self.current_image_index)
+            if number:
+                self.filter_status.setText(f"{number}/{len(matches)} matches")
             else:
-                self.image_label.setText("No images found in the selected directory")
+                self.filter_status.setText(f"{len(matches)} matches")
+
+    def navigation_target(self, step):
+        if self.tag_filter_matches is None:
+            return (self.current_image_index + step) % len(self.image_files)
+        from dataset_tools.tag_index import step_match
+        return step_match(self.tag_filter_matches, self.current_image_index, step)
 
     def load_current_image(self):
         if 0 <= self.current_image_index < len(self.image_files):
@@ -1032,20 +2772,31 @@ class ImageTextPairApp(QWidget):
             self.reset_generation_status()
 
     def previous_image(self):
+        self.cancel_openrouter_stream()
         if self.image_files:
             if self.should_autosave():
                 self.save_description()
-            self.current_image_index = (self.current_image_index - 1) % len(self.image_files)
+            target = self.navigation_target(-1)
+            if target is None:
+                print("No images match the filter")
+                return
+            self.current_image_index = target
             self.load_current_image()
 
     def next_image(self):
+        self.cancel_openrouter_stream()
         if self.image_files:
             if self.should_autosave():
                 self.save_description()
-            self.current_image_index = (self.current_image_index + 1) % len(self.image_files)
+            target = self.navigation_target(1)
+            if target is None:
+                print("No images match the filter")
+                return
+            self.current_image_index = target
             self.load_current_image()
 
     def next_unlabeled_image(self):
+        self.cancel_openrouter_stream()
         if self.should_autosave():
             self.save_description()
         for i in range(self.current_image_index + 1, len(self.image_files)):
@@ -1059,16 +2810,24 @@ class ImageTextPairApp(QWidget):
     def jump_to_image(self):
         try:
             new_index = int(self.jump_input.text()) - 1
+            if self.tag_filter_matches is not None:
+                # With a filter active the number counts matching images
+                matches = self.tag_filter_matches
+                new_index = int(matches[new_index]) if 0 <= new_index < len(matches) else -1
             if 0 <= new_index < len(self.image_files):
-                if self.should_autosave():
-                    self.save_description()
-                self.current_image_index = new_index
-                self.load_current_image()
+                self.go_to_image(new_index)
             else:
                 print("Invalid image number")
         except ValueError:
             print("Please enter a valid number")
 
+    def go_to_image(self, index):
+        self.cancel_openrouter_stream()
+        if self.should_autosave():
+            self.save_description()
+        self.current_image_index = index
+        self.load_current_image()
+
     def load_description(self):
         current_image = os.path.join(self.current_directory, self.image_files[self.current_image_index])
         txt_path = os.path.splitext(current_image)[0] + '.txt'
@@ -1092,21 +2851,19 @@ class ImageTextPairApp(QWidget):
                 if os.path.exists(txt_path):
                     os.remove(txt_path)
             
+            self.refresh_tag_index(self.current_image_index)
             self.update_counters()
 
-    def delete_current_image(self):
-        if not self.image_files:
-            return
-
-        current_image = os.path.join(self.current_directory, self.image_files[self.current_image_index])
+    def move_to_deleted(self, image_file, folder="deleted"):
+        current_image = os.path.join(self.current_directory, image_file)
         txt_path = os.path.splitext(current_image)[0] + '.txt'
 
         # Create 'deleted' subfolder if it doesn't exist
-        deleted_folder = os.path.join(self.current_directory, "deleted")
+        deleted_folder = os.path.join(self.current_directory, folder)
         os.makedirs(deleted_folder, exist_ok=True)
 
         # Move image file to 'deleted' folder
-        deleted_image_path = os.path.join(deleted_folder, self.image_files[self.current_image_index])
+        deleted_image_path = os.path.join(deleted_folder, image_file)
         os.rename(current_image, deleted_image_path)
 
         # Move associated text file if it exists
@@ -1114,11 +2871,21 @@ class ImageTextPairApp(QWidget):
             deleted_txt_path = os.path.join(deleted_folder, os.path.basename(txt_path))
             os.rename(txt_path, deleted_txt_path)
 
+    def delete_current_image(self):
+        if not self.image_files:
+            return
+        self.cancel_openrouter_stream()
+
+        self.move_to_deleted(self.image_files[self.current_image_index])
+
         # Remove from list and update index
+        if self.tag_index is not None:
+            self.tag_index.remove(self.current_image_index, self.image_files[self.current_image_index])
         del self.image_files[self.current_image_index]
         if self.current_image_index >= len(self.image_files):
             self.current_image_index = max(0, len(self.image_files) - 1)
 
+        self.on_tag_index_changed()
         if self.image_files:
             self.load_current_image()
         else:
@@ -1127,6 +2894,39 @@ class ImageTextPairApp(QWidget):
         
         self.update_counters()
 
+    def delete_images(self, image_files, folder="deleted"):
+        # Batch version of delete_current_image, for the duplicates picked in review and quarantined files
+        self.cancel_openrouter_stream()
+        if self.should_autosave():
+            self.save_description()
+
+        targets = set(image_files)
+        removed = []
+        try:
+            for position, image_file in enumerate(self.image_files):
+                if image_file in targets:
+                    self.move_to_deleted(image_file, folder)
+                    removed.append((position, image_file))
+        except OSError as e:
+            QMessageBox.warning(self, "Delete Failed", f"Could not move {image_file}: {e}")
+
+        if self.tag_index is not None:
+            self.tag_index.remove_many(removed)
+        moved = {image_file for _, image_file in removed}
+        self.image_files = [image_file for image_file in self.image_files if image_file not in moved]
+        # Land on the image that took the current one's place
+        shift = sum(1 for position, _ in removed if position < self.current_image_index)
+        self.current_image_index = max(0, min(self.current_image_index - shift, len(self.image_files) - 1))
+
+        self.on_tag_index_changed()
+        if self.image_files:
+            self.load_current_image()
+        else:
+            self.image_label.setText("No images left in the directory")
+            self.text_edit.clear()
+        self.update_counters()
+        return len(removed)
+
     def update_counters(self):
         total_images = len(self.image_files)
         labeled_images = sum(1 for img in self.image_files 
@@ -1135,6 +2935,7 @@ class ImageTextPairApp(QWidget):
         
         self.image_counter.setText(f"{self.current_image_index + 1}/{total_images}")
         self.labeled_counter.setText(f"{labeled_images}/{total_images} labeled")
+        self.update_filter_status()
 
     def resizeEvent(self, event: QResizeEvent):
         super().resizeEvent(event)
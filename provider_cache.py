@@ -0,0 +1,149 @@
+import hashlib
+import json
+import mimetypes
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+CACHE_DIR = Path(os.environ.get("LABELER_CACHE_DIR", Path.home() / ".cache" / "assisted-image-labeler"))
+
+UPLOAD_TTL = 6 * 60 * 60  # fal doesn't promise how long uploads live, stay well inside it
+RESPONSE_TTL = 30 * 24 * 60 * 60
+RESPONSE_MAX_ENTRIES = 200000
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def detect_mime_type(data, file_name=None):
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"BM"):
+        return "image/bmp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    guessed = mimetypes.guess_type(file_name)[0] if file_name else None
+    return guessed or "application/octet-stream"
+
+class BlobCache:
+    def __init__(self, directory=None):
+        self.directory = Path(directory or CACHE_DIR / "encoded")
+
+    def path(self, key):
+        return self.directory / key[:2] / key
+
+    def get(self, key):
+        try:
+            return self.path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+class SqliteCache:
+    def __init__(self, path, schema, journal_mode="WAL"):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # One connection shared by the GUI and batch threads, serialised by the lock
+        self.connection = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.connection.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.connection.execute(schema)
+        self.lock = threading.Lock()
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def executemany(self, sql, rows):
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(sql, rows)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class UploadCache(SqliteCache):
+    def __init__(self, path=None, ttl=UPLOAD_TTL):
+        super().__init__(
+            path or CACHE_DIR / "fal_uploads.sqlite",
+            "CREATE TABLE IF NOT EXISTS uploads (digest TEXT PRIMARY KEY, url TEXT NOT NULL, expires_at REAL NOT NULL)",
+        )
+        self.ttl = ttl
+
+    def get(self, digest):
+        rows = self.execute("SELECT url FROM uploads WHERE digest = ? AND expires_at > ?", (digest, time.time()))
+        return rows[0][0] if rows else None
+
+    def put(self, digest, url):
+        self.execute(
+            "INSERT OR REPLACE INTO uploads (digest, url, expires_at) VALUES (?, ?, ?)",
+            (digest, url, time.time() + self.ttl),
+        )
+
+    def discard(self, digest):
+        self.execute("DELETE FROM uploads WHERE digest = ?", (digest,))
+
+    def prune(self):
+        self.execute("DELETE FROM uploads WHERE expires_at <= ?", (time.time(),))
+
+def response_key(provider, endpoint, prompt, params, image_hash=None):
+    key = json.dumps([provider, endpoint, prompt, params, image_hash], sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+class ResponseCache(SqliteCache):
+    def __init__(self, path=None, ttl=RESPONSE_TTL, max_entries=RESPONSE_MAX_ENTRIES):
+        super().__init__(
+            path or CACHE_DIR / "responses.sqlite",
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_used REAL NOT NULL)",
+        )
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.puts_since_evict = 0
+
+    def get(self, key):
+        now = time.time()
+        rows = self.execute("SELECT response FROM responses WHERE key = ? AND created_at > ?", (key, now - self.ttl))
+        if not rows:
+            return None
+        self.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(rows[0][0])
+
+    def put(self, key, response):
+        now = time.time()
+        self.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created_at, last_used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(response), now, now),
+        )
+        self.puts_since_evict += 1
+        if self.puts_since_evict >= 1000:
+            self.evict()
+
+    def evict(self):
+        # Drop expired entries, then the least recently used ones beyond max_entries
+        self.puts_since_evict = 0
+        self.execute("DELETE FROM responses WHERE created_at <= ?", (time.time() - self.ttl,))
+        self.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def clear(self):
+        self.execute("DELETE FROM responses")
@@ -0,0 +1,524 @@
+import concurrent.futures
+import io
+import json
+import os
+import threading
+import time
+from provider_cache import BlobCache, ResponseCache, UploadCache, content_hash, detect_mime_type, response_key
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+OPENROUTER_MODELS = {
+    "llama-3.1-8B (free)": "meta-llama/llama-3.1-8b-instruct:free",
+    "phi3-mini (free)": "microsoft/phi-3-mini-128k-instruct:free",
+    "phi3-medium (free)": "microsoft/phi-3-medium-128k-instruct:free",
+    "Gemma-2-9B (free)": "google/gemma-2-9b-it:free",
+}
+DEFAULT_OPENROUTER_MODEL = "meta-llama/llama-3.1-8b-instruct:free"
+OPENROUTER_CONTEXT_LENGTHS = {
+    "meta-llama/llama-3.1-8b-instruct:free": 131072,
+    "microsoft/phi-3-mini-128k-instruct:free": 128000,
+    "microsoft/phi-3-medium-128k-instruct:free": 128000,
+    "google/gemma-2-9b-it:free": 8192,
+}
+PACK_MAX_ITEMS = 32  # captions per packed request
+PACK_MAX_OUTPUT_TOKENS = 4096  # completion cap most free endpoints enforce
+PACK_ITEM_OVERHEAD_TOKENS = 16  # JSON keys and punctuation around each item
+PACK_INSTRUCTIONS = (
+    "You will receive an instruction and a numbered list of captions. Apply the instruction to each caption "
+    "independently, reading {caption} in the instruction as that caption. Reply with only a JSON object of the form "
+    '{"results": [{"id": <caption id>, "text": "<your answer for that caption>"}]} containing one entry per caption.'
+)
+
+FAL_MODELS = {
+    "LLavaV15_13B": "fal-ai/llavav15-13b",
+    "LLavaV16_34B": "fal-ai/llava-next",
+    "Florence_2_Large": "fal-ai/florence-2-large/detailed-caption",
+    "moondream_2": "fal-ai/moondream/batched",
+    "moondream_2_docci": "fal-ai/moondream/batched" # these models share an endpoint
+}
+
+CONNECT_TIMEOUT = 10  # seconds to establish a connection
+READ_TIMEOUT = 120  # seconds without a byte from the server
+FAL_JOB_TIMEOUT = 600  # seconds for a queued fal job to complete
+FAL_POLL_INTERVAL = 0.25
+FAL_UPLOAD_LOOKAHEAD = 4  # images uploaded ahead of the one being captioned in batch mode
+
+class UploadOptions:
+    def __init__(self, max_side=1024, image_format="JPEG", quality=90):
+        self.max_side = max_side  # 0 keeps the original resolution
+        self.image_format = image_format  # "Original" uploads the file untouched
+        self.quality = quality
+
+    @property
+    def enabled(self):
+        return self.image_format != "Original"
+
+    def key(self):
+        return f"{self.max_side}-{self.image_format}-{self.quality}"
+
+def encode_for_upload(data, options):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    max_side = options.max_side or max(image.size)
+    if max(image.size) <= max_side and image.format == options.image_format:
+        return data
+
+    image.thumbnail((max_side, max_side), Image.LANCZOS)  # uses draft()/reduce() for large inputs
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    if has_alpha and options.image_format == "JPEG":
+        image = image.convert("RGBA")
+        canvas = Image.new("RGBA", image.size, (255, 255, 255))
+        canvas.alpha_composite(image)
+        image = canvas.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+    output = io.BytesIO()
+    image.save(output, options.image_format, quality=options.quality)
+    encoded = output.getvalue()
+    return encoded if len(encoded) < len(data) else data
+
+class UploadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.original_bytes = 0
+        self.uploaded_bytes = 0
+        self.upload_seconds = 0.0
+        self.uploads = 0
+        self.cache_hits = 0
+
+    def record_upload(self, original_bytes, uploaded_bytes, seconds):
+        with self.lock:
+            self.original_bytes += original_bytes
+            self.uploaded_bytes += uploaded_bytes
+            self.upload_seconds += seconds
+            self.uploads += 1
+
+    def record_cache_hit(self):
+        with self.lock:
+            self.cache_hits += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "original_bytes": self.original_bytes,
+                "uploaded_bytes": self.uploaded_bytes,
+                "upload_seconds": self.upload_seconds,
+                "uploads": self.uploads,
+                "cache_hits": self.cache_hits,
+            }
+
+def summarize_uploads(before, after):
+    delta = {key: after[key] - before[key] for key in after}
+    if not delta["uploads"] and not delta["cache_hits"]:
+        return ""
+    saved_bytes = delta["original_bytes"] - delta["uploaded_bytes"]
+    summary = (
+        f"Uploaded {delta['uploaded_bytes'] / 1e6:.1f} MB in {delta['upload_seconds']:.1f}s "
+        f"({delta['uploads']} uploads, {delta['cache_hits']} cached), saved {saved_bytes / 1e6:.1f} MB"
+    )
+    if delta["uploaded_bytes"] and delta["upload_seconds"]:
+        # Estimate what the saved bytes would have cost at the throughput we actually saw
+        bytes_per_second = delta["uploaded_bytes"] / delta["upload_seconds"]
+        summary += f" (~{saved_bytes / bytes_per_second:.1f}s)"
+    return summary
+
+def cached_call(response_cache, use_cache, key, call):
+    # With use_cache off the lookup is skipped but the fresh response still replaces the stored one
+    if response_cache is None:
+        return call()
+    if use_cache:
+        response = response_cache.get(key)
+        if response is not None:
+            return response
+    response = call()
+    response_cache.put(key, response)
+    return response
+
+def estimate_tokens(text):
+    return len(text) // 3 + 1  # deliberately high, real tokenizers average closer to 4 characters
+
+def plan_packs(model_id, prompt, captions, max_tokens):
+    # Greedily fill each request until the item cap, the completion cap or the context window is reached
+    context = OPENROUTER_CONTEXT_LENGTHS.get(model_id, 8192)
+    base_tokens = estimate_tokens(PACK_INSTRUCTIONS) + estimate_tokens(prompt)
+    item_output = max_tokens + PACK_ITEM_OVERHEAD_TOKENS
+    packs = []
+    pack = []
+    input_tokens = base_tokens
+    for index, caption in enumerate(captions):
+        item_input = estimate_tokens(caption) + PACK_ITEM_OVERHEAD_TOKENS
+        output_tokens = (len(pack) + 1) * item_output
+        fits = (
+            len(pack) < PACK_MAX_ITEMS
+            and output_tokens <= PACK_MAX_OUTPUT_TOKENS
+            and input_tokens + item_input + output_tokens <= context
+        )
+        if pack and not fits:
+            packs.append(pack)
+            pack = []
+            input_tokens = base_tokens
+        pack.append(index)
+        input_tokens += item_input
+    if pack:
+        packs.append(pack)
+    return packs
+
+def parse_packed_results(text, count):
+    # Keeps only well-formed entries, anything missing is retried on its own by the caller
+    start, end = text.find("{"), text.rfind("}")
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return {}
+    items = data.get("results") if isinstance(data, dict) else None
+    results = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        item_id, item_text = item.get("id"), item.get("text")
+        if isinstance(item_id, int) and 0 <= item_id < count and isinstance(item_text, str) and item_text.strip():
+            results[item_id] = item_text.strip()
+    return results
+
+def iter_stream_tokens(response):
+    # chunk_size=None hands over each chunk as soon as it arrives instead of waiting for 512 bytes
+    for line in response.iter_lines(chunk_size=None):
+        if not line.startswith(b"data:"):
+            continue  # blank separators and ": OPENROUTER PROCESSING" keep-alive comments
+        payload = line[5:].strip()
+        if payload == b"[DONE]":
+            break
+        chunk = json.loads(payload)
+        if "error" in chunk:
+            raise RuntimeError(chunk["error"].get("message", str(chunk["error"])))
+        content = chunk["choices"][0].get("delta", {}).get("content")
+        if content:
+            yield content
+
+class OpenRouterClient:
+    def __init__(self, api_key, max_connections=4, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), url=OPENROUTER_URL,
+                 response_cache=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = url
+        self.response_cache = response_cache
+        self.timeout = timeout
+        self.session = requests.Session()
+        # pool_block makes extra threads wait for a kept-alive connection instead of opening throwaway ones
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "HTTP-Referer": "https://github.com/BetaDoggo/Assisted-Image-Labeler",
+            "X-Title": "Assisted-Image-Labeler",
+            "Content-Type": "application/json"
+        })
+
+    def describe(self, prompt, model, max_tokens, temperature, repetition_penalty, use_cache=True):
+        model_id = OPENROUTER_MODELS.get(model, DEFAULT_OPENROUTER_MODEL)
+        params = {"max_tokens": max_tokens, "temperature": temperature, "repetition_penalty": repetition_penalty}
+        key = response_key("openrouter", model_id, prompt, params)
+        return cached_call(self.response_cache, use_cache, key,
+                           lambda: self.complete(prompt, model_id, max_tokens, temperature, repetition_penalty))
+
+    def describe_many(self, prompt, captions, model, max_tokens, temperature, repetition_penalty, use_cache=True):
+        # Rephrases several captions through one {caption} prompt, packing them into as few requests as fit
+        model_id = OPENROUTER_MODELS.get(model, DEFAULT_OPENROUTER_MODEL)
+        params = {"max_tokens": max_tokens, "temperature": temperature, "repetition_penalty": repetition_penalty}
+        prompts = [prompt.replace("{caption}", f'"{caption}"') for caption in captions]
+        keys = [response_key("openrouter", model_id, item_prompt, params) for item_prompt in prompts]
+
+        results = [None] * len(captions)
+        if self.response_cache is not None and use_cache:
+            for index, key in enumerate(keys):
+                results[index] = self.response_cache.get(key)
+        missing = [index for index, result in enumerate(results) if result is None]
+
+        for pack in plan_packs(model_id, prompt, [captions[index] for index in missing], max_tokens):
+            indexes = [missing[position] for position in pack]
+            packed = self.complete_packed(prompt, [captions[index] for index in indexes], model_id, max_tokens,
+                                          temperature, repetition_penalty)
+            for position, index in enumerate(indexes):
+                if position in packed:
+                    results[index] = packed[position]
+                    if self.response_cache is not None:
+                        self.response_cache.put(keys[index], packed[position])
+
+        for index, result in enumerate(results):
+            if result is None:
+                results[index] = self.describe(prompts[index], model, max_tokens, temperature, repetition_penalty, use_cache)
+        return results
+
+    def complete_packed(self, prompt, captions, model_id, max_tokens, temperature, repetition_penalty):
+        items = [{"id": index, "caption": caption} for index, caption in enumerate(captions)]
+        data = {
+            "model": model_id,
+            "messages": [
+                {"role": "system", "content": PACK_INSTRUCTIONS},
+                {"role": "user", "content": json.dumps({"instruction": prompt, "captions": items}, ensure_ascii=False)},
+            ],
+            "response_format": {"type": "json_object"},
+            "max_tokens": len(captions) * (max_tokens + PACK_ITEM_OVERHEAD_TOKENS),
+            "temperature": temperature,
+            "repetition_penalty": repetition_penalty
+        }
+
+        response = self.session.post(self.url, json=data, timeout=self.timeout)
+        if response.status_code in (400, 422):
+            return {}  # the model rejects the packed request (no response_format), each caption goes on its own
+        # Rate limits, auth failures and timeouts raise: retrying item by item would only multiply them
+        response.raise_for_status()
+
+        try:
+            content = response.json()['choices'][0]['message']['content']
+        except (ValueError, KeyError, IndexError, TypeError):
+            return {}
+        return parse_packed_results(content, len(captions))
+
+    def stream(self, prompt, model, max_tokens, temperature, repetition_penalty, use_cache=True, on_response=None):
+        # Yields the completion piece by piece, a cache hit comes back as a single piece
+        model_id = OPENROUTER_MODELS.get(model, DEFAULT_OPENROUTER_MODEL)
+        params = {"max_tokens": max_tokens, "temperature": temperature, "repetition_penalty": repetition_penalty}
+        key = response_key("openrouter", model_id, prompt, params)
+        if self.response_cache is not None and use_cache:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                yield cached
+                return
+
+        data = self.request_body(prompt, model_id, max_tokens, temperature, repetition_penalty)
+        data["stream"] = True
+        response = self.session.post(self.url, json=data, timeout=self.timeout, stream=True)
+        if on_response:
+            on_response(response)  # lets another thread cancel by closing it
+        parts = []
+        with response:
+            response.raise_for_status()
+            for token in iter_stream_tokens(response):
+                parts.append(token)
+                yield token
+
+        # Only reached when the stream was read to the end, cancelled streams aren't cached
+        if self.response_cache is not None:
+            self.response_cache.put(key, "".join(parts))
+
+    def request_body(self, prompt, model_id, max_tokens, temperature, repetition_penalty):
+        return {
+            "model": model_id,
+            "messages": [
+                {"role": "user", "content": [
+                    {"type": "text", "text": prompt},
+                ]}
+            ],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "repetition_penalty": repetition_penalty
+        }
+
+    def complete(self, prompt, model_id, max_tokens, temperature, repetition_penalty):
+        data = self.request_body(prompt, model_id, max_tokens, temperature, repetition_penalty)
+
+        response = self.session.post(self.url, json=data, timeout=self.timeout)
+        response.raise_for_status()
+
+        return response.json()['choices'][0]['message']['content']
+
+    def close(self):
+        self.session.close()
+
+class FalClient:
+    def __init__(self, api_key, max_connections=4, timeout=READ_TIMEOUT, job_timeout=FAL_JOB_TIMEOUT, upload_cache=None,
+                 response_cache=None):
+        import fal_client
+
+        self.fal_client = fal_client
+        # SyncClient keeps one pooled httpx client for uploads, submits and status polls
+        self.client = fal_client.SyncClient(key=api_key, default_timeout=timeout)
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.job_timeout = job_timeout
+        self.upload_cache = upload_cache or UploadCache()
+        self.response_cache = response_cache
+        self.blob_cache = BlobCache()
+        self.upload_stats = UploadStats()
+        self.pending_uploads = {}
+        self.pending_lock = threading.Lock()
+        self.upload_executor = concurrent.futures.ThreadPoolExecutor(max_connections, thread_name_prefix="fal-upload")
+
+    def upload(self, data, content_type):
+        with self.slots:
+            return self.client.upload(data, content_type)
+
+    def upload_file(self, image_path, options=None):
+        with open(image_path, 'rb') as img_file:
+            data = img_file.read()
+        return self.upload_data(data, content_hash(data), os.path.basename(image_path), options)
+
+    def upload_data(self, data, digest, file_name, options=None):
+        # Uploads are keyed by content, so another model, prompt or retry on the same image reuses the URL
+        if options and options.enabled:
+            digest = f"{digest}-{options.key()}"
+        url = self.upload_cache.get(digest)
+        if url:
+            self.upload_stats.record_cache_hit()
+            return url, digest
+
+        with self.pending_lock:
+            pending = self.pending_uploads.get(digest)
+            if pending is None:
+                pending = self.pending_uploads[digest] = concurrent.futures.Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return pending.result(), digest
+
+        try:
+            blob = self.encoded_blob(data, digest, options)
+            start = time.perf_counter()
+            url = self.upload(blob, detect_mime_type(blob, file_name))
+            self.upload_stats.record_upload(len(data), len(blob), time.perf_counter() - start)
+            self.upload_cache.put(digest, url)
+            pending.set_result(url)
+            return url, digest
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self.pending_lock:
+                del self.pending_uploads[digest]
+
+    def encoded_blob(self, data, digest, options):
+        if not options or not options.enabled:
+            return data
+        blob = self.blob_cache.get(digest)
+        if blob is None:
+            blob = encode_for_upload(data, options)
+            if blob is not data:  # no point keeping a copy of files that didn't shrink
+                self.blob_cache.put(digest, blob)
+        return blob
+
+    def prefetch_uploads(self, image_paths, options=None):
+        # Encoding and uploading both happen on the pool, failures are left for describe() to report
+        for image_path in image_paths:
+            self.upload_executor.submit(self.upload_file, image_path, options)
+
+    def run(self, endpoint, arguments):
+        with self.slots:
+            handle = self.client.submit(endpoint, arguments=arguments)
+        deadline = time.monotonic() + self.job_timeout
+        for status in handle.iter_events(interval=FAL_POLL_INTERVAL):
+            if isinstance(status, self.fal_client.Completed):
+                break
+            if time.monotonic() > deadline:
+                handle.cancel()
+                raise TimeoutError(f"{endpoint} did not finish within {self.job_timeout} seconds")
+        return handle.get()
+
+    def describe(self, image_path, prompt, max_tokens, temp, top_p, model, repetition_penalty=1, upload_options=None,
+                 use_cache=True):
+        endpoint = FAL_MODELS.get(model)
+        if model == "moondream_2_docci":
+            model_id = "fal-ai/moondream2-docci"
+        else:
+            model_id = "vikhyatk/moondream2"
+
+        with open(image_path, 'rb') as img_file:
+            data = img_file.read()
+        image_hash = content_hash(data)
+        # Only what the endpoint actually receives goes into the key, Florence ignores prompt and sampling
+        if endpoint == "fal-ai/florence-2-large/detailed-caption":
+            key_prompt, params = None, {}
+        elif endpoint == "fal-ai/moondream/batched":
+            key_prompt = prompt
+            params = {"model_id": model_id, "max_tokens": max_tokens, "temperature": temp, "top_p": top_p,
+                      "repetition_penalty": repetition_penalty}
+        else: # llava
+            key_prompt, params = prompt, {"max_tokens": max_tokens, "temperature": temp, "top_p": top_p}
+        if upload_options and upload_options.enabled:
+            params["upload"] = upload_options.key()  # the model sees the re-encoded image
+        key = response_key("fal", endpoint, key_prompt, params, image_hash)
+
+        def call():
+            image_url, digest = self.upload_data(data, image_hash, os.path.basename(image_path), upload_options)
+            try:
+                return self.describe_url(image_url, endpoint, model_id, prompt, max_tokens, temp, top_p, repetition_penalty)
+            except Exception:
+                # The cached URL may have expired early, make the next attempt upload again
+                self.upload_cache.discard(digest)
+                raise
+
+        return cached_call(self.response_cache, use_cache, key, call)
+
+    def describe_url(self, image_url, endpoint, model_id, prompt, max_tokens, temp, top_p, repetition_penalty):
+        if endpoint == "fal-ai/florence-2-large/detailed-caption":
+            result = self.run(endpoint, {"image_url": image_url})
+            output_text = result['results']
+        elif endpoint == "fal-ai/moondream/batched":
+            result = self.run(endpoint, {
+                "model_id": model_id,
+                "inputs": [
+                    {
+                    "prompt": prompt,
+                    "image_url": image_url,
+                    }
+                ],
+                "max_tokens": max_tokens,
+                "temperature": temp,
+                "top_p": top_p,
+                "repetition_penalty": repetition_penalty,
+            })
+            output_text = result['outputs'][0]
+        else: # llava
+            result = self.run(endpoint, {
+                "image_url": image_url,
+                "prompt": prompt,
+                "max_tokens": max_tokens,
+                "temperature": temp,
+                "top_p": top_p,
+            })
+            output_text = result['output']
+        return output_text
+
+    def close(self):
+        self.upload_executor.shutdown(wait=False, cancel_futures=True)
+        self.upload_cache.close()
+        # SyncClient creates its httpx client lazily and has no close() of its own
+        if "_client" in vars(self.client):
+            self.client._client.close()
+
+class ProviderClients:
+    def __init__(self, max_connections=4):
+        self.max_connections = max_connections
+        self.clients = {}
+        self.response_cache = None
+        self.lock = threading.Lock()
+
+    def openrouter(self, api_key):
+        return self.get("openrouter", api_key, OpenRouterClient)
+
+    def fal(self, api_key):
+        return self.get("fal", api_key, FalClient)
+
+    def get(self, provider, api_key, factory):
+        # One client per provider and key, so changing the key in Settings starts a fresh pool
+        with self.lock:
+            key = (provider, api_key)
+            if key not in self.clients:
+                if self.response_cache is None:
+                    self.response_cache = ResponseCache()
+                self.clients[key] = factory(api_key, self.max_connections, response_cache=self.response_cache)
+            return self.clients[key]
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+            if self.response_cache is not None:
+                self.response_cache.close()
+                self.response_cache = None
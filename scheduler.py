@@ -0,0 +1,84 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+INTERACTIVE = 0
+BATCH = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+WAIT_SAMPLES = 1000  # recent waits kept per class for the percentiles
+
+class PriorityScheduler:
+    # Runs calls on a fixed set of threads, lower priority values first and FIFO within a class.
+    # Nothing is pre-empted mid-call, so batch work submits one item per call and an interactive
+    # request waits at most for the item that is already running
+    def __init__(self, name, workers=1):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.waits = {priority: deque(maxlen=WAIT_SAMPLES) for priority in PRIORITY_NAMES}
+        self.counts = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.threads = [threading.Thread(target=self.run_tasks, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, function, priority=BATCH):
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Scheduler is closed")
+            heapq.heappush(self.heap, (priority, next(self.counter), time.monotonic(), function, future))
+            self.condition.notify()
+        return future
+
+    def run(self, function, priority=BATCH):
+        return self.submit(function, priority).result()
+
+    def run_tasks(self):
+        while True:
+            with self.condition:
+                while not self.heap and not self.closed:
+                    self.condition.wait()
+                if not self.heap:
+                    return
+                priority, _, queued, function, future = heapq.heappop(self.heap)
+                future.queue_wait = time.monotonic() - queued
+                self.waits[priority].append(future.queue_wait)
+                self.counts[priority] += 1
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function())
+            except BaseException as e:
+                future.set_exception(e)
+
+    def pending(self):
+        with self.condition:
+            return len(self.heap)
+
+    def wait_stats(self):
+        with self.condition:
+            waits = {priority: sorted(samples) for priority, samples in self.waits.items()}
+            counts = dict(self.counts)
+        return {PRIORITY_NAMES[priority]: {
+                    "count": counts[priority],
+                    "mean": sum(samples) / len(samples) if samples else 0.0,
+                    "p95": samples[int(0.95 * (len(samples) - 1))] if samples else 0.0,
+                    "max": samples[-1] if samples else 0.0,
+                } for priority, samples in waits.items()}
+
+    def close(self):
+        # Queued calls are cancelled, one that is already running finishes on its daemon thread
+        with self.condition:
+            self.closed = True
+            for _, _, _, _, future in self.heap:
+                future.cancel()
+            self.heap = []
+            self.condition.notify_all()
+
+def format_wait_stats(stats):
+    return ", ".join(f"{name} {entry['count']} waited {entry['mean'] * 1000:.0f} ms avg, "
+                     f"{entry['p95'] * 1000:.0f} ms p95" for name, entry in stats.items() if entry["count"])
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("onnx")
+pytest.importorskip("tokenizers")
+
+from bench import make_standin_captioner
+from wd_tagger.captioner import NO_REPEAT_NGRAM_SIZE, CaptionGenerator, banned_tokens
+from wd_tagger.model_store import ModelStore
+from wd_tagger.tuning import TuningConfig
+
+MODEL_REPO, REVISION = "standin/captioner", "main"
+TASK = "<CAPTION>"
+MAX_TOKENS = 40
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    store = ModelStore(tmp_path_factory.mktemp("store"))
+    make_standin_captioner(store.model_dir(MODEL_REPO, REVISION), layers=2)
+    return store
+
+@pytest.fixture(scope="module")
+def image_paths(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("images")
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(5):
+        paths.append(str(directory / f"{i}.png"))
+        Image.fromarray(rng.integers(0, 256, (64 + 16 * i, 96, 3), dtype=np.uint8)).save(paths[-1])
+    return paths
+
+def generator(store, batch_size=1):
+    generator = CaptionGenerator(store, TuningConfig(batch_size))
+    generator.load_model(MODEL_REPO, REVISION)
+    return generator
+
+def recompute_decode(generator, image, task, max_tokens):
+    # Greedy decoding without the cache: the decoder sees the whole sequence again on every step
+    hidden_states, attention_mask = generator.encode(image, task)
+    empty_past = {name: np.zeros((1, shape[1], 0, shape[3]), dtype=np.float32)
+                  for name, shape in generator.past_shapes.items()}
+    tokens = [generator.eos_id]
+    sequence = []
+    for step in range(max_tokens):
+        feeds = {"inputs_embeds": generator.embed(np.array([tokens], dtype=np.int64)),
+                 "encoder_hidden_states": hidden_states, "encoder_attention_mask": attention_mask, **empty_past}
+        if generator.use_cache_input:
+            feeds["use_cache_branch"] = np.array([False])
+        logits = generator.decoder.run(["logits"], feeds)[0][0, -1]
+        if step == 0:
+            next_token = generator.bos_id
+        else:
+            logits[banned_tokens(sequence, NO_REPEAT_NGRAM_SIZE)] = -np.inf
+            next_token = int(logits.argmax())
+        sequence.append(next_token)
+        if next_token == generator.eos_id:
+            break
+        tokens.append(next_token)
+    return generator.tokenizer.decode(sequence, skip_special_tokens=True).strip()
+
+def test_cached_decoding_matches_recomputing(store, image_paths):
+    captioner = generator(store)
+    for image_path in image_paths:
+        image = captioner.prepare_image(image_path)
+        cached = captioner.generate(image, TASK, MAX_TOKENS)[0]
+        assert cached
+        assert cached == recompute_decode(captioner, image, TASK, MAX_TOKENS)
+
+def test_batched_captions_match_single(store, image_paths):
+    single = [caption for caption, error in generator(store, 1).run_many(image_paths, MODEL_REPO, REVISION, TASK, MAX_TOKENS)]
+    batched = [caption for caption, error in generator(store, 3).run_many(image_paths, MODEL_REPO, REVISION, TASK, MAX_TOKENS)]
+    assert batched == single
+
+def test_unreadable_image_only_fails_its_entry(store, image_paths, tmp_path):
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+    paths = [image_paths[0], str(broken), image_paths[1]]
+    results = list(generator(store, 2).run_many(paths, MODEL_REPO, REVISION, TASK, MAX_TOKENS))
+    assert results[0][0] and results[2][0]
+    assert results[1][0] is None and results[1][1] is not None
+
+def test_no_repeated_trigrams(store, image_paths):
+    captions = [caption for caption, _ in generator(store, 2).run_many(image_paths, MODEL_REPO, REVISION, TASK, MAX_TOKENS)]
+    for caption in captions:
+        words = caption.split()
+        trigrams = [tuple(words[i:i + 3]) for i in range(len(words) - 2)]
+        assert len(trigrams) == len(set(trigrams))
+
+def test_banned_tokens():
+    assert banned_tokens([1, 2], 3) == []
+    assert banned_tokens([1, 2, 3, 1, 2], 3) == [3]
+    assert sorted(banned_tokens([5, 1, 2, 3, 1, 2, 4, 1, 2], 3)) == [3, 4]
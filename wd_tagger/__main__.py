@@ -0,0 +1,273 @@
+import argparse
+import os
+
+from .captioner import CAPTIONER_FILES, CaptionGenerator, ImageCaptioner
+from .model_store import MODEL_FILES, PINS_PATH, ModelStore, load_pins, save_pins
+from .tagger import ImageTagger
+
+def check_model(model, models, kind):
+    # A typo must never reach the store under another model's key
+    if model not in models:
+        raise SystemExit(f"{model!r} is not a {kind} model, expected one of {', '.join(models)}")
+    return model
+
+def model_files(model):
+    # (repo, revision, files) for a tagger or captioner name
+    tagger, captioner = ImageTagger(), ImageCaptioner()
+    check_model(model, {**tagger.models, **captioner.models}, "tagger or captioner")
+    if model in captioner.models:
+        return (*captioner.model_spec(model), CAPTIONER_FILES)
+    return (*tagger.model_spec(model), MODEL_FILES)
+
+def pin_model(model_repo, branch, pins):
+    import huggingface_hub
+
+    commit = huggingface_hub.model_info(model_repo, revision=branch).sha
+    previous = pins.get(f"{model_repo}@{branch}")
+    pins[f"{model_repo}@{branch}"] = commit
+    save_pins(pins)
+    print(f"Pinned {model_repo}@{branch} to {commit}" + (f" (was {previous})" if previous not in (None, commit) else ""))
+    return commit
+
+def prefetch(args):
+    store = ModelStore(args.store)
+    pins = load_pins()
+    tables = {**ImageTagger().models, **ImageCaptioner().models}
+    for model in args.models or ImageTagger().models:  # captioners are large, only fetched by name
+        model_repo, revision, files = model_files(model)
+        if revision == tables[model][1]:
+            # Not pinned yet, pin it to the commit fetched now so every later fetch gets the same weights
+            revision = pin_model(model_repo, revision, pins)
+        print(f"Fetching {model} ({model_repo}@{revision})")
+        store.prefetch(model_repo, revision, files)
+    print(f"Pins live in {PINS_PATH}, commit it so every node uses the same weights")
+
+def pin(args):
+    pins = load_pins()
+    tables = {**ImageTagger().models, **ImageCaptioner().models}
+    for model in args.models:
+        check_model(model, tables, "tagger or captioner")
+    for model in args.models or tables:
+        pin_model(*tables[model], pins)
+    print(f"Wrote {PINS_PATH}, commit it so every node fetches the same weights")
+
+def import_model(args):
+    store = ModelStore(args.store)
+    model_repo, revision, files = model_files(args.model)
+    store.import_files(model_repo, revision, args.source, files)
+    print(f"Imported {args.model} ({model_repo}@{revision}) from {args.source}")
+
+def list_models(args):
+    store = ModelStore(args.store)
+    for manifest in store.list_models():
+        print(f"{manifest['repo']}@{manifest['revision']}  commit={manifest['commit']}  source={manifest['source']}")
+
+def serve(args):
+    from .server import TaggingService, make_server
+
+    service = TaggingService(ModelStore(args.store), args.max_batch, args.max_wait_ms / 1000)
+    tagger = ImageTagger()
+    for model in args.preload:
+        model_repo, revision = tagger.model_spec(check_model(model, tagger.models, "tagger"))
+        print(f"Loading {model} ({model_repo}@{revision})")
+        service.batcher(model_repo, revision).predictor.load_model(model_repo, revision)
+    server = make_server(service, args.listen)
+    print(f"Serving on {args.listen}, batches of up to {args.max_batch} waiting at most {args.max_wait_ms} ms")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.listen.startswith("unix:"):
+            os.remove(args.listen[len("unix:"):])
+
+def write_caption(image_path, caption):
+    txt_path = os.path.splitext(image_path)[0] + ".txt"
+    tmp_path = f"{txt_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(caption)
+    os.replace(tmp_path, txt_path)  # a shard run twice after a lost lease never leaves a torn caption
+
+def check_job_model(job):
+    models = ImageCaptioner().models if job.provider == "local_caption" else ImageTagger().models
+    check_model(job.model, models, job.provider)
+    return job
+
+def load_job(path):
+    from jobs import job_from_json
+
+    with open(path, encoding="utf-8") as f:
+        job = job_from_json(f.read())
+    if not job.runs_locally:
+        raise SystemExit(f"{path} is a {job.provider} job, tagging nodes only run local jobs")
+    return check_job_model(job)
+
+def queue_create(args):
+    from dataset_tools.work_queue import WorkQueue, list_images, read_manifest
+
+    job = load_job(args.job) if args.job else None
+    image_files = read_manifest(args.manifest) if args.manifest else list_images(args.directory)
+    queue = WorkQueue(args.queue)
+    shards = queue.populate(args.directory, image_files, args.shard_size, job)
+    print(f"Queued {len(image_files)} images from {args.directory} in {shards} shards")
+
+def queue_work(args):
+    from dataset_tools.work_queue import WorkQueue, run_worker
+    from jobs import LocalCaptionJob, LocalCaptionProvider, LocalJob, LocalProvider, merge_caption, read_caption
+
+    queue = WorkQueue(args.queue)
+    directory = args.directory or queue.directory()
+    # The job stored with the queue (or given here), with any settings passed on the command line on top
+    job = load_job(args.job) if args.job else queue.job()
+    if job is None:
+        job = LocalCaptionJob() if args.model in ImageCaptioner().models else LocalJob()
+    overrides = {"model": args.model, "general_threshold": args.general_threshold,
+                 "character_threshold": args.character_threshold}
+    if args.tiling:
+        overrides.update(tiling=args.tiling != "off", tile_merge=None if args.tiling == "off" else args.tiling)
+    try:
+        job = job.replace(**{name: value for name, value in overrides.items() if value is not None})
+    except TypeError as e:
+        raise SystemExit(str(e))
+    check_job_model(job)
+    print(f"Job: {job}")
+    if job.provider == "local_caption":
+        if args.server:
+            raise SystemExit("A tagging server only runs the wd taggers, caption jobs load the model on each node")
+        provider = LocalCaptionProvider(job, ImageCaptioner(CaptionGenerator(ModelStore(args.store))))
+    elif args.server:
+        from .server import RemotePredictor
+        provider = LocalProvider(job, ImageTagger(RemotePredictor(args.server, ModelStore(args.store))))
+    else:
+        from .tagger import Predictor
+        provider = LocalProvider(job, ImageTagger(Predictor(ModelStore(args.store))))
+
+    def process(image_files):
+        image_paths = [os.path.join(directory, image_file) for image_file in image_files]
+        todo = [image_path for image_path in image_paths
+                if args.overwrite or not os.path.exists(os.path.splitext(image_path)[0] + ".txt")]
+        captions = dict(zip(todo, provider.caption_chunk(todo)))
+        errors = []
+        for image_path in image_paths:
+            caption = captions.get(image_path)
+            if isinstance(caption, Exception):
+                errors.append(caption)
+                continue
+            if caption is not None:
+                write_caption(image_path, merge_caption(read_caption(image_path), caption, job.caption_mode))
+            errors.append(None)
+        return errors
+
+    provider.prepare([])  # the batch size comes from this host's tuning for the model
+    try:
+        run_worker(queue, process, args.worker, args.lease_seconds, batch_size=provider.chunk_size)
+        summary = provider.summary()  # tiling cost or captioner throughput
+        if summary:
+            print(summary)
+    finally:
+        queue.close()
+
+def queue_status(args):
+    from dataset_tools.work_queue import WorkQueue, format_status
+
+    queue = WorkQueue(args.queue)
+    print(format_status(queue.status()))
+
+def autotune(args):
+    import random
+    from dataset_tools.work_queue import list_images
+    from .tuning import TuningStore, autotune as run_autotune
+
+    store = ModelStore(args.store)
+    tagger = ImageTagger()
+    model_repo, revision = tagger.model_spec(check_model(args.model, tagger.models, "tagger"))
+    store.resolve(model_repo, revision)  # fetch once here rather than in every trial
+    image_files = list_images(args.directory)
+    if not image_files:
+        raise SystemExit(f"No images in {args.directory}")
+    sample = random.Random(0).sample(image_files, min(args.sample, len(image_files)))
+    image_paths = [os.path.join(args.directory, image_file) for image_file in sample]
+    print(f"Tuning {args.model} ({model_repo}@{revision}) on {len(image_paths)} images, "
+          f"{args.seconds:g} s per trial, memory cap {args.memory_cap_mb} MB")
+    config, rate, peak_mb = run_autotune(store, model_repo, revision, image_paths, args.seconds, args.memory_cap_mb)
+    print(f"Best: {config} at {rate:.2f} images/s, peak {peak_mb:.0f} MB")
+    if not args.dry_run:
+        tuning_store = TuningStore.for_store(store)
+        tuning_store.put(model_repo, revision, config, rate, peak_mb)
+        print(f"Saved for this host in {tuning_store.path}")
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m wd_tagger")
+    parser.add_argument("--store", help="Model store directory (default: $WD_TAGGER_MODEL_DIR or ~/.cache/wd_tagger/models)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prefetch_parser = subparsers.add_parser("prefetch", help="Download models into the local store")
+    prefetch_parser.add_argument("models", nargs="*", help="Model names, e.g. vitv3 or Florence_2_Base (default: every tagger)")
+    prefetch_parser.set_defaults(func=prefetch)
+
+    pin_parser = subparsers.add_parser("pin", help="Pin models to their branch's current commit in model_pins.json")
+    pin_parser.add_argument("models", nargs="*", help="Model names (default: every tagger and captioner)")
+    pin_parser.set_defaults(func=pin)
+
+    import_parser = subparsers.add_parser("import", help="Copy a model's files from a folder into the store")
+    import_parser.add_argument("model", help="Model name, e.g. vitv3 or Florence_2_Base")
+    import_parser.add_argument("source", help="Folder containing model.onnx and selected_tags.csv, or a captioner's "
+                                              "tokenizer.json and onnx/ graphs")
+    import_parser.set_defaults(func=import_model)
+
+    list_parser = subparsers.add_parser("list", help="List models in the local store")
+    list_parser.set_defaults(func=list_models)
+
+    serve_parser = subparsers.add_parser("serve", help="Run a shared tagging server that batches requests from several labelers")
+    serve_parser.add_argument("--listen", default="127.0.0.1:8765", help="host:port or unix:/path/to.sock")
+    serve_parser.add_argument("--max-batch", type=int, default=8, help="Most images per inference call")
+    serve_parser.add_argument("--max-wait-ms", type=float, default=10, help="How long a request waits for others to batch with")
+    serve_parser.add_argument("--preload", nargs="*", default=[], help="Model names to load at startup, e.g. vitv3")
+    serve_parser.set_defaults(func=serve)
+
+    autotune_parser = subparsers.add_parser("autotune", help="Find the fastest batch size and thread counts for this host")
+    autotune_parser.add_argument("directory", help="Dataset to sample images from")
+    autotune_parser.add_argument("--model", default="vitv3")
+    autotune_parser.add_argument("--sample", type=int, default=64, help="Images per trial")
+    autotune_parser.add_argument("--seconds", type=float, default=5, help="How long each trial runs")
+    autotune_parser.add_argument("--memory-cap-mb", type=int, default=4096, help="Skip configurations peaking above this")
+    autotune_parser.add_argument("--dry-run", action="store_true", help="Report the best configuration without saving it")
+    autotune_parser.set_defaults(func=autotune)
+
+    queue_parser = subparsers.add_parser("queue", help="Split a dataset across several tagging nodes")
+    queue_subparsers = queue_parser.add_subparsers(dest="queue_command", required=True)
+    create_parser = queue_subparsers.add_parser("create", help="Split a dataset into shards")
+    create_parser.add_argument("directory", help="Dataset directory on the shared storage")
+    create_parser.add_argument("queue", help="Queue database to create, e.g. on the same share")
+    create_parser.add_argument("--manifest", help="File listing the images to queue, one per line (default: every image)")
+    create_parser.add_argument("--shard-size", type=int, default=500)
+    create_parser.add_argument("--job", help="JSON job config every node tags with (default: the Local defaults)")
+    create_parser.set_defaults(func=queue_create)
+
+    work_parser = queue_subparsers.add_parser("work", help="Lease shards and tag them until the queue is done")
+    work_parser.add_argument("queue")
+    work_parser.add_argument("--directory", help="Where this node mounts the dataset (default: the path it was queued from)")
+    work_parser.add_argument("--job", help="JSON job config to use instead of the one stored with the queue")
+    work_parser.add_argument("--model", help="Override the job's model, e.g. vitv3. Without a job, a captioner "
+                             "name such as Florence_2_Base runs a local caption job")
+    work_parser.add_argument("--general-threshold", type=float, help="Override the job's general threshold")
+    work_parser.add_argument("--character-threshold", type=float, help="Override the job's character threshold")
+    work_parser.add_argument("--tiling", choices=["max", "mean", "off"],
+                             help="Override the job's tiling: tag overlapping crops of large images and merge by max or mean")
+    work_parser.add_argument("--overwrite", action="store_true", help="Retag images that already have a caption")
+    work_parser.add_argument("--server", help="Use a `wd_tagger serve` process instead of loading the model here")
+    work_parser.add_argument("--worker", help="Name shown in the status report (default: host-pid)")
+    work_parser.add_argument("--lease-seconds", type=float, default=120)
+    work_parser.set_defaults(func=queue_work)
+
+    status_parser = queue_subparsers.add_parser("status", help="Progress and throughput per node")
+    status_parser.add_argument("queue")
+    status_parser.set_defaults(func=queue_status)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import onnxruntime as rt
+from PIL import Image
+from .model_store import ModelStore, load_pins, pinned_revision
+from .tuning import TuningConfig, TuningStore
+
+TOKENIZER_FILENAME = "tokenizer.json"
+# The split export optimum and transformers.js use: image encoder, token embeddings, text encoder and
+# a decoder merged with its past-key-values variant
+CAPTIONER_FILES = (TOKENIZER_FILENAME, "onnx/vision_encoder.onnx", "onnx/embed_tokens.onnx",
+                   "onnx/encoder_model.onnx", "onnx/decoder_model_merged.onnx")
+DEFAULT_IMAGE_SIZE = 768  # when the vision encoder's input size isn't fixed in the graph
+IMAGE_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGE_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+DEFAULT_BATCH_SIZE = 4  # without a tuning entry, the decoder's per-step overhead is shared by a few images
+NO_REPEAT_NGRAM_SIZE = 3  # as in Florence-2's generation config, greedy decoding loops without it
+# Florence-2 task tokens and the prompts its processor expands them to
+TASK_PROMPTS = {
+    "<CAPTION>": "What does the image describe?",
+    "<DETAILED_CAPTION>": "Describe in detail what is shown in the image.",
+    "<MORE_DETAILED_CAPTION>": "Describe with a paragraph what is shown in the image.",
+}
+
+def load_tokenizer(path):
+    try:
+        from tokenizers import Tokenizer
+    except ImportError:
+        raise RuntimeError("Local captioning needs the tokenizers package (pip install tokenizers)") from None
+    return Tokenizer.from_file(path)
+
+def banned_tokens(tokens, size):
+    # Tokens that would complete an n-gram the sequence already contains
+    if len(tokens) < size:
+        return []
+    prefix = tokens[len(tokens) - size + 1:]
+    return [tokens[i + size - 1] for i in range(len(tokens) - size + 1) if tokens[i:i + size - 1] == prefix]
+
+class GenerationStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def record(self, images, tokens, seconds):
+        with self.lock:
+            self.images += images
+            self.tokens += tokens
+            self.seconds += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return self.images, self.tokens, self.seconds
+
+def summarize_generation(before, after, device):
+    images, tokens, seconds = (now - then for now, then in zip(after, before))
+    if not images:
+        return ""
+    return (f"Captioned {images} images ({tokens} tokens) in {seconds:.1f} s on {device}: "
+            f"{images / seconds:.2f} images/s, {tokens / seconds:.1f} tokens/s")
+
+class CaptionGenerator:
+    def __init__(self, model_store=None, tuning=None):
+        self.model_store = model_store or ModelStore()
+        self.load_lock = threading.Lock()
+        self.last_loaded = None
+        self.fixed_tuning = tuning
+        self.tuning = tuning or TuningConfig(DEFAULT_BATCH_SIZE)
+        self.stats = GenerationStats()
+
+    def load_model(self, model_repo, revision="main"):
+        with self.load_lock:
+            if self.last_loaded != (model_repo, revision):
+                self._load_model(model_repo, revision)
+
+    def _load_model(self, model_repo, revision):
+        tokenizer_path, *model_paths = self.model_store.resolve(model_repo, revision, files=CAPTIONER_FILES)
+        self.tokenizer = load_tokenizer(tokenizer_path)
+        self.tuning = (self.fixed_tuning or TuningStore.for_store(self.model_store).get(model_repo, revision)
+                       or TuningConfig(DEFAULT_BATCH_SIZE))
+        options = self.tuning.session_options()
+        self.vision_encoder, self.embed_tokens, self.encoder, self.decoder = [
+            rt.InferenceSession(model_path, options) for model_path in model_paths]
+
+        size = self.vision_encoder.get_inputs()[0].shape[2]
+        self.image_size = size if isinstance(size, int) else DEFAULT_IMAGE_SIZE
+        decoder_inputs = {decoder_input.name: decoder_input for decoder_input in self.decoder.get_inputs()}
+        # (batch, heads, length, head size), heads and head size are fixed in the export
+        self.past_shapes = {name: decoder_input.shape for name, decoder_input in decoder_inputs.items()
+                            if name.startswith("past_key_values.")}
+        self.use_cache_input = "use_cache_branch" in decoder_inputs
+        self.decoder_outputs = [output.name for output in self.decoder.get_outputs()]
+        self.device = self.decoder.get_providers()[0]
+        self.bos_id, self.eos_id, self.pad_id = [self.tokenizer.token_to_id(token) for token in ("<s>", "</s>", "<pad>")]
+        self.last_loaded = (model_repo, revision)
+
+    def prepare_image(self, image_path):
+        image = Image.open(image_path)
+        size = self.image_size
+        if image.format == "JPEG":
+            image.draft("RGB", (size, size))
+
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        if has_alpha:
+            canvas = Image.new("RGBA", image.size, (255, 255, 255))
+            canvas.alpha_composite(image)
+            image = canvas.convert("RGB")
+
+        # Stretched to a square without padding, as the Florence-2 processor does
+        image = image.resize((size, size), Image.BICUBIC, reducing_gap=3.0)
+        image_array = (np.asarray(image, dtype=np.float32) / 255 - IMAGE_MEAN) / IMAGE_STD
+        return image_array.transpose(2, 0, 1)[None]
+
+    def embed(self, token_ids):
+        return self.embed_tokens.run(None, {self.embed_tokens.get_inputs()[0].name: token_ids})[0]
+
+    def encode(self, images, task):
+        prompt_ids = np.array([self.tokenizer.encode(TASK_PROMPTS.get(task, task)).ids], dtype=np.int64)
+        image_features = self.vision_encoder.run(None, {self.vision_encoder.get_inputs()[0].name: images})[0]
+        inputs_embeds = np.concatenate([image_features, self.embed(np.repeat(prompt_ids, len(images), axis=0))], axis=1)
+        attention_mask = np.ones(inputs_embeds.shape[:2], dtype=np.int64)
+        hidden_states = self.encoder.run(None, {"inputs_embeds": inputs_embeds, "attention_mask": attention_mask})[0]
+        return hidden_states, attention_mask
+
+    def generate(self, images, task, max_tokens):
+        # Greedy decoding for a batch of images stacked from prepare_image. Each step feeds only the
+        # newest token, attention over earlier tokens comes from the key/value cache
+        start = time.perf_counter()
+        hidden_states, attention_mask = self.encode(images, task)
+        batch = len(images)
+        past = {name: np.zeros((batch, shape[1], 0, shape[3]), dtype=np.float32) for name, shape in self.past_shapes.items()}
+        sequences = [[] for _ in range(batch)]
+        finished = np.zeros(batch, dtype=bool)
+        tokens = np.full((batch, 1), self.eos_id, dtype=np.int64)  # BART-style decoders start from </s>
+        for step in range(max_tokens):
+            feeds = {"inputs_embeds": self.embed(tokens), "encoder_hidden_states": hidden_states,
+                     "encoder_attention_mask": attention_mask, **past}
+            if self.use_cache_input:
+                feeds["use_cache_branch"] = np.array([step > 0])
+            outputs = dict(zip(self.decoder_outputs, self.decoder.run(self.decoder_outputs, feeds)))
+            for name in past:
+                # Self-attention entries grow by a token per step; the cross-attention ones only depend on
+                # the encoder output, so they are computed on the first step and reused after that
+                if step == 0 or ".decoder." in name:
+                    past[name] = outputs[name.replace("past_key_values", "present")]
+
+            if step == 0:
+                next_tokens = np.full(batch, self.bos_id, dtype=np.int64)  # forced_bos_token_id
+            else:
+                logits = outputs["logits"][:, -1, :]
+                for row, sequence in enumerate(sequences):
+                    logits[row, banned_tokens(sequence, NO_REPEAT_NGRAM_SIZE)] = -np.inf
+                next_tokens = logits.argmax(axis=-1)
+            next_tokens[finished] = self.pad_id
+            for row in np.flatnonzero(~finished):
+                sequences[row].append(int(next_tokens[row]))
+            finished |= next_tokens == self.eos_id
+            if finished.all():
+                break
+            tokens = next_tokens[:, None]
+
+        self.stats.record(batch, sum(map(len, sequences)), time.perf_counter() - start)
+        return [self.tokenizer.decode(sequence, skip_special_tokens=True).strip() for sequence in sequences]
+
+    def run_many(self, image_paths, model_repo, revision, task, max_tokens):
+        # Yields (caption, error) per image, in order. Images are decoded on decode_workers threads while
+        # the previous batch generates, an unreadable image only fails its own entry
+        self.load_model(model_repo, revision)
+        batch_size = self.tuning.batch_size
+        paths = iter(image_paths)
+        pending = deque()
+        pool = ThreadPoolExecutor(max_workers=self.tuning.decode_workers)
+
+        def fill():
+            while len(pending) < 2 * batch_size + self.tuning.decode_workers:
+                image_path = next(paths, None)
+                if image_path is None:
+                    return
+                pending.append(pool.submit(self.prepare_image, image_path))
+
+        try:
+            fill()
+            while pending:
+                batch = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+                fill()
+                images, errors = [], []
+                for future in batch:
+                    try:
+                        images.append(future.result())
+                        errors.append(None)
+                    except Exception as e:
+                        errors.append(e)
+                captions = iter(self.generate(np.concatenate(images), task, max_tokens) if images else [])
+                for error in errors:
+                    yield (None, error) if error else (next(captions), None)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+class ImageCaptioner:
+    def __init__(self, generator=None):
+        self.generator = generator or CaptionGenerator()
+        # name: (repo, branch), pinned to a commit in model_pins.json as in ImageTagger.models
+        self.models = {
+            "Florence_2_Base": ("onnx-community/Florence-2-base-ft", "main"),
+            "Florence_2_Large": ("onnx-community/Florence-2-large-ft", "main"),
+        }
+        self.pins = load_pins()
+
+    def model_spec(self, model):
+        if model not in self.models:
+            raise KeyError(f"Unknown captioner model {model!r}, expected one of {', '.join(self.models)}")
+        model_repo, branch = self.models[model]
+        return model_repo, pinned_revision(model_repo, branch, self.pins)
+
+    def preload(self, model="Florence_2_Base"):
+        self.generator.load_model(*self.model_spec(model))
+
+    def caption_image(self, image_path, model="Florence_2_Base", task="<MORE_DETAILED_CAPTION>", max_tokens=256):
+        self.preload(model)
+        return self.generator.generate(self.generator.prepare_image(image_path), task, max_tokens)[0]
+
+    def caption_images(self, image_paths, model="Florence_2_Base", task="<MORE_DETAILED_CAPTION>", max_tokens=256):
+        # Batched caption_image, a caption per image or the exception for an image that couldn't be read
+        results = self.generator.run_many(image_paths, *self.model_spec(model), task, max_tokens)
+        return [error or caption for caption, error in results]
+
+    def summary(self, before):
+        # Throughput since an earlier stats snapshot
+        return summarize_generation(before, self.generator.stats.snapshot(), getattr(self.generator, "device", "CPU"))
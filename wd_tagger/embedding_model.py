@@ -0,0 +1,42 @@
+import os
+from pathlib import Path
+
+EMBEDDING_MODEL_FILENAME = "model_embed.onnx"
+HEAD_OPS = {"MatMul", "Gemm"}
+# Ops allowed between the classifier head and the graph output (bias, activation, reshapes)
+PASSTHROUGH_OPS = {"Add", "Sigmoid", "Identity", "Reshape", "Squeeze", "Flatten", "Cast"}
+
+def find_embedding_output(graph):
+    # The pooled features are whatever feeds the classifier head, found by walking back from the output
+    producers = {output: node for node in graph.node for output in node.output}
+    constants = {initializer.name for initializer in graph.initializer}
+    constants |= {node.output[0] for node in graph.node if node.op_type == "Constant"}
+    name = graph.output[0].name
+    while name in producers:
+        node = producers[name]
+        inputs = [input_name for input_name in node.input if input_name and input_name not in constants]
+        if node.op_type in HEAD_OPS and inputs:
+            return inputs[0]
+        if node.op_type not in PASSTHROUGH_OPS or len(inputs) != 1:
+            break
+        name = inputs[0]
+    raise ValueError("Could not find the classifier head in the model graph")
+
+def derive_embedding_model(model_path, model_dir):
+    # Same graph with the head's input exposed as a second output, written once next to the store entry
+    derived_path = Path(model_dir) / EMBEDDING_MODEL_FILENAME
+    if derived_path.exists() and derived_path.stat().st_mtime >= os.stat(model_path).st_mtime:
+        return str(derived_path)
+    try:
+        import onnx
+    except ImportError:
+        raise RuntimeError("Extracting embeddings needs the onnx package (pip install onnx)") from None
+
+    model = onnx.load(model_path)
+    name = find_embedding_output(model.graph)
+    model.graph.output.append(onnx.helper.make_tensor_value_info(name, onnx.TensorProto.FLOAT, None))
+    derived_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = derived_path.with_name(derived_path.name + ".tmp")
+    onnx.save(model, str(tmp_path))
+    os.replace(tmp_path, derived_path)
+    return str(derived_path)
@@ -0,0 +1,117 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import huggingface_hub
+from huggingface_hub.utils import LocalEntryNotFoundError
+
+MODEL_FILENAME = "model.onnx"
+LABEL_FILENAME = "selected_tags.csv"
+MODEL_FILES = (LABEL_FILENAME, MODEL_FILENAME)
+MANIFEST_FILENAME = "manifest.json"
+# Checked in next to the code, so every checkout fetches the same weights for a model name
+PINS_PATH = Path(__file__).with_name("model_pins.json")
+
+def default_store_root():
+    return Path(os.environ.get("WD_TAGGER_MODEL_DIR", Path.home() / ".cache" / "wd_tagger" / "models"))
+
+def offline_only():
+    return os.environ.get("WD_TAGGER_OFFLINE") == "1" or os.environ.get("HF_HUB_OFFLINE") == "1"
+
+def load_pins(path=PINS_PATH):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_pins(pins, path=PINS_PATH):
+    tmp_path = Path(f"{path}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(dict(sorted(pins.items())), f, indent=2)
+        f.write("\n")
+    os.replace(tmp_path, path)
+
+def pinned_revision(model_repo, branch, pins):
+    # The commit a model table's branch is pinned to, or the branch itself until `wd_tagger pin` has run
+    return pins.get(f"{model_repo}@{branch}", branch)
+
+class ModelStore:
+    def __init__(self, root=None):
+        self.root = Path(root) if root else default_store_root()
+
+    def model_dir(self, model_repo, revision):
+        return self.root / model_repo.replace("/", "--") / revision
+
+    # files defaults to a tagger's; captioners keep several graphs and a tokenizer, some in subfolders
+    def find(self, model_repo, revision, files=MODEL_FILES):
+        model_dir = self.model_dir(model_repo, revision)
+        paths = [model_dir / filename for filename in files]
+        if all(path.exists() for path in paths):
+            return tuple(str(path) for path in paths)
+        return None
+
+    def find_in_hf_cache(self, model_repo, revision, files=MODEL_FILES):
+        # Files fetched by older versions live in the huggingface cache, reuse them without a network check
+        try:
+            return tuple(
+                huggingface_hub.hf_hub_download(model_repo, filename, revision=revision, local_files_only=True)
+                for filename in files
+            )
+        except LocalEntryNotFoundError:
+            return None
+
+    def resolve(self, model_repo, revision, allow_download=True, files=MODEL_FILES):
+        paths = self.find(model_repo, revision, files) or self.find_in_hf_cache(model_repo, revision, files)
+        if paths:
+            return paths
+        if not allow_download or offline_only():
+            raise FileNotFoundError(
+                f"{model_repo}@{revision} is not in the model store at {self.root}. "
+                "Run `python -m wd_tagger prefetch` or `python -m wd_tagger import` first."
+            )
+        return self.prefetch(model_repo, revision, files)
+
+    def prefetch(self, model_repo, revision, files=MODEL_FILES):
+        model_dir = self.model_dir(model_repo, revision)
+        # Resolved once, so a branch moving mid-download can't mix files from two commits
+        commit = huggingface_hub.model_info(model_repo, revision=revision).sha
+        for filename in files:
+            huggingface_hub.hf_hub_download(model_repo, filename, revision=commit, local_dir=model_dir)
+        self.write_manifest(model_dir, model_repo, revision, source="huggingface", commit=commit, files=files)
+        return self.find(model_repo, revision, files)
+
+    def import_files(self, model_repo, revision, source_dir, files=MODEL_FILES):
+        source_dir = Path(source_dir)
+        for filename in files:
+            if not (source_dir / filename).exists():
+                raise FileNotFoundError(f"{source_dir / filename} not found")
+
+        model_dir = self.model_dir(model_repo, revision)
+        for filename in files:
+            # Copy then rename so an interrupted import never looks complete to find()
+            (model_dir / filename).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = model_dir / (filename + ".tmp")
+            shutil.copyfile(source_dir / filename, tmp_path)
+            os.replace(tmp_path, model_dir / filename)
+        self.write_manifest(model_dir, model_repo, revision, source=str(source_dir), files=files)
+        return self.find(model_repo, revision, files)
+
+    def write_manifest(self, model_dir, model_repo, revision, source, commit=None, files=MODEL_FILES):
+        manifest = {
+            "repo": model_repo,
+            "revision": revision,
+            "commit": commit,
+            "source": source,
+            "files": {filename: (model_dir / filename).stat().st_size for filename in files},
+        }
+        with open(model_dir / MANIFEST_FILENAME, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def list_models(self):
+        manifests = []
+        for manifest_path in sorted(self.root.glob(f"*/*/{MANIFEST_FILENAME}")):
+            with open(manifest_path) as f:
+                manifests.append(json.load(f))
+        return manifests
@@ -0,0 +1,285 @@
+import http.client
+import http.server
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import numpy as np
+
+from .model_store import ModelStore
+from .tagger import Predictor
+from .tuning import TuningConfig
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_BATCH = 8
+DEFAULT_MAX_WAIT = 0.01  # seconds the first request of a batch waits for company
+PROBABILITIES_PATH = "/v1/probabilities"
+HEALTH_PATH = "/v1/health"
+
+class PendingRequest:
+    def __init__(self, image, embedding):
+        self.image = image
+        self.embedding = embedding
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher:
+    # One per loaded model. Requests arriving within max_wait of the first one share a single session.run,
+    # images are prepared on the callers' threads so only inference is serialised here
+    def __init__(self, model_repo, revision, model_store=None, max_batch=DEFAULT_MAX_BATCH, max_wait=DEFAULT_MAX_WAIT):
+        self.model_repo = model_repo
+        self.revision = revision
+        self.predictor = Predictor(model_store)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.requests = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image_path, embedding=False):
+        self.predictor.load_model(self.model_repo, self.revision)
+        request = PendingRequest(self.predictor.prepare_image(image_path), embedding)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error:
+            raise request.error
+        return request.result
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                return
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    request = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.queue.put(None)  # finish this batch, stop on the next loop
+                    break
+                batch.append(request)
+            self.process(batch)
+
+    def process(self, batch):
+        embedding = any(request.embedding for request in batch)
+        try:
+            self.predictor.load_model(self.model_repo, self.revision, embeddings=embedding)
+            probs, embeddings = self.predictor.run_batch(np.concatenate([request.image for request in batch]), embedding)
+        except Exception as e:
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+        self.requests += len(batch)
+        self.batches += 1
+        for i, request in enumerate(batch):
+            request.result = (probs[i], embeddings[i] if request.embedding else None)
+            request.done.set()
+
+    def stats(self):
+        return {"requests": self.requests, "batches": self.batches,
+                "mean_batch": round(self.requests / self.batches, 2) if self.batches else 0}
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class TaggingService:
+    # Holds every model once, however many labelers talk to it
+    def __init__(self, model_store=None, max_batch=DEFAULT_MAX_BATCH, max_wait=DEFAULT_MAX_WAIT):
+        self.model_store = model_store or ModelStore()
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batchers = {}
+        self.lock = threading.Lock()
+
+    def batcher(self, model_repo, revision):
+        with self.lock:
+            if (model_repo, revision) not in self.batchers:
+                self.batchers[model_repo, revision] = MicroBatcher(model_repo, revision, self.model_store,
+                                                                   self.max_batch, self.max_wait)
+            return self.batchers[model_repo, revision]
+
+    def probabilities(self, image_path, model_repo, revision="main", embedding=False):
+        return self.batcher(model_repo, revision).submit(image_path, embedding)
+
+    def health(self):
+        with self.lock:
+            return {"models": {f"{repo}@{revision}": batcher.stats() for (repo, revision), batcher in self.batchers.items()}}
+
+    def close(self):
+        with self.lock:
+            for batcher in self.batchers.values():
+                batcher.close()
+            self.batchers = {}
+
+class TaggingRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, clients hold one connection per thread
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != HEALTH_PATH:
+            return self.send_json(404, {"error": f"unknown path {self.path}"})
+        self.send_json(200, self.server.service.health())
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != PROBABILITIES_PATH:
+            return self.send_json(404, {"error": f"unknown path {self.path}"})
+        try:
+            request = json.loads(body)
+            probs, embedding = self.server.service.probabilities(
+                request["image_path"], request["model_repo"], request.get("revision", "main"), request.get("embedding", False))
+        except (OSError, ValueError, KeyError) as e:  # unreadable image or malformed request
+            return self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            return self.send_json(500, {"error": str(e)})
+
+        # Raw float32 rows, thresholding is up to the client
+        payload = probs.astype(np.float32).tobytes()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("X-Tag-Count", str(len(probs)))
+        if embedding is not None:
+            payload += embedding.astype(np.float32).tobytes()
+            self.send_header("X-Embedding-Dim", str(len(embedding)))
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class UnixTaggingRequestHandler(TaggingRequestHandler):
+    disable_nagle_algorithm = False  # TCP_NODELAY doesn't apply to Unix sockets
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, address):
+    # address is "unix:/path/to.sock" or "host:port"
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)  # left behind by a server that didn't shut down cleanly
+        server = ThreadingUnixHTTPServer(path, UnixTaggingRequestHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port or DEFAULT_PORT)), TaggingRequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+class TaggingClient:
+    def __init__(self, address, timeout=120):
+        # "unix:/path/to.sock", "http://host:port" or plain "host:port"
+        self.address = address
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connect(self):
+        if self.address.startswith("unix:"):
+            return UnixHTTPConnection(self.address[len("unix:"):], self.timeout)
+        url = urlparse(self.address if "://" in self.address else f"http://{self.address}")
+        return http.client.HTTPConnection(url.hostname, url.port or DEFAULT_PORT, timeout=self.timeout)
+
+    def request(self, method, path, body=None):
+        for attempt in range(2):
+            connection = getattr(self.local, "connection", None) or self.connect()
+            self.local.connection = connection
+            try:
+                connection.request(method, path, body, {"Content-Type": "application/json"} if body else {})
+                response = connection.getresponse()
+                return response, response.read()
+            except (ConnectionError, http.client.HTTPException):
+                # A kept-alive connection the server has since dropped, retry once on a fresh one
+                connection.close()
+                self.local.connection = None
+                if attempt:
+                    raise
+
+    def probabilities(self, image_path, model_repo, revision="main", embedding=False):
+        body = json.dumps({"image_path": os.path.abspath(image_path), "model_repo": model_repo,
+                           "revision": revision, "embedding": embedding}).encode("utf-8")
+        response, payload = self.request("POST", PROBABILITIES_PATH, body)
+        if response.status != 200:
+            raise RuntimeError(f"Tagging server: {json.loads(payload).get('error', response.reason)}")
+        values = np.frombuffer(payload, dtype=np.float32)
+        tag_count = int(response.getheader("X-Tag-Count"))
+        return values[:tag_count], values[tag_count:] if response.getheader("X-Embedding-Dim") else None
+
+    def health(self):
+        response, payload = self.request("GET", HEALTH_PATH)
+        return json.loads(payload)
+
+class RemotePredictor(Predictor):
+    # Thresholding and tag tables stay in the labeler, the server only runs the model
+    def __init__(self, address, model_store=None):
+        # Enough requests in flight to fill one of the server's micro-batches, host tuning applies server-side
+        super().__init__(model_store, TuningConfig(batch_size=DEFAULT_MAX_BATCH))
+        self.client = TaggingClient(address)
+        self.pool = ThreadPoolExecutor(max_workers=DEFAULT_MAX_BATCH)  # long-lived, so connections are reused
+
+    def load_model(self, model_repo, revision="main", embeddings=False):
+        with self.load_lock:
+            if model_repo == self.last_loaded_repo and revision == self.last_loaded_revision:
+                return
+            csv_path, _ = self.model_store.resolve(model_repo, revision, allow_download=False)
+            self.load_tags(csv_path, model_repo, revision)
+            self.last_loaded_repo = model_repo
+            self.last_loaded_revision = revision
+
+    def check_tiling(self, tiling):
+        if tiling is not None:
+            raise RuntimeError("Tiled tagging runs the model in this process, turn it off or the tagging server")
+
+    def probabilities(self, image_path, model_repo, revision="main", tiling=None):
+        self.check_tiling(tiling)
+        self.load_model(model_repo, revision)
+        return self.client.probabilities(image_path, model_repo, revision)[0]
+
+    def features(self, image_path, model_repo, revision="main", tiling=None):
+        self.check_tiling(tiling)
+        self.load_model(model_repo, revision)
+        return self.client.probabilities(image_path, model_repo, revision, embedding=True)
+
+    def run_many(self, image_paths, model_repo, revision="main", embeddings=False, tiling=None):
+        self.check_tiling(tiling)
+        self.load_model(model_repo, revision)
+
+        def fetch(image_path):
+            try:
+                return (*self.client.probabilities(image_path, model_repo, revision, embeddings), None)
+            except (OSError, RuntimeError) as e:
+                return None, None, e
+
+        yield from self.pool.map(fetch, image_paths)
@@ -0,0 +1,78 @@
+import csv
+import os
+from pathlib import Path
+
+import numpy as np
+
+CATEGORIES_FILENAME = "categories.npy"
+OFFSETS_FILENAME = "offsets.npy"
+NAMES_FILENAME = "names.bin"
+
+RATING_CATEGORY = 9
+GENERAL_CATEGORY = 0
+CHARACTER_CATEGORY = 4
+
+kaomojis = [
+    "0_0", "(o)_(o)", "+_+", "+_-", "._.", "<o>_<o>", "<|>_<|>", "=_=", ">_<",
+    "3_3", "6_9", ">_o", "@_@", "^_^", "o_o", "u_u", "x_x", "|_|", "||_||",
+]
+
+def display_name(name):
+    return name.replace("_", " ") if name not in kaomojis else name
+
+def compile_tag_table(csv_path, table_dir):
+    names = []
+    categories = []
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            names.append(display_name(row["name"]).encode("utf-8"))
+            categories.append(int(row["category"]))
+
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in names], out=offsets[1:])
+
+    table_dir = Path(table_dir)
+    table_dir.mkdir(parents=True, exist_ok=True)
+    # Names are written last so an interrupted compile is caught by is_stale()
+    np.save(table_dir / CATEGORIES_FILENAME, np.array(categories, dtype=np.uint8))
+    np.save(table_dir / OFFSETS_FILENAME, offsets)
+    tmp_path = table_dir / (NAMES_FILENAME + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(b"".join(names))
+    os.replace(tmp_path, table_dir / NAMES_FILENAME)
+
+def is_stale(csv_path, table_dir):
+    names_path = Path(table_dir) / NAMES_FILENAME
+    return not names_path.exists() or names_path.stat().st_mtime < os.stat(csv_path).st_mtime
+
+class TagTable:
+    def __init__(self, categories, offsets, names):
+        self.categories = categories
+        self.offsets = offsets
+        self.names = names
+
+    @classmethod
+    def load(cls, table_dir):
+        table_dir = Path(table_dir)
+        categories = np.load(table_dir / CATEGORIES_FILENAME, mmap_mode="r")
+        offsets = np.load(table_dir / OFFSETS_FILENAME, mmap_mode="r")
+        if offsets[-1] > 0:
+            names = np.memmap(table_dir / NAMES_FILENAME, dtype=np.uint8, mode="r")
+        else:  # np.memmap refuses empty files
+            names = np.zeros(0, dtype=np.uint8)
+        return cls(categories, offsets, names)
+
+    @classmethod
+    def from_csv(cls, csv_path, table_dir):
+        if is_stale(csv_path, table_dir):
+            compile_tag_table(csv_path, table_dir)
+        return cls.load(table_dir)
+
+    def __len__(self):
+        return len(self.categories)
+
+    def name(self, index):
+        return self.names[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8")
+
+    def indexes(self, category):
+        return np.flatnonzero(self.categories == category)
@@ -1,29 +1,15 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import onnxruntime as rt
-import pandas as pd
 from PIL import Image
-import huggingface_hub
 from pathlib import Path
-
-MODEL_FILENAME = "model.onnx"
-LABEL_FILENAME = "selected_tags.csv"
-
-kaomojis = [
-    "0_0", "(o)_(o)", "+_+", "+_-", "._.", "<o>_<o>", "<|>_<|>", "=_=", ">_<",
-    "3_3", "6_9", ">_o", "@_@", "^_^", "o_o", "u_u", "x_x", "|_|", "||_||",
-]
-
-def load_labels(dataframe):
-    name_series = dataframe["name"]
-    name_series = name_series.map(
-        lambda x: x.replace("_", " ") if x not in kaomojis else x
-    )
-    tag_names = name_series.tolist()
-
-    rating_indexes = list(np.where(dataframe["category"] == 9)[0])
-    general_indexes = list(np.where(dataframe["category"] == 0)[0])
-    character_indexes = list(np.where(dataframe["category"] == 4)[0])
-    return tag_names, rating_indexes, general_indexes, character_indexes
+from .embedding_model import derive_embedding_model
+from .model_store import ModelStore, load_pins, pinned_revision
+from .tag_table import TagTable, RATING_CATEGORY, GENERAL_CATEGORY, CHARACTER_CATEGORY
+from .tiling import TilingStats, merge_probabilities, tile_boxes
+from .tuning import TuningConfig, TuningStore
 
 def mcut_threshold(probs):
     sorted_probs = probs[probs.argsort()[::-1]]
@@ -33,101 +19,238 @@ def mcut_threshold(probs):
     return thresh
 
 class Predictor:
-    def __init__(self):
+    def __init__(self, model_store=None, tuning=None):
         self.model_target_size = None
         self.last_loaded_repo = None
-
-    def download_model(self, model_repo):
-        csv_path = huggingface_hub.hf_hub_download(
-            model_repo,
-            LABEL_FILENAME,
-        )
-        model_path = huggingface_hub.hf_hub_download(
-            model_repo,
-            MODEL_FILENAME,
-        )
-        return csv_path, model_path
-
-    def load_model(self, model_repo):
-        if model_repo == self.last_loaded_repo:
-            return
-
-        csv_path, model_path = self.download_model(model_repo)
-
-        tags_df = pd.read_csv(csv_path)
-        sep_tags = load_labels(tags_df)
-
-        self.tag_names = sep_tags[0]
-        self.rating_indexes = sep_tags[1]
-        self.general_indexes = sep_tags[2]
-        self.character_indexes = sep_tags[3]
-
-        model = rt.InferenceSession(model_path)
+        self.last_loaded_revision = None
+        self.embedding_output = None
+        self.model_store = model_store or ModelStore()
+        self.load_lock = threading.Lock()
+        # A fixed configuration (autotune trials) or the one tuned for this host, looked up per model
+        self.fixed_tuning = tuning
+        self.tuning = tuning or TuningConfig()
+        self.tiling_stats = TilingStats()
+
+    def download_model(self, model_repo, revision="main"):
+        return self.model_store.resolve(model_repo, revision)
+
+    def load_model(self, model_repo, revision="main", embeddings=False):
+        with self.load_lock:
+            if (model_repo == self.last_loaded_repo and revision == self.last_loaded_revision
+                    and (self.embedding_output or not embeddings)):
+                return
+            self._load_model(model_repo, revision, embeddings)
+
+    def _load_model(self, model_repo, revision, embeddings=False):
+        csv_path, model_path = self.download_model(model_repo, revision)
+        if embeddings:
+            # The derived graph also serves plain tagging, so the session is only swapped once
+            model_path = derive_embedding_model(model_path, self.model_store.model_dir(model_repo, revision))
+
+        self.load_tags(csv_path, model_repo, revision)
+
+        self.tuning = self.fixed_tuning or TuningStore.for_store(self.model_store).get(model_repo, revision) or TuningConfig()
+        model = rt.InferenceSession(model_path, self.tuning.session_options())
         _, height, width, _ = model.get_inputs()[0].shape
         self.model_target_size = height
 
-        self.last_loaded_repo = model_repo
         self.model = model
+        self.embedding_output = model.get_outputs()[1].name if embeddings else None
+        self.last_loaded_repo = model_repo
+        self.last_loaded_revision = revision
+
+    def load_tags(self, csv_path, model_repo, revision):
+        # Compiled once per model next to the store entry, memory-mapped on every later load
+        tag_table = TagTable.from_csv(csv_path, self.model_store.model_dir(model_repo, revision) / "tag_table")
+
+        self.tag_table = tag_table
+        self.rating_indexes = tag_table.indexes(RATING_CATEGORY)
+        self.general_indexes = tag_table.indexes(GENERAL_CATEGORY)
+        self.character_indexes = tag_table.indexes(CHARACTER_CATEGORY)
+        self.tag_positions = None
+
+    def fit_size(self, width, height):
+        max_dim = max(width, height)
+        return (
+            max(1, round(width * self.model_target_size / max_dim)),
+            max(1, round(height * self.model_target_size / max_dim)),
+        )
 
     def prepare_image(self, image_path):
-        image = Image.open(image_path).convert("RGBA")
-        target_size = self.model_target_size
+        image = Image.open(image_path)
+        return self.pad_square(self.load_scaled(image, self.fit_size(*image.size)))
 
-        canvas = Image.new("RGBA", image.size, (255, 255, 255))
-        canvas.alpha_composite(image)
-        image = canvas.convert("RGB")
+    def load_scaled(self, image, new_size):
+        # Scale down before compositing and padding so no full-size canvases get allocated
+        if image.format == "JPEG" and new_size[0] < image.size[0]:
+            image.draft("RGB", new_size)  # let libjpeg decode at a reduced DCT scale
 
-        image_shape = image.size
-        max_dim = max(image_shape)
-        pad_left = (max_dim - image_shape[0]) // 2
-        pad_top = (max_dim - image_shape[1]) // 2
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        mode = "RGBA" if has_alpha else "RGB"
+        if image.mode != mode:
+            image = image.convert(mode)
 
-        padded_image = Image.new("RGB", (max_dim, max_dim), (255, 255, 255))
-        padded_image.paste(image, (pad_left, pad_top))
+        if image.size != new_size:
+            image = image.resize(new_size, Image.BICUBIC, reducing_gap=3.0)
 
-        if max_dim != target_size:
-            padded_image = padded_image.resize(
-                (target_size, target_size),
-                Image.BICUBIC,
-            )
+        if has_alpha:
+            canvas = Image.new("RGBA", image.size, (255, 255, 255))
+            canvas.alpha_composite(image)
+            image = canvas.convert("RGB")
+        return image
 
-        image_array = np.asarray(padded_image, dtype=np.float32)
-        image_array = image_array[:, :, ::-1]
-
-        return np.expand_dims(image_array, axis=0)
+    def pad_square(self, image):
+        target_size = self.model_target_size
+        width, height = image.size
+        pad_left = (target_size - width) // 2
+        pad_top = (target_size - height) // 2
 
-    def predict(self, image_path, model_repo, general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled):
-        self.load_model(model_repo)
+        image_array = np.full((1, target_size, target_size, 3), 255, dtype=np.float32)
+        image_array[0, pad_top:pad_top + height, pad_left:pad_left + width] = np.asarray(image)[:, :, ::-1]
 
-        image = self.prepare_image(image_path)
+        return image_array
 
+    def prepare_views(self, image_path, tiling=None):
+        # The padded global view, then with tiling an input per overlapping crop. The image is decoded and
+        # scaled once, to where a crop is the model's input size
+        if tiling is None:
+            return self.prepare_image(image_path)
+        image = Image.open(image_path)
+        target_size = self.model_target_size
+        width, height = image.size
+        boxes = tile_boxes(width, height, target_size, tiling.grid, tiling.overlap)
+        if not boxes:
+            return self.pad_square(self.load_scaled(image, self.fit_size(width, height)))
+        scale = min(1.0, target_size / (boxes[0][2] - boxes[0][0]))
+        scaled = self.load_scaled(image, (max(1, round(width * scale)), max(1, round(height * scale))))
+        views = [self.pad_square(scaled.resize(self.fit_size(width, height), Image.BICUBIC, reducing_gap=3.0))]
+        for box in boxes:
+            tile = scaled.crop(tuple(round(edge * scale) for edge in box))
+            if tile.size != (target_size, target_size):
+                tile = tile.resize((target_size, target_size), Image.BICUBIC)
+            views.append(self.pad_square(tile))
+        return np.concatenate(views)
+
+    def merge_views(self, probs, tiling):
+        # One row of probabilities from the rows of prepare_views
+        if tiling is None:
+            return probs[0]
+        self.tiling_stats.record(1, len(probs))
+        if len(probs) == 1:
+            return probs[0]
+        return merge_probabilities(probs, tiling.merge, self.rating_indexes)
+
+    def run_batch(self, images, embeddings=False):
+        # images stacked from prepare_image, one row of probabilities (and embedding) per image
         input_name = self.model.get_inputs()[0].name
-        label_name = self.model.get_outputs()[0].name
-        preds = self.model.run([label_name], {input_name: image})[0]
-
-        labels = list(zip(self.tag_names, preds[0].astype(float)))
-
-        ratings_names = [labels[i] for i in self.rating_indexes]
-        rating = dict(ratings_names)
-
-        general_names = [labels[i] for i in self.general_indexes]
+        output_names = [self.model.get_outputs()[0].name]
+        if embeddings:
+            output_names.append(self.embedding_output)
+        outputs = self.model.run(output_names, {input_name: images})
+        return outputs[0], outputs[1].reshape(len(images), -1) if embeddings else None
+
+    def run_many(self, image_paths, model_repo, revision="main", embeddings=False, tiling=None):
+        # Yields (probs, embedding, error) per image, in order. Images are decoded on decode_workers
+        # threads while the previous batch runs, an unreadable image only fails its own entry. With tiling
+        # every view of the batch's images goes through the same session run
+        self.load_model(model_repo, revision, embeddings)
+        batch_size = self.tuning.batch_size
+        paths = iter(image_paths)
+        pending = deque()
+        pool = ThreadPoolExecutor(max_workers=self.tuning.decode_workers)
+
+        def fill():
+            # Bounded read-ahead, a whole shard of decoded images would not fit in memory
+            while len(pending) < 2 * batch_size + self.tuning.decode_workers:
+                image_path = next(paths, None)
+                if image_path is None:
+                    return
+                pending.append(pool.submit(self.prepare_views, image_path, tiling))
+
+        try:
+            fill()
+            while pending:
+                batch = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+                fill()
+                images, errors = [], []
+                for future in batch:
+                    try:
+                        images.append(future.result())
+                        errors.append(None)
+                    except Exception as e:
+                        errors.append(e)
+                if images:
+                    probs, features = self.run_batch(np.concatenate(images), embeddings)
+                row = 0
+                views = iter(images)
+                for error in errors:
+                    if error:
+                        yield None, None, error
+                    else:
+                        count = len(next(views))
+                        # The embedding is the global view's, it describes the whole image
+                        yield self.merge_views(probs[row:row + count], tiling), features[row] if embeddings else None, None
+                        row += count
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def probabilities(self, image_path, model_repo, revision="main", tiling=None):
+        self.load_model(model_repo, revision)
+        return self.merge_views(self.run_batch(self.prepare_views(image_path, tiling))[0], tiling)
+
+    def features(self, image_path, model_repo, revision="main", tiling=None):
+        # Probabilities plus the pooled feature vector that feeds the classifier head
+        self.load_model(model_repo, revision, embeddings=True)
+        probs, embeddings = self.run_batch(self.prepare_views(image_path, tiling), embeddings=True)
+        return self.merge_views(probs, tiling), embeddings[0]
+
+    def tag_confidences(self, image_path, tags, model_repo, revision="main"):
+        # Tags the model doesn't know (trigger words, hand written ones) come back as None
+        probs = self.probabilities(image_path, model_repo, revision)
+        if self.tag_positions is None:
+            self.tag_positions = {self.tag_table.name(i): i for i in range(len(self.tag_table))}
+        positions = [self.tag_positions.get(tag.replace("\\(", "(").replace("\\)", ")")) for tag in tags]
+        return [None if position is None else float(probs[position]) for position in positions]
+
+    def predict(self, image_path, model_repo, general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled, revision="main",
+                on_probabilities=None, on_embedding=None, tiling=None):
+        if on_embedding:
+            probs, embedding = self.features(image_path, model_repo, revision, tiling)
+            on_embedding(embedding)
+        else:
+            probs = self.probabilities(image_path, model_repo, revision, tiling)
+        if on_probabilities:
+            on_probabilities(probs, self.tag_table)
+        return self.interpret(probs, general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled)
+
+    def interpret(self, probs, general_thresh, general_mcut_enabled, character_thresh, character_mcut_enabled):
+        probs = probs.astype(float)
+        tag_name = self.tag_table.name
+
+        rating = {tag_name(i): probs[i] for i in self.rating_indexes}
+
+        general_probs = probs[self.general_indexes]
 
         if general_mcut_enabled:
-            general_probs = np.array([x[1] for x in general_names])
             general_thresh = mcut_threshold(general_probs)
 
-        general_res = [x for x in general_names if x[1] > general_thresh]
-        general_res = dict(general_res)
+        general_keep = general_probs > general_thresh
+        general_res = {
+            tag_name(i): prob
+            for i, prob in zip(self.general_indexes[general_keep], general_probs[general_keep])
+        }
 
-        character_names = [labels[i] for i in self.character_indexes]
+        character_probs = probs[self.character_indexes]
 
         if character_mcut_enabled:
-            character_probs = np.array([x[1] for x in character_names])
             character_thresh = mcut_threshold(character_probs)
             character_thresh = max(0.15, character_thresh)
 
-        character_res = [x for x in character_names if x[1] > character_thresh]
-        character_res = dict(character_res)
+        character_keep = character_probs > character_thresh
+        character_res = {
+            tag_name(i): prob
+            for i, prob in zip(self.character_indexes[character_keep], character_probs[character_keep])
+        }
 
         sorted_general_strings = sorted(
             general_res.items(),
@@ -140,30 +263,75 @@ class Predictor:
         return sorted_general_strings, rating, character_res, general_res
 
 class ImageTagger:
-    def __init__(self):
-        self.predictor = Predictor()
+    def __init__(self, predictor=None):
+        self.predictor = predictor or Predictor()
+        # name: (repo, branch). model_pins.json pins each branch to a commit, which selects the
+        # directory in the model store
         self.models = {
-            "swinv3": "SmilingWolf/wd-swinv2-tagger-v3",
-            "vitv3": "SmilingWolf/wd-vit-tagger-v3",
-            "vitv3-large": "SmilingWolf/wd-vit-large-tagger-v3",
-            "convnextv3": "SmilingWolf/wd-convnext-tagger-v3"
+            "swinv3": ("SmilingWolf/wd-swinv2-tagger-v3", "main"),
+            "vitv3": ("SmilingWolf/wd-vit-tagger-v3", "main"),
+            "vitv3-large": ("SmilingWolf/wd-vit-large-tagger-v3", "main"),
+            "convnextv3": ("SmilingWolf/wd-convnext-tagger-v3", "main")
         }
 
+        self.pins = load_pins()
+
+    def model_spec(self, model):
+        if model not in self.models:
+            raise KeyError(f"Unknown tagger model {model!r}, expected one of {', '.join(self.models)}")
+        model_repo, branch = self.models[model]
+        return model_repo, pinned_revision(model_repo, branch, self.pins)
+
+    def preload(self, model="vitv3"):
+        self.predictor.load_model(*self.model_spec(model))
+
+    def tag_confidences(self, image_path, tags, model="vitv3"):
+        model_repo, revision = self.model_spec(model)
+        return self.predictor.tag_confidences(image_path, tags, model_repo, revision)
+
     def tag_image(self, image_path, model="vitv3", general=True, rating=True, character=True,
                   general_threshold=0.35, character_threshold=0.85,
-                  general_mcut=False, character_mcut=False):
+                  general_mcut=False, character_mcut=False, on_probabilities=None, on_embedding=None, tiling=None):
         image_path = Path(image_path)
-        model_repo = self.models.get(model, self.models["vitv3"])
+        model_repo, revision = self.model_spec(model)
 
-        sorted_general_strings, rating_dict, character_res, general_res = self.predictor.predict(
+        prediction = self.predictor.predict(
             image_path,
             model_repo,
             general_threshold,
             general_mcut,
             character_threshold,
-            character_mcut
+            character_mcut,
+            revision,
+            on_probabilities,
+            on_embedding,
+            tiling
         )
-
+        return self.caption(prediction, general, rating, character)
+
+    def tag_images(self, image_paths, model="vitv3", general=True, rating=True, character=True,
+                   general_threshold=0.35, character_threshold=0.85,
+                   general_mcut=False, character_mcut=False, on_probabilities=None, on_embedding=None, tiling=None):
+        # Batched tag_image. Returns a caption per image, or the exception for an image that couldn't be
+        # read; the callbacks get the image path first. tiling is a TilingOptions, or None for a single pass
+        model_repo, revision = self.model_spec(model)
+        results = self.predictor.run_many(image_paths, model_repo, revision, embeddings=on_embedding is not None,
+                                          tiling=tiling)
+        captions = []
+        for image_path, (probs, embedding, error) in zip(image_paths, results):
+            if error:
+                captions.append(error)
+                continue
+            if on_embedding:
+                on_embedding(image_path, embedding)
+            if on_probabilities:
+                on_probabilities(image_path, probs, self.predictor.tag_table)
+            prediction = self.predictor.interpret(probs, general_threshold, general_mcut, character_threshold, character_mcut)
+            captions.append(self.caption(prediction, general, rating, character))
+        return captions
+
+    def caption(self, prediction, general, rating, character):
+        sorted_general_strings, rating_dict, character_res, general_res = prediction
         tag_parts = []
         
         if character:
@@ -0,0 +1,60 @@
+import math
+import threading
+import numpy as np
+
+MERGE_MODES = ("max", "mean")
+MIN_TILING_SCALE = 1.5  # images up to this multiple of the model's input size gain nothing from tiles
+
+class TilingOptions:
+    # Overlapping square crops, grid of them across the longer side, tagged in the same batch as the
+    # usual padded global view and merged per tag
+    def __init__(self, grid=2, overlap=0.25, merge="max"):
+        if merge not in MERGE_MODES:
+            raise ValueError(f"Tile merge must be one of {', '.join(MERGE_MODES)}")
+        if grid < 1 or not 0 <= overlap < 1:
+            raise ValueError("Tiling needs a grid of at least 1 and an overlap below 1")
+        self.grid = grid
+        self.overlap = overlap
+        self.merge = merge
+
+def tile_boxes(width, height, target_size, grid=2, overlap=0.25):
+    # (left, top, right, bottom) in source pixels, spread evenly so neighbours overlap by at least overlap.
+    # Tiles never go below the model's input size, so small images get none and cost a single pass
+    if max(width, height) < target_size * MIN_TILING_SCALE:
+        return []
+    side = min(width, height, max(target_size, round(max(width, height) / grid)))
+
+    def starts(length):
+        count = math.ceil(max(0, length - side) / (side * (1 - overlap))) + 1
+        return np.linspace(0, length - side, count).round().astype(int).tolist()
+
+    return [(left, top, left + side, top + side) for top in starts(height) for left in starts(width)]
+
+def merge_probabilities(probs, merge, global_indexes):
+    # probs has a row per view, the global view first. Tags in global_indexes (ratings) describe the
+    # whole image, so they come from the global view alone
+    merged = probs.max(axis=0) if merge == "max" else probs.mean(axis=0)
+    merged[global_indexes] = probs[0, global_indexes]
+    return merged
+
+class TilingStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images = 0
+        self.views = 0
+
+    def record(self, images, views):
+        with self.lock:
+            self.images += images
+            self.views += views
+
+    def snapshot(self):
+        with self.lock:
+            return self.images, self.views
+
+def summarize_tiling(before, after):
+    # Every view is one model input, so views per image is the cost relative to a single pass
+    images, views = (now - then for now, then in zip(after, before))
+    if not images:
+        return ""
+    return f"Tiling: {views} views for {images} images, {views / images:.1f}x the inference of a single pass"
@@ -0,0 +1,174 @@
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import onnxruntime as rt
+
+TUNING_FILENAME = "tuning.json"
+BATCH_SIZES = (1, 2, 4, 8, 16, 32)
+DECODE_WORKERS = (1, 2, 4, 8)
+BATCH_DROP = 0.95  # stop growing the batch once throughput falls below this share of the best so far
+
+class TuningConfig:
+    # 0 threads leaves the choice to onnxruntime
+    def __init__(self, batch_size=1, intra_op_threads=0, inter_op_threads=0, decode_workers=1):
+        self.batch_size = batch_size
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.decode_workers = decode_workers
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["batch_size"], data["intra_op_threads"], data["inter_op_threads"], data["decode_workers"])
+
+    def as_dict(self):
+        return {"batch_size": self.batch_size, "intra_op_threads": self.intra_op_threads,
+                "inter_op_threads": self.inter_op_threads, "decode_workers": self.decode_workers}
+
+    def session_options(self):
+        options = rt.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads > 1:
+            # Inter-op threads only run independent branches in parallel mode
+            options.execution_mode = rt.ExecutionMode.ORT_PARALLEL
+            options.inter_op_num_threads = self.inter_op_threads
+        return options
+
+    def __str__(self):
+        threads = lambda count: count or "default"
+        return (f"batch {self.batch_size}, {threads(self.intra_op_threads)} intra-op / "
+                f"{threads(self.inter_op_threads)} inter-op threads, {self.decode_workers} decode workers")
+
+class TuningStore:
+    # Best configuration per (host, model) in one JSON file at the model store root. The store may be
+    # shared by several machines, so entries are keyed by host name
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_store(cls, model_store):
+        return cls(model_store.root / TUNING_FILENAME)
+
+    @staticmethod
+    def key(model_repo, revision, host=None):
+        return f"{host or socket.gethostname()}|{model_repo}@{revision}"
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, model_repo, revision, host=None):
+        entry = self.load().get(self.key(model_repo, revision, host))
+        return TuningConfig.from_dict(entry["config"]) if entry else None
+
+    def put(self, model_repo, revision, config, images_per_second, peak_mb, host=None):
+        entries = self.load()
+        entries[self.key(model_repo, revision, host)] = {
+            "config": config.as_dict(), "images_per_second": round(images_per_second, 2),
+            "peak_mb": round(peak_mb) if peak_mb is not None else None, "tuned": time.time(),
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters),
+                                                 counters.cb)
+        return counters.PeakWorkingSetSize / 2**20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10  # bytes on macOS, KiB elsewhere
+
+def run_trial(store_root, model_repo, revision, config, image_paths, seconds):
+    # Runs in a fresh process, so the peak memory belongs to this configuration alone
+    from .model_store import ModelStore
+    from .tagger import Predictor
+
+    config = TuningConfig.from_dict(config)
+    predictor = Predictor(ModelStore(store_root), tuning=config)
+    predictor.load_model(model_repo, revision)
+    for _ in predictor.run_many(image_paths[:config.batch_size], model_repo, revision):
+        pass  # warm-up, the first run allocates the arena
+    # The sample goes round until the time is up, so small samples still give steady numbers
+    count = 0
+    start = time.perf_counter()
+    for _ in predictor.run_many(itertools.cycle(image_paths), model_repo, revision):
+        count += 1
+        if count % config.batch_size == 0 and time.perf_counter() - start > seconds:
+            break
+    return count / (time.perf_counter() - start), peak_memory_mb()
+
+def thread_candidates(cpus):
+    intra = sorted({cpus, max(1, cpus // 2), max(1, cpus // 4)}, reverse=True)
+    candidates = [(threads, 1) for threads in intra]
+    if cpus >= 4:
+        candidates.append((cpus // 2, 2))
+    return candidates
+
+def autotune(model_store, model_repo, revision, image_paths, seconds=5, memory_cap_mb=4096, log=print):
+    # Coordinate search: session threads first, then batch size, then decode workers, each trial in a
+    # new process. Returns (config, images/s, peak MB) of the fastest trial within the memory cap
+    cpus = os.cpu_count() or 1
+    results = {}
+    context = multiprocessing.get_context("spawn")
+
+    def trial(config):
+        key = tuple(config.as_dict().values())
+        if key not in results:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                try:
+                    rate, peak_mb = pool.submit(run_trial, str(model_store.root), model_repo, revision,
+                                                config.as_dict(), image_paths, seconds).result()
+                except Exception as e:
+                    log(f"  {config}: failed ({e})")
+                    results[key] = (config, 0.0, None)
+                    return results[key]
+            over = memory_cap_mb and peak_mb > memory_cap_mb
+            log(f"  {config}: {rate:.2f} images/s, peak {peak_mb:.0f} MB" + (" (over the memory cap)" if over else ""))
+            results[key] = (config, 0.0 if over else rate, peak_mb)
+        return results[key]
+
+    def best():
+        return max(results.values(), key=lambda result: result[1])
+
+    decode_workers = min(4, cpus)
+    for intra, inter in thread_candidates(cpus):
+        trial(TuningConfig(4, intra, inter, decode_workers))
+    config = best()[0]
+    batch_best = 0.0
+    for batch_size in BATCH_SIZES:
+        _, rate, _ = trial(TuningConfig(batch_size, config.intra_op_threads, config.inter_op_threads, decode_workers))
+        if rate < BATCH_DROP * batch_best:
+            break  # past the sweet spot, or over the cap, larger batches only use more memory
+        batch_best = max(batch_best, rate)
+    config = best()[0]
+    for workers in DECODE_WORKERS:
+        if workers <= cpus:
+            trial(TuningConfig(config.batch_size, config.intra_op_threads, config.inter_op_threads, workers))
+    config, rate, peak_mb = best()
+    if not rate:
+        raise RuntimeError("No configuration ran within the memory cap")
+    return config, rate, peak_mb